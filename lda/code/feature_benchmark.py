@@ -0,0 +1,48 @@
+# Benchmark for MakeBinnedFeatures on a synthetic run
+# Times make_features with the ms2 peaks as a list of tuples and as an MS2Columns object
+# usage: python feature_benchmark.py [n_docs] [peaks_per_doc] [n_repeats]
+import sys
+import time
+
+import numpy as np
+
+from ms2lda_feature_extraction import MS1, MS2Columns, MakeBinnedFeatures
+
+def make_ms2(n_docs,peaks_per_doc,seed = 0):
+    rng = np.random.RandomState(seed)
+    ms2_list = []
+    ms2_columns = MS2Columns()
+    peak_id = 0
+    for d in range(n_docs):
+        ms1 = MS1(d,100.0 + rng.rand()*900.0,rng.rand()*1200.0,1e6,'file_{}.mzML'.format(d % 4))
+        mz = np.round(50.0 + rng.rand(peaks_per_doc)*(ms1.mz - 50.0),4)
+        intensity = np.round(rng.rand(peaks_per_doc)*1e4,1)
+        ids = np.arange(peak_id,peak_id + peaks_per_doc,dtype = np.float)
+        peak_id += peaks_per_doc
+        ms2_columns.add_spectrum(ms1,mz,intensity,ids)
+        for peak_mz,peak_intensity,ms2_id in zip(mz.tolist(),intensity.tolist(),ids.tolist()):
+            ms2_list.append((peak_mz,ms1.rt,peak_intensity,ms1,ms1.file_name,ms2_id))
+    return ms2_list,ms2_columns
+
+def time_features(ms2,n_repeats):
+    times = []
+    for i in range(n_repeats):
+        start_time = time.time()
+        corpus,word_mz_range = MakeBinnedFeatures().make_features(ms2)
+        times.append(time.time() - start_time)
+    return min(times),len(word_mz_range)
+
+if __name__ == '__main__':
+    n_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    peaks_per_doc = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    n_repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    ms2_list,ms2_columns = make_ms2(n_docs,peaks_per_doc)
+    list_time,n_words = time_features(ms2_list,n_repeats)
+    columns_time,_ = time_features(ms2_columns,n_repeats)
+
+    print
+    print "{} documents, {} ms2 peaks, {} words".format(n_docs,len(ms2_list),n_words)
+    print "{:<24}{:>12}".format('ms2 input','time (s)')
+    print "{:<24}{:>12.2f}".format('list of tuples',list_time)
+    print "{:<24}{:>12.2f}".format('MS2Columns',columns_time)
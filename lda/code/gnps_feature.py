@@ -1,4 +1,3 @@
-from Queue import PriorityQueue
 import numpy as np
 import pandas as pd
 import scipy.sparse as ss
@@ -46,38 +45,46 @@ class FeatureExtractor(object):
             temp = self._position_index(ms2, f)
             self.ms2_pos.update(temp)
 
-    def make_fragment_queue(self):
-        q = PriorityQueue()
+    # The fragment masses of all the files as arrays (masses, files, positions), sorted
+    # on mass (then peakID and file), where positions are the rows in each file's ms2
+    def make_fragment_masses(self):
+        masses = []
         for f in range(self.F):
             print "Processing fragments for file %d" % f
             ms2 = self.all_ms2[f]
-            for _, row in ms2.iterrows():
-                fragment_mz = row['mz']
-                fragment_id = row['peakID']
-                item = (fragment_mz, fragment_id, f, row)
-                q.put(item)
-        return q
-
-    def make_loss_queue(self, mode='POS'):
-        q = PriorityQueue()
+            masses.append(ms2['mz'].values.astype(float))
+        return self._sort_masses(masses)
+
+    # As make_fragment_masses, for the losses from each fragment's parent
+    def make_loss_masses(self, mode='POS'):
+        masses = []
         for f in range(self.F):
             print "Processing losses for file %d" % f
             ms1 = self.all_ms1[f]
             ms2 = self.all_ms2[f]
-            for _, row in ms2.iterrows():
-
-                key = (row['MSnParentPeakID'], f)
-                pos = self.ms1_pos[key]
-                parent_row = ms1.iloc[pos]
-                row_mz = row['mz']
-                row_id = row['peakID']
-                parent_mz = parent_row['mz']
-                loss_mz = np.abs(parent_mz - row_mz)
-
-                item = (loss_mz, row_id, f, row)
-                q.put(item)
-
-        return q
+            parent_pos = [self.ms1_pos[(parent_id, f)] for parent_id in ms2['MSnParentPeakID'].values]
+            parent_mz = ms1['mz'].values[np.array(parent_pos, dtype=int)]
+            masses.append(np.abs(parent_mz - ms2['mz'].values).astype(float))
+        return self._sort_masses(masses)
+
+    # the old names, from when these returned a PriorityQueue
+    make_fragment_queue = make_fragment_masses
+    make_loss_queue = make_loss_masses
+
+    def _sort_masses(self, file_masses):
+        masses = np.zeros(0)
+        files = np.zeros(0, dtype=int)
+        positions = np.zeros(0, dtype=int)
+        peak_ids = np.zeros(0, dtype=int)
+        for f in range(self.F):
+            n = len(file_masses[f])
+            masses = np.append(masses, file_masses[f])
+            files = np.append(files, np.zeros(n, dtype=int) + f)
+            positions = np.append(positions, np.arange(n))
+            peak_ids = np.append(peak_ids, self.all_ms2[f]['peakID'].values)
+        # the same order as the PriorityQueue used to give
+        order = np.lexsort((files, peak_ids, masses))
+        return masses[order], files[order], positions[order]
 
     def _is_valid(self, current_mass, group):
         valid = True
@@ -87,43 +94,27 @@ class FeatureExtractor(object):
             valid = False
         return valid
 
-    def group_features(self, q, grouping_tol, check_threshold=False):
+    # Splits the sorted masses (from make_fragment_masses or make_loss_masses) into groups
+    # wherever the gap to the next mass is bigger than grouping_tol ppm.
+    # Returns a dictionary of groups, each a list of (ms2 position, file, mass)
+    def group_features(self, sorted_masses, grouping_tol, check_threshold=False):
+
+        masses, files, positions = sorted_masses
+        _, upper = self._mass_range(masses[:-1], grouping_tol)
+        ends = np.append(np.where(masses[1:] > upper)[0] + 1, len(masses)) if len(masses) > 0 else []
 
         groups = {}
         k = 0
-        group = []
-        while not q.empty():
-
-            current_item = q.get()
-            current_mass = current_item[0]
-            current_file = current_item[2]
-            current_row = current_item[3]
-            item = (current_row, current_file, current_mass)
-            group.append(item)
-
-            # check if the next mass is outside tolerance
-            if len(q.queue) > 0:
-                head = q.queue[0]
-                head_mass = head[0]
-                _, upper = self._mass_range(current_mass, grouping_tol)
-                if head_mass > upper:
-
-                    if check_threshold:
-                        if self._is_valid(current_mass, group):
-                            groups[k] = group
-                            k += 1
-                    else: # nothing to check
-                        groups[k] = group
-                        k += 1
-                    group = [] # whether valid or not, discard this group
-
-            else: # no more item
-
-                if check_threshold:
-                    if self._is_valid(current_mass, group):
-                        groups[k] = group
-                else: # nothing to check
-                    groups[k] = group
+        start = 0
+        items = zip(positions.tolist(), files.tolist(), masses.tolist())
+        for end in ends:
+            group = items[start:end]
+            current_mass = group[-1][2]
+            # whether valid or not, the group is finished
+            if not check_threshold or self._is_valid(current_mass, group):
+                groups[k] = group
+                k += 1
+            start = end
 
         K = len(groups)
         print "Total groups=%d" % K
@@ -166,11 +157,9 @@ class FeatureExtractor(object):
 
     def _position_index(self, df, f):
         peakid_pos = {}
-        pos = 0
-        for _, row in df.iterrows():
-            key = (int(row['peakID']), f)
+        for pos, peak_id in enumerate(df['peakID'].values):
+            key = (int(peak_id), f)
             peakid_pos[key] = pos
-            pos += 1
         return peakid_pos
 
     def _get_doc_label(self, mz_val, rt_val):
@@ -179,7 +168,8 @@ class FeatureExtractor(object):
 
     def _print_group(self, group):
         print "%d members in the group" % len(group)
-        for row, f, _ in group:
+        for pos, f, _ in group:
+            row = self.all_ms2[f].iloc[pos]
             this_parent_id = row['MSnParentPeakID']
             this_file_id = f
             this_peak_id = row['peakID']
@@ -223,21 +213,22 @@ class FeatureExtractor(object):
 
     def _populate_counts(self, groups, group_words):
 
-        i = 0
+        parent_ids = [ms2['MSnParentPeakID'].values for ms2 in self.all_ms2]
+        intensities = [ms2['intensity'].values for ms2 in self.all_ms2]
         for k in groups:
 
             w = group_words[k]
             group = groups[k]
-            for row, f, _ in group:
+            for pos, f, _ in group:
 
                 lda_dict = self.all_counts[f]
 
-                key = (row['MSnParentPeakID'], f)
+                key = (parent_ids[f][pos], f)
                 col_pos = self.ms1_pos[key]
                 doc_id = self.all_doc_labels[f][col_pos]
-                intensity = row['intensity']
+                intensity = intensities[f][pos]
 
                 if w in lda_dict[doc_id]:
                     lda_dict[doc_id][w] += intensity
                 else:
-                    lda_dict[doc_id].update({w : intensity})
\ No newline at end of file
+                    lda_dict[doc_id].update({w : intensity})
\ No newline at end of file
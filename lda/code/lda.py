@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import multiprocessing
+import os
 import pickle
 import time
 import sys
@@ -7,10 +8,14 @@ import sys
 from scipy.special import polygamma as pg
 from scipy.special import psi as psi
 
-from parallel_calls import par_e_step
+from parallel_calls import lda_worker, LDA_STATE_ATTRIBUTES
 import numpy as np
+import scipy.sparse as sp
 
 SMALL_NUMBER = 1e-100
+# Maximum number of (document,word) entries processed in one block by the sparse e-step
+# Each block holds a (block size x K) phi array
+SPARSE_BLOCK_NNZ = 20000
 
 # This is a Gibbs sampler LDA object. Don't use it. I'll probably delete it when I have time
 class LDA(object):
@@ -175,10 +180,23 @@ class LDA(object):
 # word_index is a dictionary storing the position of each feature in numpy arrays
  # word_index is only used in multi-file as it's important that features are always in the same order.
  # In single file it is created internally
+# engine = 'dict' runs the e-step word by word over the corpus dictionary
+# engine = 'sparse' holds the corpus as a CSR document x word matrix and does the e-step
+ # in blocks of documents with numpy. Results are the same as 'dict' to floating point tolerance
+# store_phi and phi_dtype only apply to the sparse engine. With store_phi = True phi is kept
+ # in a single (nnz x K) array of type phi_dtype aligned with the CSR matrix. With store_phi = False
+ # phi is not kept during the iterations and is recomputed from the last e-step's inputs when needed
+ # (e.g. in make_dictionary). Use get_phi(doc,word) to read phi with any engine
 class VariationalLDA(object):
 	def __init__(self,corpus=None,K = 20,eta=0.1,
 		alpha=1,update_alpha=True,word_index=None,normalise = -1,
-		topic_index = None,topic_metadata = None):
+		topic_index = None,topic_metadata = None,engine = 'dict',
+		store_phi = True,phi_dtype = np.float64):
+		if not engine in ('dict','sparse'):
+			raise ValueError("Unknown engine: {}".format(engine))
+		self.engine = engine
+		self.store_phi = store_phi
+		self.phi_dtype = phi_dtype
 		self.corpus = corpus
 		self.word_index = word_index
 		self.normalise = normalise
@@ -435,19 +453,86 @@ class VariationalLDA(object):
 	# initialise = True initialises (i.e. restarts the algorithm)
 	# This means we can run the algorithm from where it got to.
 	# First time its run, initialise has to be True
-	def run_vb(self,n_its = 1,verbose=True,initialise=True):
+	# tol: stop early once the mean change per topic in beta (total change / K) drops below tol
+	# checkpoint_file: gamma, beta and alpha are saved here every checkpoint_every iterations
+	 # and at the end. If the file exists when initialising, the run carries on from it
+	 # (iterations already done count towards n_its)
+	def run_vb(self,n_its = 1,verbose=True,initialise=True,tol = None,
+		checkpoint_file = None,checkpoint_every = 10):
+		resumed = False
 		if initialise:
 			print "Initialising"
 			self.init_vb()
+			if checkpoint_file and os.path.exists(checkpoint_file):
+				resumed = self.load_checkpoint(checkpoint_file)
+		if resumed:
+			its_to_do = 0 if self.converged else max(0,n_its - self.its_performed)
+			print "Resuming from iteration {} ({} to go)".format(self.its_performed,its_to_do)
+			if its_to_do == 0:
+				self.refresh_phi()
+		else:
+			its_to_do = n_its
+			self.converged = False
 		print "Starting iterations"
-		for it in range(n_its):
+		for it in range(its_to_do):
 			start_time = time.clock()
 			diff = self.vb_step()
 			end_time = time.clock()
 			self.its_performed += 1
-			estimated_finish = ((end_time - start_time)*(n_its - it)/60.0)
+			estimated_finish = ((end_time - start_time)*(its_to_do - it)/60.0)
 			if verbose:
 				print "Iteration {} (change = {}) ({} seconds, I think I'll finish in {} minutes). Alpha: ({},{})".format(it,diff,end_time - start_time,estimated_finish,self.alpha.min(),self.alpha.max())
+			if not tol == None and diff/self.K < tol:
+				print "Converged after {} iterations (change per topic = {})".format(self.its_performed,diff/self.K)
+				self.converged = True
+			if checkpoint_file and (self.converged or self.its_performed % checkpoint_every == 0):
+				save_checkpoint(checkpoint_file,self.get_checkpoint_state())
+			if self.converged:
+				break
+		if checkpoint_file and its_to_do > 0:
+			save_checkpoint(checkpoint_file,self.get_checkpoint_state())
+
+	# Everything needed to carry on a run: phi isn't included as the next e-step recomputes it
+	def get_checkpoint_state(self):
+		return {'K': self.K,
+				'its_performed': self.its_performed,
+				'converged': self.converged,
+				'doc_index': self.doc_index,
+				'word_index': self.word_index,
+				'gamma_matrix': self.gamma_matrix,
+				'beta_matrix': self.beta_matrix,
+				'alpha': self.alpha}
+
+	# Load a state from get_checkpoint_state. The documents and words are matched up by name,
+	# so the corpus can be rebuilt in a different order. Returns False (and changes nothing)
+	# if the checkpoint is for a different corpus or K
+	def set_checkpoint_state(self,state,set_beta = True):
+		if not state['K'] == self.K or not set(state['doc_index']) == set(self.doc_index) \
+				or not set(state['word_index']) == set(self.word_index):
+			return False
+		doc_order = [state['doc_index'][doc] for doc,_ in sorted(self.doc_index.items(),key = lambda x: x[1])]
+		self.gamma_matrix = state['gamma_matrix'][doc_order,:]
+		if set_beta:
+			word_order = [state['word_index'][word] for word,_ in sorted(self.word_index.items(),key = lambda x: x[1])]
+			self.beta_matrix = state['beta_matrix'][:,word_order]
+		self.alpha = state['alpha']
+		self.its_performed = state['its_performed']
+		self.converged = state['converged']
+		return True
+
+	def load_checkpoint(self,filename):
+		print "Loading checkpoint from {}".format(filename)
+		if not self.set_checkpoint_state(load_checkpoint(filename)):
+			print "Checkpoint doesn't match this corpus, starting from scratch"
+			return False
+		return True
+
+	# Recompute phi from the current beta and gamma without changing them.
+	# Used when a run is resumed from a checkpoint with no iterations left to do
+	def refresh_phi(self):
+		gamma_matrix = self.gamma_matrix.copy()
+		self.e_step()
+		self.gamma_matrix = gamma_matrix
 
 	# D a VB step
 	def vb_step(self):
@@ -513,6 +598,8 @@ class VariationalLDA(object):
 
 	# TODO: tidy up and comment this function
 	def e_step(self):
+		if self.engine == 'sparse':
+			return self.e_step_sparse()
 		temp_beta = np.zeros((self.K,self.n_words))
 		for doc in self.corpus:
 			d = self.doc_index[doc]
@@ -536,6 +623,106 @@ class VariationalLDA(object):
 			self.gamma_matrix[d,pos] = SMALL_NUMBER
 		return temp_beta
 
+	# Sparse version of e_step. Each block of documents is done in one go:
+	# log(beta) is computed once per iteration, the columns for all the words in the block
+	# are gathered into a (nnz x K) array and exponentiated / normalised in place.
+	# The gamma and beta sums are then sparse products with the word counts
+	def e_step_sparse(self):
+		temp_beta = np.zeros((self.K,self.n_words))
+		with np.errstate(divide='ignore'):
+			log_beta = np.log(self.beta_matrix)
+		psi_gamma = psi(self.gamma_matrix)
+		indptr = self.corpus_matrix.indptr
+		indices = self.corpus_matrix.indices
+		data = self.corpus_matrix.data
+		for start,end in self.doc_blocks:
+			lo = indptr[start]
+			hi = indptr[end]
+			nnz = hi - lo
+			if nnz == 0:
+				self.gamma_matrix[start:end,:] = self.alpha
+				continue
+			phi = self.compute_block_phi(start,end,log_beta,psi_gamma)
+			if self.store_phi:
+				self.phi_array[lo:hi,:] = phi
+
+			words = indices[lo:hi]
+			phi *= data[lo:hi,None]
+			block_indptr = indptr[start:end+1] - lo
+			doc_sum = sp.csr_matrix((np.ones(nnz),np.arange(nnz),block_indptr),shape=(end - start,nnz))
+			gamma = doc_sum.dot(phi) + self.alpha
+			gamma[gamma < SMALL_NUMBER] = SMALL_NUMBER
+			self.gamma_matrix[start:end,:] = gamma
+			word_sum = sp.csr_matrix((np.ones(nnz),(words,np.arange(nnz))),shape=(self.n_words,nnz))
+			temp_beta += word_sum.dot(phi).T
+		# Keep what is needed to rebuild the phi of this e-step (K x n_words + n_docs x K)
+		# rather than phi itself (nnz x K)
+		self.phi_log_beta = log_beta
+		self.phi_psi_gamma = psi_gamma
+		return temp_beta
+
+	# Compute the normalised phi rows for the (doc,word) entries of documents start to end-1
+	# Returns an (nnz x K) array aligned with self.corpus_matrix.data[indptr[start]:indptr[end]]
+	def compute_block_phi(self,start,end,log_beta,psi_gamma):
+		indptr = self.corpus_matrix.indptr
+		lo = indptr[start]
+		hi = indptr[end]
+		words = self.corpus_matrix.indices[lo:hi]
+		doc_rows = np.repeat(np.arange(start,end),np.diff(indptr[start:end+1]))
+		log_phi = log_beta[:,words].T
+		log_phi += psi_gamma[doc_rows,:]
+		log_phi -= log_phi.max(axis=1)[:,None]
+		phi = np.exp(log_phi,out=log_phi)
+		phi /= phi.sum(axis=1)[:,None]
+		return phi
+
+	# phi for the documents start to end-1 from the last e-step, whichever engine and storage is used
+	def get_block_phi(self,start,end):
+		indptr = self.corpus_matrix.indptr
+		if self.store_phi:
+			return self.phi_array[indptr[start]:indptr[end],:]
+		if self.phi_log_beta is None:
+			# No iterations yet
+			return np.zeros((indptr[end] - indptr[start],self.K),self.phi_dtype)
+		return self.compute_block_phi(start,end,self.phi_log_beta,self.phi_psi_gamma).astype(self.phi_dtype)
+
+	# Returns the phi vector (over topics) for a word in a document
+	def get_phi(self,doc,word):
+		if self.engine == 'dict':
+			return self.phi_matrix[doc][word]
+		d = self.doc_index[doc]
+		indptr = self.corpus_matrix.indptr
+		row_words = self.corpus_matrix.indices[indptr[d]:indptr[d+1]]
+		pos = np.where(row_words == self.word_index[word])[0][0]
+		return self.get_block_phi(d,d+1)[pos,:]
+
+	# Build the CSR document x word count matrix used by the sparse engine.
+	# Rows follow self.doc_index and, within a row, words are in the order
+	# they appear in self.corpus[doc], so position i in the matrix data is
+	# the i-th (doc,word) pair of the corpus
+	def make_corpus_matrix(self):
+		di = sorted(self.doc_index.items(),key = lambda x: x[1])
+		indptr = [0]
+		indices = []
+		data = []
+		for doc,_ in di:
+			for word in self.corpus[doc]:
+				indices.append(self.word_index[word])
+				data.append(self.corpus[doc][word])
+			indptr.append(len(indices))
+		self.corpus_matrix = sp.csr_matrix((np.array(data,np.float),np.array(indices,np.int32),np.array(indptr,np.int64)),
+			shape=(self.n_docs,self.n_words))
+		# Split the documents into blocks of at most SPARSE_BLOCK_NNZ (doc,word) entries
+		# (a single document bigger than this gets a block of its own)
+		indptr = self.corpus_matrix.indptr
+		self.doc_blocks = []
+		start = 0
+		while start < self.n_docs:
+			end = np.searchsorted(indptr,indptr[start] + SPARSE_BLOCK_NNZ,side='right') - 1
+			end = min(max(end,start + 1),self.n_docs)
+			self.doc_blocks.append((start,end))
+			start = end
+
 	# Function to find the unique words in the corpus and assign them to indices
 	def find_unique_words(self):
 		word_index = {}
@@ -562,12 +749,23 @@ class VariationalLDA(object):
 		# self.gamma_matrix = np.zeros((self.n_docs,self.K),np.float) + 1.0
 		# self.phi_matrix = np.zeros((self.n_docs,self.n_words,self.K))
 		self.its_performed = 0
-		self.phi_matrix = {}
+		self.converged = False
 		self.gamma_matrix = np.zeros((self.n_docs,self.K))
+		if self.engine == 'sparse':
+			self.make_corpus_matrix()
+			self.phi_matrix = None
+			self.phi_array = None
+			self.phi_log_beta = None
+			self.phi_psi_gamma = None
+			if self.store_phi:
+				self.phi_array = np.zeros((self.corpus_matrix.nnz,self.K),self.phi_dtype)
+		else:
+			self.phi_matrix = {}
 		for doc in self.corpus:
-			self.phi_matrix[doc] = {}
-			for word in self.corpus[doc]:
-				self.phi_matrix[doc][word] = np.zeros(self.K)
+			if self.engine == 'dict':
+				self.phi_matrix[doc] = {}
+				for word in self.corpus[doc]:
+					self.phi_matrix[doc][word] = np.zeros(self.K)
 			d = self.doc_index[doc]
 			doc_total = 0.0
 			for word in self.corpus[doc]:
@@ -689,18 +887,21 @@ class VariationalLDA(object):
 				lda_dict['theta'][doc][motif_name] = t[p]
 
 		lda_dict['phi'] = {}
-		ndocs = 0
-		for doc in self.corpus:
-			ndocs += 1
-			lda_dict['phi'][doc] = {}
-			for word in self.corpus[doc]:
-				lda_dict['phi'][doc][word] = {}
-				pos = np.where(self.phi_matrix[doc][word] >= min_prob_to_keep_phi)[0]
-				for p in pos:
-					motif_name = reverse[p]
-					lda_dict['phi'][doc][word][motif_name] = self.phi_matrix[doc][word][p]
-			if ndocs % 500 == 0:
-				print "Done {}".format(ndocs)
+		if self.engine == 'sparse':
+			self.make_sparse_phi_dictionary(lda_dict['phi'],di,ri,reverse,min_prob_to_keep_phi)
+		else:
+			ndocs = 0
+			for doc in self.corpus:
+				ndocs += 1
+				lda_dict['phi'][doc] = {}
+				for word in self.corpus[doc]:
+					lda_dict['phi'][doc][word] = {}
+					pos = np.where(self.phi_matrix[doc][word] >= min_prob_to_keep_phi)[0]
+					for p in pos:
+						motif_name = reverse[p]
+						lda_dict['phi'][doc][word][motif_name] = self.phi_matrix[doc][word][p]
+				if ndocs % 500 == 0:
+					print "Done {}".format(ndocs)
 
 		if not filename == None:
 			with open(filename,'w') as f:
@@ -708,6 +909,224 @@ class VariationalLDA(object):
 
 		return lda_dict
 
+	# Fill the phi part of the output dictionary from the sparse engine's phi, a block at a time
+	# di, ri and reverse are the document, word and topic names in index order
+	def make_sparse_phi_dictionary(self,phi_dict,di,ri,reverse,min_prob_to_keep_phi):
+		indptr = self.corpus_matrix.indptr
+		indices = self.corpus_matrix.indices
+		for start,end in self.doc_blocks:
+			lo = indptr[start]
+			phi = self.get_block_phi(start,end)
+			for d in range(start,end):
+				doc = di[d]
+				phi_dict[doc] = {}
+				for pos in range(indptr[d],indptr[d+1]):
+					phi_dict[doc][ri[indices[pos]]] = {}
+			rows,topics = np.where(phi >= min_prob_to_keep_phi)
+			doc_rows = np.repeat(np.arange(start,end),np.diff(indptr[start:end+1]))
+			for r,k in zip(rows,topics):
+				doc = di[doc_rows[r]]
+				word = ri[indices[lo + r]]
+				phi_dict[doc][word][reverse[k]] = phi[r,k]
+			print "Done {}".format(end)
+
+# Online (mini-batch) variational Bayes LDA, following Hoffman, Blei and Bach (2010)
+# but with the same point estimate of beta as VariationalLDA.
+# Documents are processed batch_size at a time: gamma and phi are iterated for the batch alone
+# (until the mean change in gamma is below doc_tol, or max_doc_its), and the running
+# topic x word statistics are moved towards the batch's (scaled up to the corpus size) by
+# rho = (tau0 + t)^-kappa, where t is the number of batches seen so far. beta is these
+# statistics plus eta, normalised. Fixed topics (add_fixed_topics) are kept as they are.
+# alpha (if update_alpha) is moved towards the Newton-Raphson estimate for each batch by rho.
+# corpus can be a dictionary, as for VariationalLDA, or, for corpora that don't fit in memory,
+# a function that returns an iterator over (doc_name,{word: intensity}) pairs each time it is called
+# (e.g. reading spectra from disk). In that case word_index and n_docs have to be given, and words
+# that aren't in word_index are ignored.
+# run_vb(n_its) makes n_its passes over the corpus. make_dictionary does a final pass with the
+# learnt beta to get theta and phi for every document, and its output is the same as VariationalLDA's
+class OnlineVariationalLDA(VariationalLDA):
+	def __init__(self,corpus=None,K = 20,eta=0.1,
+		alpha=1,update_alpha=True,word_index=None,normalise = -1,
+		topic_index = None,topic_metadata = None,n_docs = None,
+		batch_size = 256,tau0 = 1.0,kappa = 0.7,max_doc_its = 100,doc_tol = 1e-3):
+		self.corpus_source = None
+		self.streamed = callable(corpus)
+		if self.streamed:
+			if word_index == None or n_docs == None:
+				raise ValueError("word_index and n_docs are needed when the corpus is streamed")
+			self.corpus_source = corpus
+			corpus = None
+		super(OnlineVariationalLDA,self).__init__(corpus = corpus,K = K,eta = eta,alpha = alpha,
+			update_alpha = update_alpha,word_index = word_index,normalise = normalise,
+			topic_index = topic_index,topic_metadata = topic_metadata,
+			engine = 'sparse',store_phi = False)
+		if self.streamed:
+			self.n_docs = n_docs
+			self.n_words = len(self.word_index)
+		else:
+			self.corpus_source = self.iterate_corpus
+		self.batch_size = batch_size
+		self.tau0 = tau0
+		self.kappa = kappa
+		self.max_doc_its = max_doc_its
+		self.doc_tol = doc_tol
+
+	# Default document source when the corpus is in memory: all the documents in a random order
+	def iterate_corpus(self):
+		docs = self.corpus.keys()
+		for pos in np.random.permutation(len(docs)):
+			yield docs[pos],self.corpus[docs[pos]]
+
+	# Group the documents from the source into batches. Each batch is a list of
+	# document names and a CSR document x word matrix
+	def iterate_batches(self,batch_size):
+		docs = []
+		indptr = [0]
+		indices = []
+		data = []
+		for doc,words in self.corpus_source():
+			# An in-memory corpus has already been normalised by VariationalLDA.__init__
+			if self.normalise > -1 and self.streamed and len(words) > 0:
+				max_i = max(words.values())
+				words = dict((word,int(self.normalise*intensity/max_i)) for word,intensity in words.items())
+			for word in words:
+				if word in self.word_index:
+					indices.append(self.word_index[word])
+					data.append(words[word])
+			indptr.append(len(indices))
+			docs.append(doc)
+			if len(docs) == batch_size:
+				yield docs,sp.csr_matrix((np.array(data,np.float),np.array(indices,np.int32),np.array(indptr,np.int64)),
+					shape=(len(docs),self.n_words))
+				docs = []
+				indptr = [0]
+				indices = []
+				data = []
+		if len(docs) > 0:
+			yield docs,sp.csr_matrix((np.array(data,np.float),np.array(indices,np.int32),np.array(indptr,np.int64)),
+				shape=(len(docs),self.n_words))
+
+	# Iterate gamma and phi for the documents in batch_matrix with beta fixed
+	# Returns gamma, psi(gamma) as used for the final phi, and the final phi
+	def infer_batch(self,batch_matrix,log_beta):
+		n_batch_docs = batch_matrix.shape[0]
+		indptr = batch_matrix.indptr
+		nnz = batch_matrix.nnz
+		gamma = np.zeros((n_batch_docs,self.K)) + self.alpha
+		gamma += (np.asarray(batch_matrix.sum(axis=1)) / self.K)
+		if nnz == 0:
+			return gamma,psi(gamma),np.zeros((0,self.K))
+		doc_rows = np.repeat(np.arange(n_batch_docs),np.diff(indptr))
+		doc_sum = sp.csr_matrix((batch_matrix.data,np.arange(nnz),indptr),shape=(n_batch_docs,nnz))
+		log_beta_words = log_beta[:,batch_matrix.indices].T
+		for it in range(self.max_doc_its):
+			psi_gamma = psi(gamma)
+			log_phi = log_beta_words + psi_gamma[doc_rows,:]
+			log_phi -= log_phi.max(axis=1)[:,None]
+			phi = np.exp(log_phi,out=log_phi)
+			phi /= phi.sum(axis=1)[:,None]
+			new_gamma = doc_sum.dot(phi) + self.alpha
+			new_gamma[new_gamma < SMALL_NUMBER] = SMALL_NUMBER
+			change = np.abs(new_gamma - gamma).mean()
+			gamma = new_gamma
+			if change < self.doc_tol:
+				break
+		return gamma,psi_gamma,phi
+
+	def init_vb(self):
+		self.its_performed = 0
+		self.converged = False
+		self.batches_done = 0
+		self.topic_word_stats = np.zeros((self.K,self.n_words))
+		if self.n_fixed_topics == 0:
+			self.beta_matrix = np.random.rand(self.K,self.n_words)
+		else:
+			self.beta_matrix[self.n_fixed_topics:,] = np.random.rand(self.K - self.n_fixed_topics,self.n_words)
+		self.beta_matrix /= self.beta_matrix.sum(axis=1)[:,None]
+
+	# One stochastic update from a batch. Returns the change in beta
+	def online_step(self,batch_matrix):
+		with np.errstate(divide='ignore'):
+			log_beta = np.log(self.beta_matrix)
+		gamma,psi_gamma,phi = self.infer_batch(batch_matrix,log_beta)
+		nnz = batch_matrix.nnz
+		phi *= batch_matrix.data[:,None]
+		word_sum = sp.csr_matrix((np.ones(nnz),(batch_matrix.indices,np.arange(nnz))),shape=(self.n_words,nnz))
+		batch_stats = word_sum.dot(phi).T * (1.0*self.n_docs/batch_matrix.shape[0])
+
+		# The first batch replaces the (empty) statistics whatever tau0 is
+		rho = 1.0 if self.batches_done == 0 else (self.tau0 + self.batches_done)**(-self.kappa)
+		self.rho = rho
+		self.topic_word_stats *= (1.0 - rho)
+		self.topic_word_stats += rho*batch_stats
+		self.batches_done += 1
+
+		temp_beta = self.topic_word_stats + self.eta
+		if self.n_fixed_topics > 0:
+			temp_beta[:self.n_fixed_topics,:] = self.beta_matrix[:self.n_fixed_topics,:]
+		temp_beta /= temp_beta.sum(axis=1)[:,None]
+		total_difference = (np.abs(temp_beta - self.beta_matrix)).sum()
+		self.beta_matrix = temp_beta
+
+		if self.update_alpha:
+			# alpha_nr works on self.gamma_matrix, so give it this batch's gamma
+			self.gamma_matrix = gamma
+			self.alpha = (1.0 - rho)*self.alpha + rho*self.alpha_nr(init_alpha = self.alpha.copy())
+			self.gamma_matrix = None
+		return total_difference
+
+	# n_its is the number of passes through the corpus
+	def run_vb(self,n_its = 1,verbose=True,initialise=True):
+		if initialise:
+			print "Initialising"
+			self.init_vb()
+		print "Starting passes"
+		for it in range(n_its):
+			start_time = time.clock()
+			docs_done = 0
+			for docs,batch_matrix in self.iterate_batches(self.batch_size):
+				diff = self.online_step(batch_matrix)
+				docs_done += len(docs)
+				if verbose:
+					print "Pass {}, {}/{} documents (change = {}, rho = {}). Alpha: ({},{})".format(it,docs_done,self.n_docs,
+						diff,self.rho,self.alpha.min(),self.alpha.max())
+			self.its_performed += 1
+			print "Pass {} done in {} seconds".format(it,time.clock() - start_time)
+
+	# Final pass with the learnt beta. Fills in the corpus, doc_index and gamma for every
+	# document, and what is needed to recompute phi, so the VariationalLDA make_dictionary works
+	def infer_corpus(self):
+		with np.errstate(divide='ignore'):
+			log_beta = np.log(self.beta_matrix)
+		if self.streamed:
+			reverse_word_index = [word for word,_ in sorted(self.word_index.items(),key = lambda x: x[1])]
+			self.corpus = {}
+		self.doc_index = {}
+		gammas = []
+		psi_gammas = []
+		for docs,batch_matrix in self.iterate_batches(self.batch_size):
+			gamma,psi_gamma,phi = self.infer_batch(batch_matrix,log_beta)
+			gammas.append(gamma)
+			psi_gammas.append(psi_gamma)
+			for i,doc in enumerate(docs):
+				self.doc_index[doc] = len(self.doc_index)
+				if self.streamed:
+					lo,hi = batch_matrix.indptr[i],batch_matrix.indptr[i+1]
+					self.corpus[doc] = dict((reverse_word_index[w],c) for w,c in zip(batch_matrix.indices[lo:hi],batch_matrix.data[lo:hi]))
+		self.n_docs = len(self.doc_index)
+		self.gamma_matrix = np.vstack(gammas)
+		self.make_corpus_matrix()
+		self.phi_log_beta = log_beta
+		self.phi_psi_gamma = np.vstack(psi_gammas)
+
+	def make_dictionary(self,metadata=None,min_prob_to_keep_beta = 1e-3,
+		min_prob_to_keep_phi = 1e-2,min_prob_to_keep_theta = 1e-2,
+		filename = None,features = None):
+		self.infer_corpus()
+		return super(OnlineVariationalLDA,self).make_dictionary(metadata = metadata,
+			min_prob_to_keep_beta = min_prob_to_keep_beta,min_prob_to_keep_phi = min_prob_to_keep_phi,
+			min_prob_to_keep_theta = min_prob_to_keep_theta,filename = filename,features = features)
+
 # MS1 object used by Variational Bayes LDA
 class MS1(object):
 	def __init__(self,ms1_id,mz,rt,intensity,name):
@@ -721,7 +1140,7 @@ class MS1(object):
 
 # TODO: comment this class!
 class MultiFileVariationalLDA(object):
-	def __init__(self,corpus_dictionary,word_index,topic_index = None,topic_metadata = None,K = 20,alpha=1,eta = 0.1,update_alpha=True,normalise = 1000.0):
+	def __init__(self,corpus_dictionary,word_index,topic_index = None,topic_metadata = None,K = 20,alpha=1,eta = 0.1,update_alpha=True,normalise = 1000.0,engine = 'dict'):
 		self.word_index = word_index # this needs to be consistent across the instances
 		self.corpus_dictionary = corpus_dictionary
 		self.K = K
@@ -732,6 +1151,7 @@ class MultiFileVariationalLDA(object):
 		self.eta = eta # Smoothing parameter for beta
 		self.individual_lda = {}
 		self.update_alpha = update_alpha		
+		self.engine = engine
 
 		self.topic_index = topic_index
 		if topic_index == None:
@@ -750,65 +1170,185 @@ class MultiFileVariationalLDA(object):
 				topic_index = self.topic_index,
 				topic_metadata = self.topic_metadata,
 				update_alpha=self.update_alpha,
-				normalise = normalise)
+				normalise = normalise,
+				engine = engine)
 			self.individual_lda[corpus_name] = new_lda
 
 
-	def run_vb(self,n_its = 10,initialise=True,parallel=False):
+	# parallel = True spreads the individual ldas over n_workers persistent processes
+	# (default: one per core, at most one per file). Each worker keeps its ldas for the
+	# whole run; per iteration only beta (through shared memory), the K x n_words e-step
+	# statistics (also shared memory) and the alphas are exchanged
+	# tol, checkpoint_file and checkpoint_every work as in VariationalLDA.run_vb
+	def run_vb(self,n_its = 10,initialise=True,parallel=False,n_workers = None,
+		tol = None,checkpoint_file = None,checkpoint_every = 10):
+		resumed = False
 		if initialise:
 			for lda_name in self.individual_lda:
 				self.individual_lda[lda_name].init_vb()
-
-		if parallel:
-			num_cores = multiprocessing.cpu_count()
-			print 'parallel=%s num_cores=%d' % (parallel, num_cores)
-			pool = multiprocessing.Pool(num_cores)
+			self.its_performed = 0
+			if checkpoint_file and os.path.exists(checkpoint_file):
+				resumed = self.load_checkpoint(checkpoint_file)
+		if resumed:
+			its_to_do = 0 if self.converged else max(0,n_its - self.its_performed)
+			print "Resuming from iteration {} ({} to go)".format(self.its_performed,its_to_do)
+			if its_to_do == 0:
+				for lda_name in self.individual_lda:
+					self.individual_lda[lda_name].refresh_phi()
 		else:
+			its_to_do = n_its
+			self.converged = False
+
+		if parallel and its_to_do > 0:
+			if n_workers == None:
+				n_workers = multiprocessing.cpu_count()
+			n_workers = max(1,min(n_workers,len(self.individual_lda)))
+			print 'parallel=%s n_workers=%d' % (parallel, n_workers)
+			self.start_workers(n_workers)
+		else:
+			parallel = False
 			print 'serial processing'
-		
-		for it in range(n_its):
 
-			print "Iteration: {}".format(it)
-			temp_beta = np.zeros((self.K,self.n_words),np.float)
-			total_difference = []
-			
-			if parallel:			
-
-				# map each param_set for an individual lda to a worker that performs par_e_step()
-				ldas = [self.individual_lda[lda_name] for lda_name in self.individual_lda]	
-				params = []
-				for l in ldas:
-					param_set = (l.corpus, l.K, l.n_words, l.doc_index, l.alpha, l.word_index, l.phi_matrix, l.beta_matrix, l.gamma_matrix)
-					params.append(param_set)
-				par_results = pool.map(par_e_step, params)
-
-				# process the results
-				assert len(par_results) == len(ldas)
-				for i in range(len(par_results)):
-					
-					beta_res, phi_res, gamma_res = par_results[i]
-					temp_beta += beta_res
-					ldas[i].phi_matrix = phi_res
-					ldas[i].gamma_matrix = gamma_res
-					
-			else: # serial
-				
+		try:
+			for it in range(its_to_do):
+
+				print "Iteration: {}".format(it)
+				temp_beta = np.zeros((self.K,self.n_words),np.float)
+
+				if parallel:
+					# On the first iteration the workers use the beta the ldas already have
+					# (their own initial beta or the one from a checkpoint)
+					temp_beta += self.parallel_e_step(use_shared_beta = it > 0)
+				else: # serial
+					for lda_name in self.individual_lda:
+						temp_beta += self.individual_lda[lda_name].e_step()
+
+					for lda_name in self.individual_lda:
+						if self.individual_lda[lda_name].update_alpha:
+							self.individual_lda[lda_name].alpha = self.individual_lda[lda_name].alpha_nr()
+
+				temp_beta += self.eta
+				temp_beta /= temp_beta.sum(axis=1)[:,None]
+				first_lda = self.individual_lda[self.individual_lda.keys()[0]]
+				total_difference = (np.abs(temp_beta - first_lda.beta_matrix)).sum()
 				for lda_name in self.individual_lda:
-					temp_beta += self.individual_lda[lda_name].e_step()
-
-			# cannot run this in parallel due to recursion .. ??
-			# see http://stackoverflow.com/questions/7222570/parallel-recursive-function-in-python
+					self.individual_lda[lda_name].beta_matrix = temp_beta
+				if parallel:
+					self.shared_beta_matrix[:] = temp_beta
+				self.its_performed += 1
+				print total_difference
+				if not tol == None and total_difference/self.K < tol:
+					print "Converged after {} iterations (change per topic = {})".format(self.its_performed,total_difference/self.K)
+					self.converged = True
+				if checkpoint_file and (self.converged or self.its_performed % checkpoint_every == 0):
+					if parallel:
+						self.collect_worker_state(['gamma_matrix'])
+					save_checkpoint(checkpoint_file,self.get_checkpoint_state())
+				if self.converged:
+					break
+			if parallel:
+				self.collect_worker_state()
+			if checkpoint_file and its_to_do > 0:
+				save_checkpoint(checkpoint_file,self.get_checkpoint_state())
+		finally:
+			if parallel:
+				self.stop_workers()
+
+	# beta is shared, so it is stored once rather than with each individual lda
+	def get_checkpoint_state(self):
+		state = {'K': self.K,
+				 'its_performed': self.its_performed,
+				 'converged': self.converged,
+				 'word_index': self.word_index,
+				 'beta_matrix': self.individual_lda[self.individual_lda.keys()[0]].beta_matrix,
+				 'individual_lda': {}}
+		for lda_name in self.individual_lda:
+			lda_state = self.individual_lda[lda_name].get_checkpoint_state()
+			del lda_state['beta_matrix']
+			state['individual_lda'][lda_name] = lda_state
+		return state
+
+	def load_checkpoint(self,filename):
+		print "Loading checkpoint from {}".format(filename)
+		state = load_checkpoint(filename)
+		matches = state['K'] == self.K and set(state['individual_lda']) == set(self.individual_lda) \
+			and set(state['word_index']) == set(self.word_index)
+		if matches:
+			# the gammas go straight into the ldas, so check every file before setting any
 			for lda_name in self.individual_lda:
-				if self.individual_lda[lda_name].update_alpha:
-					self.individual_lda[lda_name].alpha = self.individual_lda[lda_name].alpha_nr()
+				if not set(state['individual_lda'][lda_name]['doc_index']) == set(self.individual_lda[lda_name].doc_index):
+					matches = False
+		if not matches:
+			print "Checkpoint doesn't match these corpora, starting from scratch"
+			return False
+		word_order = [state['word_index'][word] for word,_ in sorted(self.word_index.items(),key = lambda x: x[1])]
+		beta_matrix = state['beta_matrix'][:,word_order]
+		for lda_name in self.individual_lda:
+			self.individual_lda[lda_name].set_checkpoint_state(state['individual_lda'][lda_name],set_beta = False)
+			self.individual_lda[lda_name].beta_matrix = beta_matrix
+		self.its_performed = state['its_performed']
+		self.converged = state['converged']
+		return True
+
+	# Start the persistent workers. The ldas are split so that each worker gets a similar
+	# number of documents. The processes are forked, so the ldas are not pickled
+	def start_workers(self,n_workers):
+		shared_beta = multiprocessing.RawArray('d',self.K*self.n_words)
+		self.shared_beta_matrix = np.frombuffer(shared_beta).reshape(self.K,self.n_words)
+		worker_ldas = [{} for w in range(n_workers)]
+		worker_docs = np.zeros(n_workers)
+		sizes = sorted([(lda_name,self.individual_lda[lda_name].n_docs) for lda_name in self.individual_lda],key = lambda x: x[1],reverse = True)
+		for lda_name,n_docs in sizes:
+			w = worker_docs.argmin()
+			worker_ldas[w][lda_name] = self.individual_lda[lda_name]
+			worker_docs[w] += n_docs
+
+		self.workers = []
+		for w in range(n_workers):
+			shared_stats = multiprocessing.RawArray('d',self.K*self.n_words)
+			conn,worker_conn = multiprocessing.Pipe()
+			process = multiprocessing.Process(target = lda_worker,
+				args = (worker_conn,worker_ldas[w],shared_beta,shared_stats,self.K,self.n_words))
+			process.daemon = True
+			process.start()
+			stats = np.frombuffer(shared_stats).reshape(self.K,self.n_words)
+			self.workers.append((process,conn,stats))
+
+	def receive_from_worker(self,conn):
+		message = conn.recv()
+		if type(message) == tuple and message[0] == 'error':
+			raise RuntimeError("LDA worker failed:\n{}".format(message[1]))
+		return message
+
+	# One e-step (and alpha update) on all workers, returns the summed beta statistics
+	def parallel_e_step(self,use_shared_beta = True):
+		for process,conn,stats in self.workers:
+			conn.send(('step',use_shared_beta))
+		temp_beta = np.zeros((self.K,self.n_words),np.float)
+		for process,conn,stats in self.workers:
+			alphas = self.receive_from_worker(conn)
+			temp_beta += stats
+			for lda_name in alphas:
+				self.individual_lda[lda_name].alpha = alphas[lda_name]
+		return temp_beta
 
-			temp_beta += self.eta
-			temp_beta /= temp_beta.sum(axis=1)[:,None]
-			first_lda = self.individual_lda[self.individual_lda.keys()[0]]			
-			total_difference = (np.abs(temp_beta - first_lda.beta_matrix)).sum()
-			for lda_name in self.individual_lda:
-				self.individual_lda[lda_name].beta_matrix = temp_beta
-			print total_difference
+	# Copy gamma, phi etc. back from the workers. All of them are only fetched at the end of
+	# the run, checkpoints just need gamma
+	def collect_worker_state(self,attributes = LDA_STATE_ATTRIBUTES):
+		for process,conn,stats in self.workers:
+			conn.send(('state',attributes))
+			state = self.receive_from_worker(conn)
+			for lda_name in state:
+				for attribute,value in state[lda_name].items():
+					setattr(self.individual_lda[lda_name],attribute,value)
+
+	def stop_workers(self):
+		for process,conn,stats in self.workers:
+			if process.is_alive():
+				conn.send(('stop',))
+			process.join()
+		self.workers = []
+		self.shared_beta_matrix = None
 
 	def make_dictionary(self,min_prob_to_keep_beta = 1e-3,
 						min_prob_to_keep_phi = 1e-2,min_prob_to_keep_theta = 1e-2,
@@ -829,6 +1369,18 @@ class MultiFileVariationalLDA(object):
 
 		return multifile_dict
 
+# Checkpoints are pickled to a temporary file and then renamed over the old one,
+# so a run killed while writing leaves the previous checkpoint intact
+def save_checkpoint(filename,state):
+	temp_filename = filename + '.tmp'
+	with open(temp_filename,'wb') as f:
+		pickle.dump(state,f,pickle.HIGHEST_PROTOCOL)
+	os.rename(temp_filename,filename)
+
+def load_checkpoint(filename):
+	with open(filename,'rb') as f:
+		return pickle.load(f)
+
 def make_split_dictionary(mflda,filename,postfix,features = None):
 	# Makes a multifile LDA into several individual dictionary files
 	multifile_dict = {}
@@ -0,0 +1,76 @@
+# Benchmarks for VariationalLDA on a synthetic corpus
+# Each configuration is run in its own process so the peak resident memory
+# (ru_maxrss) of one doesn't leak into the next
+# usage: python lda_benchmark.py [n_docs] [words_per_doc] [K] [n_its]
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+
+from lda import VariationalLDA
+
+CONFIGURATIONS = [
+	('dict engine',{'engine':'dict'}),
+	('sparse engine, float64 phi',{'engine':'sparse','store_phi':True,'phi_dtype':np.float64}),
+	('sparse engine, float32 phi',{'engine':'sparse','store_phi':True,'phi_dtype':np.float32}),
+	('sparse engine, phi not stored',{'engine':'sparse','store_phi':False}),
+]
+
+def make_corpus(n_docs,words_per_doc,vocab_size = 5000,seed = 0):
+	rng = np.random.RandomState(seed)
+	corpus = {}
+	for d in range(n_docs):
+		doc = '{:.4f}_{}'.format(100.0 + rng.rand()*900.0,d)
+		corpus[doc] = {}
+		for w in rng.choice(vocab_size,words_per_doc,replace = False):
+			corpus[doc]['fragment_{:.4f}'.format(50.0 + 0.005*w)] = float(rng.randint(1,1000))
+	return corpus
+
+# Bytes held by the phi storage of a vlda object
+def phi_bytes(vlda):
+	if vlda.engine == 'dict':
+		total = sys.getsizeof(vlda.phi_matrix)
+		for doc in vlda.phi_matrix:
+			total += sys.getsizeof(vlda.phi_matrix[doc])
+			for word in vlda.phi_matrix[doc]:
+				total += sys.getsizeof(vlda.phi_matrix[doc][word])
+		return total
+	if vlda.store_phi:
+		return vlda.phi_array.nbytes
+	return vlda.phi_log_beta.nbytes + vlda.phi_psi_gamma.nbytes
+
+def run_configuration(args):
+	name,options,n_docs,words_per_doc,K,n_its = args
+	corpus = make_corpus(n_docs,words_per_doc)
+	np.random.seed(1)
+	vlda = VariationalLDA(corpus = corpus,K = K,normalise = 1000.0,**options)
+	start_time = time.time()
+	vlda.run_vb(n_its = n_its,verbose = False)
+	run_time = time.time() - start_time
+	start_time = time.time()
+	vlda.make_dictionary()
+	dict_time = time.time() - start_time
+	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 # kB on linux
+	return name,phi_bytes(vlda) / (1024.0*1024.0),max_rss,run_time / n_its,dict_time
+
+if __name__ == '__main__':
+	n_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	words_per_doc = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+	K = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+	n_its = int(sys.argv[4]) if len(sys.argv) > 4 else 2
+
+	results = []
+	for name,options in CONFIGURATIONS:
+		# maxtasksperchild = 1 gives every configuration a fresh process
+		pool = multiprocessing.Pool(1,maxtasksperchild = 1)
+		results.append(pool.apply(run_configuration,((name,options,n_docs,words_per_doc,K,n_its),)))
+		pool.close()
+		pool.join()
+
+	print
+	print "{} documents, {} words per document, K = {}".format(n_docs,words_per_doc,K)
+	print "{:<32}{:>14}{:>16}{:>16}{:>22}".format('','phi (MB)','peak RSS (MB)','s / iteration','make_dictionary (s)')
+	for name,phi_mb,max_rss,it_time,dict_time in results:
+		print "{:<32}{:>14.1f}{:>16.1f}{:>16.2f}{:>22.2f}".format(name,phi_mb,max_rss,it_time,dict_time)
@@ -60,7 +60,7 @@ class VariationalLDAPlotter(object):
         intensity = self.v_lda.corpus[doc][word]
         if intensity > max_intensity:
             max_intensity = intensity
-        topic_contribution = self.v_lda.phi_matrix[doc][word][topic]
+        topic_contribution = self.v_lda.get_phi(doc,word)[topic]
         if word_type == 'fragment':
             mass = float(word.split('_')[1])
             if mass > max_mass:
@@ -182,7 +182,7 @@ class VariationalLDAPlotter(object):
                     max_intensity = intensity
                 cum = 0.0
                 for t in topics_to_plot:
-                    height = intensity*self.v_lda.phi_matrix[doc][word][t]
+                    height = intensity*self.v_lda.get_phi(doc,word)[t]
                     name = "motif_{}".format(t)
                     if t in topics_plotted:
                       s = Scatter(
@@ -225,7 +225,7 @@ class VariationalLDAPlotter(object):
                 pos = start
                 y = 0.9*self.v_lda.corpus[doc][word]
                 for t in topics_to_plot:
-                    width = loss_mass*self.v_lda.phi_matrix[doc][word][t]
+                    width = loss_mass*self.v_lda.get_phi(doc,word)[t]
                     name = "motif_{}".format(t)
                     if t in topics_plotted:
                         s = Scatter(
@@ -547,7 +547,7 @@ class VariationalLDAPlotter_dict(object):
                 pos = start
                 y = 0.9*self.v_lda.corpus[doc][word]
                 for t in topics_to_plot:
-                    width = loss_mass*self.v_lda.phi_matrix[doc][word][t]
+                    width = loss_mass*self.v_lda.get_phi(doc,word)[t]
                     name = "motif_{}".format(t)
                     if t in topics_plotted:
                         s = Scatter(
@@ -1,11 +1,10 @@
-import math
 import itertools
 import copy
 import csv
 from collections import defaultdict
 
-from Queue import PriorityQueue
-from scipy.sparse import lil_matrix
+import numpy as np
+from scipy.sparse import coo_matrix
 
 class MatchFeature(object):
 
@@ -28,8 +27,10 @@ class SimpleMatching:
 
     def run(self, feature_list_1, feature_list_2, mz_tol, rt_tol):
 
-        feature_list_1 = copy.deepcopy(feature_list_1)
-        feature_list_2 = copy.deepcopy(feature_list_2)
+        # copies so that the matched flags of the originals aren't changed (the metadata
+        # isn't modified so is shared with the originals)
+        feature_list_1 = [copy.copy(f) for f in feature_list_1]
+        feature_list_2 = [copy.copy(f) for f in feature_list_2]
 
         dist_mat = self.compute_scores(feature_list_1, feature_list_2, mz_tol, rt_tol)
         matches = self.approximate_match(feature_list_1, feature_list_2, dist_mat)
@@ -53,31 +54,50 @@ class SimpleMatching:
 
         return results
 
+    # Distances between all the pairs of features that are within tolerance, as a coo matrix
+    # (which can hold explicit zeros, for features at exactly the same place).
+    # The candidate pairs come from a sweep over the features of feature_list_2 sorted by mz,
+    # rather than checking every pair
     def compute_scores(self, feature_list_1, feature_list_2, mz_tol, rt_tol):
 
         print 'Computing scores'
 
         n_row = len(feature_list_1)
         n_col = len(feature_list_2)
-        dist_mat = lil_matrix((n_row, n_col))
-
-        # slow
-        for i in range(len(feature_list_1)):
-            f1 = feature_list_1[i]
-            for j in range(len(feature_list_2)):
-                f2 = feature_list_2[j]
-                if self.is_within_tolerance(f1, f2, mz_tol, rt_tol):
-                    dist_mat[i, j] = self.compute_dist(f1, f2, mz_tol, rt_tol)
+        mz_1, rt_1 = self.get_arrays(feature_list_1)
+        mz_2, rt_2 = self.get_arrays(feature_list_2)
+
+        # the features of feature_list_2 inside the mass range of each feature of feature_list_1
+        order = np.argsort(mz_2, kind='mergesort')
+        mz_lower, mz_upper = self.get_mass_range(mz_1, mz_tol)
+        starts = np.searchsorted(mz_2[order], mz_lower, side='right')
+        ends = np.searchsorted(mz_2[order], mz_upper, side='left')
+        lengths = np.maximum(ends - starts, 0)
+        rows = np.repeat(np.arange(n_row), lengths)
+        offsets = np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        cols = order[np.arange(len(rows)) - offsets]
+
+        within = self.is_within_tolerance(mz_1[rows], rt_1[rows], mz_2[cols], rt_2[cols], mz_tol, rt_tol)
+        rows = rows[within]
+        cols = cols[within]
+        dists = self.compute_dist(mz_1[rows], rt_1[rows], mz_2[cols], rt_2[cols], mz_tol, rt_tol)
+        dist_mat = coo_matrix((dists, (rows, cols)), shape=(n_row, n_col))
 
         return dist_mat
 
-    def is_within_tolerance(self, f1, f2, mz_tol, rt_tol):
+    def get_arrays(self, feature_list):
+
+        mz = np.array([f.mz for f in feature_list], dtype=float)
+        rt = np.array([np.nan if f.rt is None else f.rt for f in feature_list], dtype=float)
+        return mz, rt
+
+    def is_within_tolerance(self, mz_1, rt_1, mz_2, rt_2, mz_tol, rt_tol):
 
-        mz_lower, mz_upper = self.get_mass_range(f1.mz, mz_tol)
-        rt_lower, rt_upper = self.get_rt_range(f1.rt, rt_tol)
-        mz_ok = (mz_lower < f2.mz) and (f2.mz < mz_upper)
-        rt_ok = (rt_lower < f2.rt) and (f2.rt < rt_upper)
-        return mz_ok and rt_ok
+        mz_lower, mz_upper = self.get_mass_range(mz_1, mz_tol)
+        rt_lower, rt_upper = self.get_rt_range(rt_1, rt_tol)
+        mz_ok = (mz_lower < mz_2) & (mz_2 < mz_upper)
+        rt_ok = (rt_lower < rt_2) & (rt_2 < rt_upper)
+        return mz_ok & rt_ok
 
     def get_mass_range(self, mz, mz_tol):
 
@@ -92,30 +112,27 @@ class SimpleMatching:
         upper = rt + rt_tol
         return lower, upper
 
-    def compute_dist(self, f1, f2, mz_tol, rt_tol):
+    def compute_dist(self, mz_1, rt_1, mz_2, rt_2, mz_tol, rt_tol):
 
-        mz = f1.mz - f2.mz
-        rt = f1.rt - f2.rt
-        dist = math.sqrt((rt*rt)/(rt_tol*rt_tol) + (mz*mz)/(mz_tol*mz_tol))
+        mz = mz_1 - mz_2
+        rt = rt_1 - rt_2
+        dist = np.sqrt((rt*rt)/(rt_tol*rt_tol) + (mz*mz)/(mz_tol*mz_tol))
         return dist
 
+    # Greedy matching: the candidate pairs are taken in order of increasing distance (then row
+    # and column) and a pair is matched if neither of its features has been matched yet
     def approximate_match(self, feature_list_1, feature_list_2, dist_mat):
 
         print 'Matching'
-        dist_mat = dist_mat.tolil()
+        dist_mat = dist_mat.tocoo()
         matches = []
 
-        q = self.make_queue(dist_mat)
-        while not q.empty(): # while there are candidates to match
+        matched_1 = [False] * len(feature_list_1)
+        matched_2 = [False] * len(feature_list_2)
+        order = np.lexsort((dist_mat.col, dist_mat.row, dist_mat.data))
+        for i, j in itertools.izip(dist_mat.row[order].tolist(), dist_mat.col[order].tolist()):
 
-            # get the next candidate match with smallest distance
-            pq_entry = q.get()
-            priority = pq_entry[0]
-            item = pq_entry[1]
-            i = item[0]
-            j = item[1]
-
-            if dist_mat[i, j] != 0: # if they have not been matched
+            if not matched_1[i] and not matched_2[j]: # if they have not been matched
 
                 # match the candidates together
                 f1 = feature_list_1[i]
@@ -123,23 +140,12 @@ class SimpleMatching:
                 match = set([f1, f2])
                 matches.append(match)
 
-                # f1 and f2 cannot be matched anymore, so set row i and col j to 0
-                dist_mat[i, :] = 0
-                dist_mat[:, j] = 0
+                # f1 and f2 cannot be matched anymore
+                matched_1[i] = True
+                matched_2[j] = True
 
         return matches
 
-    def make_queue(self, dist_arr):
-
-        # make a queue of candidate matches ordered by distance (ascending)
-        q = PriorityQueue()
-        dist_arr = dist_arr.tocoo()
-        for i, j, v in itertools.izip(dist_arr.row, dist_arr.col, dist_arr.data):
-            dist = v
-            item = (i, j)
-            q.put((dist, item))
-        return q
-
 class MassOnlyMatching(SimpleMatching):
 
     def process(self, input_set, mz_tol):
@@ -201,14 +207,14 @@ class MassOnlyMatching(SimpleMatching):
             if f.metadata['filename'] == ref_filename:
                 return f
 
-    def is_within_tolerance(self, f1, f2, mz_tol, rt_tol):
+    def is_within_tolerance(self, mz_1, rt_1, mz_2, rt_2, mz_tol, rt_tol):
 
-        mz_lower, mz_upper = self.get_mass_range(f1.mz, mz_tol)
-        mz_ok = (mz_lower < f2.mz) and (f2.mz < mz_upper)
+        mz_lower, mz_upper = self.get_mass_range(mz_1, mz_tol)
+        mz_ok = (mz_lower < mz_2) & (mz_2 < mz_upper)
         return mz_ok
 
-    def compute_dist(self, f1, f2, mz_tol, rt_tol):
+    def compute_dist(self, mz_1, rt_1, mz_2, rt_2, mz_tol, rt_tol):
 
-        mz = f1.mz - f2.mz
-        dist = math.sqrt((mz*mz)/(mz_tol*mz_tol))
+        mz = mz_1 - mz_2
+        dist = np.sqrt((mz*mz)/(mz_tol*mz_tol))
         return dist
\ No newline at end of file
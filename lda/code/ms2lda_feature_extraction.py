@@ -4,6 +4,9 @@ from Queue import PriorityQueue
 import numpy as np
 import sys, os
 import re
+import time
+import scipy.sparse as sp
+import multiprocessing
 # sys.path.append('/Users/simon/git/efcompute')
 # from ef_assigner import ef_assigner
 # from formula import Formula
@@ -29,6 +32,150 @@ class MS1(object):
         return self.name
 
 
+# Columnar store for MS2 peaks, an alternative to the usual list of
+# (mz,rt,intensity,parent,file_name,id) tuples that needs much less memory for big runs.
+# Each peak is a row of the numpy columns mz, intensity, parent_index (into self.parents,
+# the list of MS1 objects), file_index (into self.file_names) and ids. The rt of a peak
+# is the rt of its parent.
+# Iterating (or indexing) gives the same tuples as the list, so code written for the
+# tuples still works, but the columns can be used directly.
+class MS2Columns(object):
+    def __init__(self):
+        self.parents = []
+        self.file_names = []
+        self._parent_pos = {}
+        self._file_pos = {}
+        self._chunks = []
+        self._columns = (np.zeros(0,np.float),np.zeros(0,np.float),np.zeros(0,np.int),np.zeros(0,np.int),np.zeros(0,np.float))
+
+    def _parent_position(self,ms1):
+        if not ms1 in self._parent_pos:
+            self._parent_pos[ms1] = len(self.parents)
+            self.parents.append(ms1)
+            if not ms1.file_name in self._file_pos:
+                self._file_pos[ms1.file_name] = len(self.file_names)
+                self.file_names.append(ms1.file_name)
+        return self._parent_pos[ms1]
+
+    # Adds the peaks of one spectrum (arrays of mz, intensity and ids) with parent ms1
+    def add_spectrum(self,ms1,mz,intensity,ids):
+        parent_pos = self._parent_position(ms1)
+        n = len(mz)
+        self._chunks.append((np.asarray(mz,np.float),np.asarray(intensity,np.float),
+                             np.zeros(n,np.int) + parent_pos,np.zeros(n,np.int) + self._file_pos[ms1.file_name],
+                             np.asarray(ids,np.float)))
+
+    def _get_columns(self):
+        if len(self._chunks) > 0:
+            self._columns = tuple(np.concatenate([c[i] for c in [self._columns] + self._chunks]) for i in range(5))
+            self._chunks = []
+        return self._columns
+
+    @property
+    def mz(self):
+        return self._get_columns()[0]
+
+    @property
+    def intensity(self):
+        return self._get_columns()[1]
+
+    @property
+    def parent_index(self):
+        return self._get_columns()[2]
+
+    @property
+    def file_index(self):
+        return self._get_columns()[3]
+
+    @property
+    def ids(self):
+        return self._get_columns()[4]
+
+    # mz of the parent of each peak (nan where the parent has no mz)
+    @property
+    def parent_mz(self):
+        parent_mz = np.array([np.nan if m.mz is None else m.mz for m in self.parents],np.float)
+        return parent_mz[self.parent_index]
+
+    def __len__(self):
+        return len(self.mz)
+
+    def __getitem__(self,i):
+        mz,intensity,parent_index,file_index,ids = self._get_columns()
+        parent = self.parents[parent_index[i]]
+        return (float(mz[i]),parent.rt,float(intensity[i]),parent,self.file_names[file_index[i]],float(ids[i]))
+
+    def __iter__(self):
+        mz,intensity,parent_index,file_index,ids = self._get_columns()
+        for peak_mz,peak_intensity,parent_pos,peak_id in zip(mz.tolist(),intensity.tolist(),parent_index.tolist(),ids.tolist()):
+            parent = self.parents[parent_pos]
+            yield (peak_mz,parent.rt,peak_intensity,parent,parent.file_name,peak_id)
+
+    # New MS2Columns holding the given rows, with new_parents[i] (if given) as the parent of rows[i]
+    def select(self,rows,new_parents = None):
+        mz,intensity,parent_index,file_index,ids = self._get_columns()
+        selected = MS2Columns()
+        if new_parents is None:
+            new_parents = [self.parents[p] for p in parent_index[rows]]
+        if len(rows) == 0:
+            return selected
+        parent_positions = np.array([selected._parent_position(m) for m in new_parents],np.int)
+        file_positions = np.array([selected._file_pos[m.file_name] for m in new_parents],np.int)
+        selected._columns = (mz[rows],intensity[rows],parent_positions,file_positions,ids[rows])
+        return selected
+
+    # The peaks whose parent is in the set keep
+    def filter_parents(self,keep):
+        keep_parent = np.array([m in keep for m in self.parents],np.bool)
+        return self.select(np.where(keep_parent[self.parent_index])[0])
+
+    def filter_intensity(self,min_intensity):
+        return self.select(np.where(self.intensity >= min_intensity)[0])
+
+    # Adds all of the peaks of another MS2Columns, adding id_offset to their ids
+    def append_columns(self,other,id_offset = 0):
+        mz,intensity,parent_index,file_index,ids = other._get_columns()
+        if len(mz) == 0:
+            return
+        parent_positions = np.array([self._parent_position(m) for m in other.parents],np.int)
+        file_positions = np.array([self._file_pos[m.file_name] for m in other.parents],np.int)
+        self._chunks.append((mz,intensity,parent_positions[parent_index],file_positions[parent_index],ids + id_offset))
+
+    # The rows of each parent, in the order they were added
+    def parent_rows(self):
+        order = np.argsort(self.parent_index,kind = 'mergesort')
+        boundaries = np.searchsorted(self.parent_index[order],np.arange(len(self.parents) + 1))
+        rows = {}
+        for i,m in enumerate(self.parents):
+            rows[m] = order[boundaries[i]:boundaries[i+1]]
+        return rows
+
+
+# Index over a list of MS1 objects for m/z and RT window queries
+# The MS1 are kept sorted by m/z (in self.ms1), so the m/z window is found with two
+# binary searches and only the MS1 inside it have their RT checked
+class MS1Index(object):
+    def __init__(self,ms1):
+        self.ms1 = sorted(ms1,key = lambda x: x.mz)
+        self.mz = np.array([x.mz for x in self.ms1],np.float)
+        self.rt = np.array([x.rt for x in self.ms1],np.float)
+
+    # Positions (in self.ms1, i.e. in m/z order) of the MS1 with min_mz <= mz <= max_mz
+    # and min_rt <= rt <= max_rt, or with strict inequalities if inclusive is False
+    def window(self,min_mz,max_mz,min_rt,max_rt,inclusive = True):
+        if inclusive:
+            start = np.searchsorted(self.mz,min_mz,'left')
+            end = np.searchsorted(self.mz,max_mz,'right')
+            rt = self.rt[start:end]
+            hits = np.where((rt >= min_rt) & (rt <= max_rt))[0]
+        else:
+            start = np.searchsorted(self.mz,min_mz,'right')
+            end = np.searchsorted(self.mz,max_mz,'left')
+            rt = self.rt[start:end]
+            hits = np.where((rt > min_rt) & (rt < max_rt))[0]
+        return hits + start
+
+
 
 
 
@@ -75,6 +222,66 @@ class Loader(object):
     def load_spectra(self,input_set):
         raise NotImplementedError("load spectra method must be implemented")
 
+    # Loaders whose files can be parsed independently set parallel_files = True and split
+    # load_spectra into _parse_files (which reads the files, giving ms1 and ms2 ids numbered
+    # from 0 without gaps) and _filter_spectra (everything afterwards)
+    parallel_files = False
+
+    def _parse_files(self,input_set,**kwargs):
+        raise NotImplementedError("_parse_files method must be implemented for parallel loading")
+
+    def _filter_spectra(self,ms1,ms2,metadata):
+        raise NotImplementedError("_filter_spectra method must be implemented for parallel loading")
+
+    # Changes the id of an ms1 parsed from one file when it is merged with the others
+    def _renumber_ms1(self,ms1,offset):
+        ms1.id += offset
+
+    # Loads the files in input_set in parallel, parsing each one in a separate process
+    # The results are merged in input order and renumbered so the ms1 and ms2 ids (and anything
+    # derived from them) are the same as if the files had been loaded one after the other, and
+    # then filtered as in load_spectra, so filters that look across all of the files (peaklist,
+    # duplicates) see everything. Falls back to load_spectra for loaders that don't support it.
+    def load_spectra_parallel(self,input_set,n_processes = None,**kwargs):
+        if not self.parallel_files:
+            print "{} can't load files in parallel, loading them one at a time".format(self)
+            return self.load_spectra(input_set,**kwargs)
+
+        start_time = time.time()
+        pool = multiprocessing.Pool(n_processes)
+        results = pool.map(_parse_file,[(self,input_file,kwargs) for input_file in input_set])
+        pool.close()
+        pool.join()
+
+        ms1 = []
+        ms2 = None
+        metadata = {}
+        ms1_offset = 0
+        ms2_offset = 0
+        for input_file,(file_ms1,file_ms2,file_metadata,parse_time) in zip(input_set,results):
+            print "Parsed {} in {:.1f}s ({} ms1, {} ms2)".format(input_file,parse_time,len(file_ms1),len(file_ms2))
+            for m in file_ms1:
+                doc_metadata = file_metadata[m.name]
+                self._renumber_ms1(m,ms1_offset)
+                metadata[m.name] = doc_metadata
+            ms1 += file_ms1
+            if isinstance(file_ms2,MS2Columns):
+                if ms2 is None:
+                    ms2 = MS2Columns()
+                ms2.append_columns(file_ms2,ms2_offset)
+            else:
+                if ms2 is None:
+                    ms2 = []
+                for peak in file_ms2:
+                    ms2.append(peak[:5] + (peak[5] + ms2_offset,))
+            ms1_offset += len(file_ms1)
+            ms2_offset += len(file_ms2)
+        if ms2 is None:
+            ms2 = []
+        print "Parsed {} files in {:.1f}s".format(len(input_set),time.time() - start_time)
+
+        return self._filter_spectra(ms1,ms2,metadata)
+
     ## modify peaklist function
     ## try to detect "featureid", store it in ms1_peaks used for in for mgf ms1 analysis
     ## ms1_peaks: [featid, mz,rt,intensity], featid will be None if "FeatureId" not exist
@@ -129,7 +336,8 @@ class Loader(object):
         print ms1[0], metadata.values()[0]
 
         self._load_peak_list()
-        ms1 = sorted(ms1,key = lambda x: x.mz)
+        ms1_index = MS1Index(ms1)
+        ms1 = ms1_index.ms1
         new_ms1_list = []
         new_ms2_list = []
         new_metadata = {}
@@ -151,10 +359,27 @@ class Loader(object):
         ## build ms1_ms2 dict, to make searching O(1) in the following loop
         ## key: ms1 object
         ## value: list of ms2
-        ms1_ms2_dict = {}
-        for el in ms2:
-            ms1_ms2_dict.setdefault(el[3], [])
-            ms1_ms2_dict[el[3]].append(el)
+        ## the most intense ms2 peak of each ms1, and its position in ms2 (to break ties
+        ## in the same way as a scan through ms2 would)
+        ms1_best_ms2 = {}
+        columnar = isinstance(ms2,MS2Columns)
+        if columnar:
+            ## for columnar ms2 the values of ms1_ms2_dict are the rows of the ms1's peaks
+            ms1_ms2_dict = ms2.parent_rows()
+            for el,rows in ms1_ms2_dict.items():
+                if len(rows) > 0:
+                    best = rows[np.argmax(ms2.intensity[rows])]
+                    ms1_best_ms2[el] = (ms2.intensity[best],best)
+            new_ms2_rows = []
+            new_ms2_parents = []
+        else:
+            ms1_ms2_dict = {}
+            for el in ms2:
+                ms1_ms2_dict.setdefault(el[3], [])
+                ms1_ms2_dict[el[3]].append(el)
+            for pos,el in enumerate(ms2):
+                if not el[3] in ms1_best_ms2 or el[2] > ms1_best_ms2[el[3]][0]:
+                    ms1_best_ms2[el[3]] = (el[2],pos)
 
         for n_peaks_checked,peak in enumerate(self.ms1_peaks):
             if n_peaks_checked % 500 == 0:
@@ -177,7 +402,7 @@ class Loader(object):
                 max_rt = peak_rt + self.rt_tol
 
 
-                ms1_hits = filter(lambda x: x.mz >= min_mz and x.mz <= max_mz and x.rt >= min_rt and x.rt <= max_rt,ms1)
+                ms1_hits = [ms1[pos] for pos in ms1_index.window(min_mz,max_mz,min_rt,max_rt)]
 
                 if len(ms1_hits) == 1:
                     # Found one hit, easy
@@ -186,11 +411,14 @@ class Loader(object):
                     # Find the one with the most intense MS2 peak
                     best_ms1 = None
                     best_intensity = 0.0
-                    for frag_peak in ms2:
-                        if frag_peak[3] in ms1_hits:
-                            if frag_peak[2] > best_intensity:
-                                best_intensity = frag_peak[2]
-                                best_ms1 = frag_peak[3]
+                    best_pos = None
+                    for hit in ms1_hits:
+                        if hit in ms1_best_ms2:
+                            intensity,pos = ms1_best_ms2[hit]
+                            if intensity > best_intensity or (intensity == best_intensity and best_ms1 is not None and pos < best_pos):
+                                best_intensity = intensity
+                                best_ms1 = hit
+                                best_pos = pos
                     old_ms1 = best_ms1
 
                 else:
@@ -232,10 +460,19 @@ class Loader(object):
             if old_ms1 in ms1_ms2_dict:
                 ms2_objects = ms1_ms2_dict[old_ms1]
 
+            if columnar:
+                new_ms2_rows.append(ms2_objects)
+                new_ms2_parents += [new_ms1]*len(ms2_objects)
+                continue
+
             for frag_peak in ms2_objects:
                 new_frag_peak = (frag_peak[0],peak_rt,frag_peak[2],new_ms1,frag_peak[4],frag_peak[5])
                 new_ms2_list.append(new_frag_peak)
 
+        if columnar:
+            rows = np.concatenate(new_ms2_rows) if len(new_ms2_rows) > 0 else np.zeros(0,np.int)
+            new_ms2_list = ms2.select(rows.astype(np.int),new_ms2_parents)
+
         # replace the ms1,ms2 and metadata with the new versions
         ms1 = new_ms1_list
         ms2 = new_ms2_list
@@ -250,13 +487,20 @@ class Loader(object):
         ## Sometimes ms1 intensity could be None
         ms1 = filter(lambda x: False if x.intensity and x.intensity < min_ms1_intensity else True, ms1)
         print "{} MS1 remaining".format(len(ms1))
-        ms2 = filter(lambda x: x[3] in set(ms1), ms2)
+        ms1_set = set(ms1)
+        if isinstance(ms2,MS2Columns):
+            ms2 = ms2.filter_parents(ms1_set)
+        else:
+            ms2 = filter(lambda x: x[3] in ms1_set, ms2)
         print "{} MS2 remaining".format(len(ms2))
         return ms1, ms2
 
     def filter_ms2_intensity(self,ms2, min_ms2_intensity = 1e6):
         print "Filtering MS2 on intensity"
-        ms2 = filter(lambda x: x[2] >= min_ms2_intensity, ms2)
+        if isinstance(ms2,MS2Columns):
+            ms2 = ms2.filter_intensity(min_ms2_intensity)
+        else:
+            ms2 = filter(lambda x: x[2] >= min_ms2_intensity, ms2)
         print "{} MS2 remaining".format(len(ms2))
         return ms2
 
@@ -268,16 +512,21 @@ class Loader(object):
         # Sort the remaining ones by intensity
         ms1_by_intensity = sorted(ms1,key = lambda x: x.intensity,reverse=True)
 
+        # removed is indexed by position in ms1_index.ms1
+        ms1_index = MS1Index(ms1)
+        index_pos = {}
+        for pos,m in enumerate(ms1_index.ms1):
+            index_pos[m] = pos
+        removed = np.zeros(len(ms1_index.ms1),np.bool)
 
         final_ms1_list = []
         final_ms2_list = []
-        while True:
-            if len(ms1_by_intensity) == 0:
-                break
+        for current_ms1 in ms1_by_intensity:
+            if removed[index_pos[current_ms1]]:
+                continue
             # Take the highest intensity one, find things within the window and remove them
-            current_ms1 = ms1_by_intensity[0]
             final_ms1_list.append(current_ms1)
-            del ms1_by_intensity[0]
+            removed[index_pos[current_ms1]] = True
 
             current_mz = current_ms1.mz
             mz_err = mz_tol*1.0*current_mz/(1.0*1e6)
@@ -288,16 +537,17 @@ class Loader(object):
             max_rt = current_ms1.rt + rt_tol
 
             # find things inside this region
-            hits = filter(lambda x: x.mz > min_mz and x.mz < max_mz and x.rt > min_rt and x.rt < max_rt,ms1_by_intensity)
-            for hit in hits:
-                pos = ms1_by_intensity.index(hit)
-                del ms1_by_intensity[pos]
+            removed[ms1_index.window(min_mz,max_mz,min_rt,max_rt,inclusive = False)] = True
 
 
         print "{} MS1 remaining".format(len(final_ms1_list))
-        for m in ms2:
-            if m[3] in final_ms1_list:
-                final_ms2_list.append(m)
+        final_ms1_set = set(final_ms1_list)
+        if isinstance(ms2,MS2Columns):
+            final_ms2_list = ms2.filter_parents(final_ms1_set)
+        else:
+            for m in ms2:
+                if m[3] in final_ms1_set:
+                    final_ms2_list.append(m)
 
         print "{} MS2 remaining".format(len(final_ms2_list))
         return final_ms1_list,final_ms2_list
@@ -461,18 +711,17 @@ class LoadCSV(Loader):
 class LoadMZML(Loader):
     def __str__(self):
         return "mzML loader"
-    def load_spectra(self,input_set):
+
+    # Parses the mzML files one spectrum at a time and yields (ms1,metadata,mz,intensity) for each
+    # precursor once all of its peaks (from all of its collision energies) have been seen, so
+    # memory use doesn't grow with the files
+    def iter_spectra(self,input_set):
         import pymzml
         import bisect
 
-        ms1 = []
-        ms2 = []
-        metadata = {}
         nc = 0
-        ms2_id = 0
         ms1_id = 0
 
-
         for input_file in input_set:
             print "Loading spectra from {}".format(input_file)
             current_ms1_scan_mz = None
@@ -484,6 +733,8 @@ class LoadMZML(Loader):
             file_name = input_file.split('/')[-1]
             previous_precursor_mz = -10
             previous_ms1 = None
+            # (ms1,metadata,mz list,intensity list) of the precursor whose peaks are being collected
+            current = None
 
             for spectrum in run:
                 if spectrum['ms level'] == 1:
@@ -502,6 +753,9 @@ class LoadMZML(Loader):
 
                     previous_precursor_mz = -10
                     previous_ms1 = None
+                    if current:
+                        yield current
+                        current = None
                 elif spectrum['ms level'] == 2:
                     # Check that we have an MS1 scan to refer to. If not, skip this one
                     # this can happen if we have blank MS1 scans. We should never get an MS2 scan after a blank MS1
@@ -512,12 +766,12 @@ class LoadMZML(Loader):
                         precursor_mz = spectrum['precursors'][0]['mz']
                         if abs(precursor_mz-previous_precursor_mz) < self.repeated_precursor_match:
                             # Another collision energy perhaps??
-                            # if this is the case, we don't bother looking for a parent, but add to the previous one
+                            # if this is the case, we don't bother looking for a parent, but add to the previous one
                             # Make the ms2 objects:
                             if previous_ms1:
                                 for mz,intensity in spectrum.centroidedPeaks:
-                                    ms2.append((mz,current_ms1_scan_rt,intensity,previous_ms1,file_name,float(ms2_id)))
-                                    ms2_id += 1
+                                    current[2].append(mz)
+                                    current[3].append(intensity)
                             else:
                                 pass
                         else:
@@ -554,31 +808,58 @@ class LoadMZML(Loader):
                                 new_ms1 = MS1(ms1_id,current_ms1_scan_mz[max_intensity_pos],
                                               current_ms1_scan_rt,max_intensity,file_name,scan_number = nc)
 
-
-                                # ms1.append(new_ms1)
-                                # ms1_id += 1
-
                                 # Make the ms2 objects:
-                                n_found = 0
+                                mz_list = []
+                                intensity_list = []
                                 for mz,intensity in spectrum.centroidedPeaks:
                                     if intensity > self.min_ms2_intensity:
-                                        ms2.append((mz,current_ms1_scan_rt,intensity,new_ms1,file_name,float(ms2_id)))
-                                        ms2_id += 1
-                                        n_found += 1
-                                if n_found > 0:
-                                    ms1.append(new_ms1)
+                                        mz_list.append(mz)
+                                        intensity_list.append(intensity)
+                                if len(mz_list) > 0:
+                                    if current:
+                                        yield current
                                     ms1_id += 1
-                                    metadata[new_ms1.name] = {'parentmass':current_ms1_scan_mz[max_intensity_pos],
-                                                              'parentrt':current_ms1_scan_rt,'scan_number':nc,
-                                                              'precursor_mass':precursor_mz}
-
+                                    new_metadata = {'parentmass':current_ms1_scan_mz[max_intensity_pos],
+                                                    'parentrt':current_ms1_scan_rt,'scan_number':nc,
+                                                    'precursor_mass':precursor_mz}
+                                    current = (new_ms1,new_metadata,mz_list,intensity_list)
 
                                     previous_ms1 = new_ms1 # used for merging energies
                                     previous_precursor_mz = new_ms1.mz
+            if current:
+                yield current
+
+    parallel_files = True
+
+    # With columnar = True the ms2 peaks are returned as an MS2Columns object rather than a list of tuples
+    def load_spectra(self,input_set,columnar = False):
+        ms1,ms2,metadata = self._parse_files(input_set,columnar = columnar)
+        return self._filter_spectra(ms1,ms2,metadata)
+
+    def _parse_files(self,input_set,columnar = False):
+        ms1 = []
+        if columnar:
+            ms2 = MS2Columns()
+        else:
+            ms2 = []
+        metadata = {}
+        ms2_id = 0
 
+        for new_ms1,new_metadata,mz_list,intensity_list in self.iter_spectra(input_set):
+            ms1.append(new_ms1)
+            metadata[new_ms1.name] = new_metadata
+            n_peaks = len(mz_list)
+            if columnar:
+                ms2.add_spectrum(new_ms1,mz_list,intensity_list,np.arange(ms2_id,ms2_id + n_peaks))
+            else:
+                for mz,intensity,peak_id in zip(mz_list,intensity_list,range(ms2_id,ms2_id + n_peaks)):
+                    ms2.append((mz,new_ms1.rt,intensity,new_ms1,new_ms1.file_name,float(peak_id)))
+            ms2_id += n_peaks
 
         print "Found {} ms2 spectra, and {} individual ms2 objects".format(len(ms1),len(ms2))
+        return ms1,ms2,metadata
 
+    def _filter_spectra(self,ms1,ms2,metadata):
         # if self.min_ms1_intensity>0.0:
         #     ms1,ms2 = filter_ms1_intensity(ms1,ms2,min_ms1_intensity = self.min_ms1_intensity)
 
@@ -1167,7 +1448,18 @@ class LoadMGF(Loader):
     def __str__(self):
         return "mgf loader"
 
+    parallel_files = True
+
     def load_spectra(self,input_set):
+        ms1,ms2,metadata = self._parse_files(input_set)
+        return self._filter_spectra(ms1,ms2,metadata)
+
+    # the document names are made from the ms1 ids
+    def _renumber_ms1(self,ms1,offset):
+        ms1.id += offset
+        ms1.name = 'document_{}'.format(ms1.id + 1)
+
+    def _parse_files(self,input_set):
         ms1 = []
         ms2 = []
         metadata = {}
@@ -1255,6 +1547,9 @@ class LoadMGF(Loader):
                                     ms2.append((mz,0.0,intensity,new_ms1,file_name,float(ms2_id)))
                                     ms2_id += 1
 
+        return ms1,ms2,metadata
+
+    def _filter_spectra(self,ms1,ms2,metadata):
         # add ms1, ms2 intensity filtering for msp input
         if self.min_ms1_intensity > 0.0:
             ms1,ms2 = self.filter_ms1_intensity(ms1,ms2,min_ms1_intensity = self.min_ms1_intensity)
@@ -1338,127 +1633,141 @@ class MakeBinnedFeatures(MakeFeatures):
         self.bin_width = bin_width
         self.min_intensity_perc = min_intensity_perc
 
+    # The fragment and loss bins of every peak are found with searchsorted on the bin edges
+    # and the intensities are summed per (document,bin) in a sparse matrix, so names are
+    # only made for the bins that are used.
+    # ms2 can be a list of ms2 tuples or an MS2Columns object
     def make_features(self,ms2):
         self.word_mz_range = {}
         self.word_counts = {}
-        self.fragment_words = []
-        self.loss_words = []
         self.corpus = {}
 
-        self._make_words(self.min_loss,self.max_loss,self.loss_words,'loss')
-        self._make_words(self.min_frag,self.max_frag,self.fragment_words,'fragment')
+        frag_lower,frag_upper = self._make_bins(self.min_frag,self.max_frag)
+        loss_lower,loss_upper = self._make_bins(self.min_loss,self.max_loss)
+        n_frag = len(frag_lower)
+        n_bins = n_frag + len(loss_lower)
 
-        for word in self.fragment_words:
-            self.word_counts[word] = 0
-        for word in self.loss_words:
-            self.word_counts[word] = 0
+        mz,intensity,parent_mz,peak_rows,doc_keys = self._peak_arrays(ms2)
 
+        # peaks whose parent has no mz have nan parent_mz so never make losses
+        with np.errstate(invalid = 'ignore'):
+            loss_mz = parent_mz - mz
+            use_peak = intensity >= self.min_intensity
+            is_frag = use_peak & (mz > self.min_frag) & (mz < self.max_frag)
+            is_loss = use_peak & (loss_mz > self.min_loss) & (loss_mz < self.max_loss)
 
-        # make a list of the lower edges
-        frag_lower = [self.word_mz_range[word][0] for word in self.fragment_words]
-        loss_lower = [self.word_mz_range[word][0] for word in self.loss_words]
-
-        import bisect
-
-
-        for peak in ms2:
-
-            # MS2 objects are ((mz,rt,intensity,parent,file_name,id))
-            # TODO: make the search more efficients
-            mz = peak[0]
-            if peak[3].mz == None:
-                # There isnt a precursor mz so we cant do losses
-                do_losses = False
-                loss_mz = 0.0
-            else:
-                do_losses = True
-                loss_mz = peak[3].mz - mz
-            intensity = peak[2]
-            if intensity >= self.min_intensity:
-                doc_name = peak[3].name
-                file_name = peak[4]
-                if mz > self.min_frag and mz < self.max_frag:
-                    pos = bisect.bisect_right(frag_lower,mz)
-                    word = self.fragment_words[pos-1]
-                    if not file_name in self.corpus:
-                        self.corpus[file_name] = {}
-                    if not doc_name in self.corpus[file_name]:
-                        self.corpus[file_name][doc_name] = {}
-                    if not word in self.corpus[file_name][doc_name]:
-                        self.corpus[file_name][doc_name][word] = 0.0
-                        self.word_counts[word] += 1
-                    self.corpus[file_name][doc_name][word] += intensity
-
-                if do_losses and loss_mz > self.min_loss and loss_mz < self.max_loss:
-                    pos = bisect.bisect_right(loss_lower,loss_mz)
-                    word = self.loss_words[pos-1]
-                    if not file_name in self.corpus:
-                        self.corpus[file_name] = {}
-                    if not doc_name in self.corpus[file_name]:
-                        self.corpus[file_name][doc_name] = {}
-                    if not word in self.corpus[file_name][doc_name]:
-                        self.corpus[file_name][doc_name][word] = 0.0
-                        self.word_counts[word] += 1
-                    self.corpus[file_name][doc_name][word] += intensity
+        frag_bins = self._bin_index(frag_lower,mz[is_frag])
+        loss_bins = self._bin_index(loss_lower,loss_mz[is_loss]) + n_frag
 
+        counts = sp.coo_matrix((np.concatenate((intensity[is_frag],intensity[is_loss])),
+                                (np.concatenate((peak_rows[is_frag],peak_rows[is_loss])),np.concatenate((frag_bins,loss_bins)))),
+                               shape = (len(doc_keys),n_bins)).tocsr()
+        counts.sum_duplicates()
+        counts = counts.tocoo()
+        rows,cols,data = counts.row,counts.col,counts.data
 
-        # TODO: Test code to remove blank words!!!!!
-        to_remove = []
-        for word in self.word_mz_range:
-            if self.word_counts[word] == 0:
-                to_remove.append(word)
-
-        for word in to_remove:
-            del self.word_mz_range[word]
-
-        n_docs = 0
-        for c in self.corpus:
-            n_docs += len(self.corpus[c])
-
+        n_docs = len(np.unique(rows))
         print "{} documents".format(n_docs)
-        print "After removing empty words, {} words left".format(len(self.word_mz_range))
+        print "After removing empty words, {} words left".format(len(np.unique(cols)))
 
         if self.min_intensity_perc > 0:
             # Remove words that are smaller than a certain percentage of the highest feature
-            for c in self.corpus:
-                for doc in self.corpus[c]:
-                    max_intensity = 0.0
-                    for word in self.corpus[c][doc]:
-                        intensity = self.corpus[c][doc][word]
-                        if intensity > max_intensity:
-                            max_intensity = intensity
-                    to_remove = []
-                    for word in self.corpus[c][doc]:
-                        intensity = self.corpus[c][doc][word]
-                        if intensity < max_intensity * self.min_intensity_perc:
-                            to_remove.append(word)
-                    for word in to_remove:
-                        del self.corpus[c][doc][word]
-                        self.word_counts[word] -= 1
-            # Remove any words that are now empty
-            to_remove = []
-            for word in self.word_mz_range:
-                if self.word_counts[word] == 0:
-                    to_remove.append(word)
-            for word in to_remove:
-                del self.word_mz_range[word]
-            print "After applying min_intensity_perc filter, {} words left".format(len(self.word_mz_range))
-
+            max_intensity = np.zeros(len(doc_keys),np.float)
+            np.maximum.at(max_intensity,rows,data)
+            keep = data >= max_intensity[rows] * self.min_intensity_perc
+            rows,cols,data = rows[keep],cols[keep],data[keep]
+            print "After applying min_intensity_perc filter, {} words left".format(len(np.unique(cols)))
+
+        word_counts = np.bincount(cols,minlength = n_bins)
+        words = np.empty(n_bins,object)
+        for col in np.where(word_counts > 0)[0].tolist():
+            if col < n_frag:
+                word = self._make_word('fragment',frag_lower[col],frag_upper[col])
+            else:
+                word = self._make_word('loss',loss_lower[col - n_frag],loss_upper[col - n_frag])
+            words[col] = word
+            self.word_counts[word] = int(word_counts[col])
+
+        # the entries are sorted by row, so each document is a slice
+        row_ends = np.cumsum(np.bincount(rows,minlength = len(doc_keys))).tolist()
+        entry_words = words[cols].tolist()
+        entry_values = data.tolist()
+        row_start = 0
+        for row,row_end in enumerate(row_ends):
+            if row_end > row_start:
+                file_name,doc_name = doc_keys[row]
+                if not file_name in self.corpus:
+                    self.corpus[file_name] = {}
+                self.corpus[file_name][doc_name] = dict(zip(entry_words[row_start:row_end],entry_values[row_start:row_end]))
+            row_start = row_end
 
         return self.corpus,self.word_mz_range
 
-    def _make_words(self,min_mz,max_mz,word_list,prefix):
-        # Bin the ranges to make the words
+    # Returns the mz, intensity and parent mz (nan if the parent has no mz) of every peak
+    # as arrays, the row of each peak's document, and the (file_name,doc_name) of each row
+    def _peak_arrays(self,ms2):
+        doc_rows = {}
+        doc_keys = []
+        if isinstance(ms2,MS2Columns):
+            parent_rows = []
+            for parent in ms2.parents:
+                key = (parent.file_name,parent.name)
+                if not key in doc_rows:
+                    doc_rows[key] = len(doc_keys)
+                    doc_keys.append(key)
+                parent_rows.append(doc_rows[key])
+            peak_rows = np.array(parent_rows,np.int)[ms2.parent_index]
+            return ms2.mz,ms2.intensity,ms2.parent_mz,peak_rows,doc_keys
+
+        n_peaks = len(ms2)
+        mz = np.zeros(n_peaks,np.float)
+        intensity = np.zeros(n_peaks,np.float)
+        parent_mz = np.zeros(n_peaks,np.float)
+        peak_rows = np.zeros(n_peaks,np.int)
+        for i,peak in enumerate(ms2):
+            # MS2 objects are ((mz,rt,intensity,parent,file_name,id))
+            mz[i] = peak[0]
+            intensity[i] = peak[2]
+            parent_mz[i] = np.nan if peak[3].mz is None else peak[3].mz
+            key = (peak[4],peak[3].name)
+            if not key in doc_rows:
+                doc_rows[key] = len(doc_keys)
+                doc_keys.append(key)
+            peak_rows[i] = doc_rows[key]
+        return mz,intensity,parent_mz,peak_rows,doc_keys
+
+    # Lower and upper edges of the bins between min_mz and max_mz
+    def _make_bins(self,min_mz,max_mz):
+        lower = []
+        upper = []
         min_word = float(min_mz)
         max_word = min_word + self.bin_width
         while min_word < max_mz:
-            up_edge = min(max_mz,max_word)
-            word_mean = 0.5*(min_word + up_edge)
-            new_word = '{}_{:.4f}'.format(prefix,word_mean) # 4dp
-            word_list.append(new_word)
-            self.word_mz_range[new_word] = (min_word,up_edge)
+            lower.append(min_word)
+            upper.append(min(max_mz,max_word))
             min_word += self.bin_width
             max_word += self.bin_width
+        return np.array(lower,np.float),np.array(upper,np.float)
+
+    # Index of the bin (lower edges in lower) of each of the values
+    # The edges are accumulated in floating point (as the words always have been) so
+    # (value - min_mz) / bin_width can be one bin out, which is corrected from the edges
+    def _bin_index(self,lower,values):
+        last = len(lower) - 1
+        bins = np.floor((values - lower[0]) / self.bin_width).astype(np.int)
+        bins = np.clip(bins,0,last)
+        bins -= lower[bins] > values
+        bins += (bins < last) & (lower[np.minimum(bins + 1,last)] <= values)
+        return bins
+
+    # Makes the word for the bin (min_word,up_edge) and adds it to word_mz_range
+    def _make_word(self,prefix,min_word,up_edge):
+        min_word = float(min_word)
+        up_edge = float(up_edge)
+        word_mean = 0.5*(min_word + up_edge)
+        new_word = '{}_{:.4f}'.format(prefix,word_mean) # 4dp
+        self.word_mz_range[new_word] = (min_word,up_edge)
+        return new_word
 
 
 
@@ -1610,30 +1919,41 @@ class MakeKDEFeatures(MakeFeatures):
         print "Finished fragments, total words now: {}".format(len(self.word_counts))
 
 
+    # The kde is evaluated for blocks of about kde_block_size (mass,neighbour) pairs at a time
+    kde_block_size = 1000000
+
+    # kde of the (sorted) masses: every mass adds a gaussian (sd of ppm/3) at each of the masses
+    # within stop_thresh sds of it, and at the first mass beyond that on either side.
+    # The windows are found with searchsorted and the gaussians evaluated in blocks
     def _make_kde(self,mass_array,ppm,stop_thresh):
-        kde = np.zeros_like(mass_array)
-        n_losses = len(mass_array)
-        for i in range(n_losses):
-            if i % 1000 == 0:
-                print "Done kde for {} of {}".format(i,n_losses)
-            this_mass = mass_array[i]
-            ss = ((ppm*(this_mass/1e6))/3.0)**2
-            finished = False
-            pos = i-1
-            while (not finished) and (pos >= 0):
-                de = self.gauss_pdf(mass_array[pos],this_mass,ss)
-                kde[pos] += de
-                if this_mass - mass_array[pos] > stop_thresh*np.sqrt(ss):
-                    finished = True
-                pos -= 1
-            finished = False
-            pos = i
-            while (not finished) and (pos < len(mass_array)):
-                de = self.gauss_pdf(mass_array[pos],this_mass,ss)
-                kde[pos] += de
-                if mass_array[pos] - this_mass > stop_thresh*np.sqrt(ss):
-                    finished = True
-                pos += 1
+        n_masses = len(mass_array)
+        kde = np.zeros(n_masses,np.float)
+        if n_masses == 0:
+            print "Made kde"
+            return kde
+        ss = ((ppm*(mass_array/1e6))/3.0)**2
+        width = stop_thresh*np.sqrt(ss)
+        starts = np.maximum(np.searchsorted(mass_array,mass_array - width,side = 'left') - 1,0)
+        ends = np.minimum(np.searchsorted(mass_array,mass_array + width,side = 'right'),n_masses - 1) + 1
+        lengths = ends - starts
+        cum_lengths = np.cumsum(lengths)
+
+        block_start = 0
+        while block_start < n_masses:
+            done = cum_lengths[block_start - 1] if block_start > 0 else 0
+            block_end = max(block_start + 1,np.searchsorted(cum_lengths,done + self.kde_block_size,side = 'right'))
+            block_lengths = lengths[block_start:block_end]
+            block_starts = starts[block_start:block_end]
+            sources = np.repeat(np.arange(block_start,block_end),block_lengths)
+            offsets = np.repeat(cum_lengths[block_start:block_end] - block_lengths - done - block_starts,block_lengths)
+            positions = np.arange(len(sources)) - offsets
+            de = self.gauss_pdf(mass_array[positions],mass_array[sources],ss[sources])
+            # starts (and so positions) don't decrease, so only the block's slice of kde is updated
+            first = block_starts[0]
+            block_kde = np.bincount(positions - first,weights = de)
+            kde[first:first + len(block_kde)] += block_kde
+            print "Done kde for {} of {}".format(block_end,n_masses)
+            block_start = block_end
         print "Made kde"
         return kde
 
@@ -1641,122 +1961,90 @@ class MakeKDEFeatures(MakeFeatures):
     def gauss_pdf(self,x,m,ss):
         return (1.0/np.sqrt(2*np.pi*ss))*np.exp(-0.5*((x-m)**2)/ss)
 
+    # Groups the masses into the peaks of the kde. The peaks are found in a single pass over
+    # the masses in order of decreasing kde (the same order as repeatedly taking the argmax
+    # of what's left), stopping at the first mass whose kde is below 0.8 of a single gaussian
     def _process_kde(self,kde,masses,ppm):
-
-        kde_copy = kde.copy()
-        groups = np.zeros_like(kde) - 1
-
-        max_width = 50 # ppm
+        groups = np.zeros(len(kde),np.int) - 1
         group_list = []
         current_group = 0
-        # group_formulas = []
-        # group_mz = []
-        verbose = False
-        while True:
-            biggest_pos = kde_copy.argmax()
-            peak_values = [biggest_pos]
-            this_mass = masses[biggest_pos]
-            ss = ((ppm*(this_mass/1e6))/3.0)**2
-            min_val = 1.0/(np.sqrt(2*np.pi*ss))
 
-            pos = biggest_pos
-            intensity = kde_copy[biggest_pos]
+        kde_list = kde.tolist()
+        mass_list = masses.tolist()
+        group_values = groups.tolist()
+        ss = ((ppm*(masses/1e6))/3.0)**2
+        min_vals = (1.0/(np.sqrt(2*np.pi*ss))).tolist()
+
+        # mergesort so that ties are taken in position order, as argmax did
+        for biggest_pos in np.argsort(-kde,kind = 'mergesort').tolist():
+            if group_values[biggest_pos] > -1:
+                continue
+            intensity = kde_list[biggest_pos]
+            min_val = min_vals[biggest_pos]
             if intensity < 0.8*min_val:
                 break # finished
-            finished = False
-            lowest_intensity = intensity
-            lowest_index = biggest_pos
 
+            peak_values = [biggest_pos]
             if intensity > min_val:
-                # Checks that it's not a singleton
-                if pos > 0:
-                    # Check that it's not the last one
-                    while not finished:
-                        pos -= 1
-                        # Decide if this one should be part of the peak or not
-                        if kde[pos] > lowest_intensity + 0.01*intensity or kde[pos] <= 1.001*min_val:
-                            # It shouldn't
-                            finished = True
-                        elif groups[pos] > -1:
-                            # We've hit another group!
-                            finished = True
-                        elif 1e6*abs(masses[pos] - this_mass)/this_mass > max_width:
-                            # Gone too far
-                            finished = True
-                        else:
-                            # it should
-                            peak_values.append(pos)
-                        # If it's the last one, we're finished
-                        if pos == 0:
-                            finished = True
-
-                        # If it's the lowest we've seen so far remember that
-                        if kde[pos] < lowest_intensity:
-                            lowest_intensity = kde[pos]
-                            lowest_index = pos
-
-
-                pos = biggest_pos
-                finished = False
-                lowest_intensity = intensity
-                lowest_index = biggest_pos
-                if pos < len(kde)-1:
-                    while not finished:
-                        # Move to the right
-                        pos += 1
-                        if verbose:
-                            print pos
-                        # check if this one should be in the peak
-                        if kde[pos] > lowest_intensity + 0.01*intensity or kde[pos] <= 1.001*min_val:
-                            # it shouldn't
-                            finished = True
-                        elif groups[pos] > -1:
-                            # We've hit another group!
-                            finished = True
-                        elif 1e6*abs(masses[pos] - this_mass)/this_mass > max_width:
-                            # Gone too far
-                            finished = True
-                        else:
-                            peak_values.append(pos)
+                # not a singleton
+                peak_values += self._walk_peak(kde_list,mass_list,group_values,biggest_pos,-1,min_val)
+                peak_values += self._walk_peak(kde_list,mass_list,group_values,biggest_pos,1,min_val)
 
-                        # If it's the last value, we're finished
-                        if pos == len(kde)-1:
-                            finished = True
+            for pos in peak_values:
+                group_values[pos] = current_group
+            group_id = current_group
+            current_group += 1
+            group_mz = masses[biggest_pos]
 
-                        # If it's the lowest we've seen, remember that
-                        if kde[pos] < lowest_intensity:
-                            lowest_intensity = kde[pos]
-                            lowest_index = pos
+            # Find formulas
+            hit_string = None
 
-            else:
-                # Singleton peak
-                peak_values = [biggest_pos]
+            new_group = (group_id,group_mz,hit_string,biggest_pos)
 
-            if len(peak_values) > 0:
-                kde_copy[peak_values] = 0.0
-                groups[peak_values] = current_group
-                group_id = current_group
-                current_group += 1
-                group_mz = masses[biggest_pos]
-
-                # Find formulas
-                hit_string = None
-
-                new_group = (group_id,group_mz,hit_string,biggest_pos)
-
-                group_list.append(new_group)
-                if current_group % 100 == 0:
-                    print "Found {} groups".format(current_group)
+            group_list.append(new_group)
+            if current_group % 100 == 0:
+                print "Found {} groups".format(current_group)
 
+        groups[:] = group_values
         return groups,group_list
 
+    # The positions that join the peak at biggest_pos walking to the left (step = -1) or
+    # the right (step = 1). The walk stops when the kde starts to rise again, falls to the
+    # level of a single mass, hits another group, or goes more than max_width ppm from the peak
+    def _walk_peak(self,kde,masses,groups,biggest_pos,step,min_val,max_width = 50):
+        intensity = kde[biggest_pos]
+        this_mass = masses[biggest_pos]
+        lowest_intensity = intensity
+        peak_values = []
+        pos = biggest_pos + step
+        while pos >= 0 and pos < len(kde):
+            if kde[pos] > lowest_intensity + 0.01*intensity or kde[pos] <= 1.001*min_val:
+                break
+            elif groups[pos] > -1:
+                # We've hit another group!
+                break
+            elif 1e6*abs(masses[pos] - this_mass)/this_mass > max_width:
+                # Gone too far
+                break
+            peak_values.append(pos)
+            if kde[pos] < lowest_intensity:
+                lowest_intensity = kde[pos]
+            pos += step
+        return peak_values
+
     def _update_corpus(self,masses,kde,meta,groups,group_list,prefix):
+        # the positions of each group, from one sort of the groups
+        order = np.argsort(groups,kind = 'mergesort')
+        sorted_groups = groups[order]
+        group_ids = [group[0] for group in group_list]
+        group_starts = np.searchsorted(sorted_groups,group_ids,side = 'left')
+        group_ends = np.searchsorted(sorted_groups,group_ids,side = 'right')
         # Loop over the groups
-        for group in group_list:
+        for group,group_start,group_end in zip(group_list,group_starts,group_ends):
             group_id = group[0]
             group_mz = group[1]
             group_formula = group[2]
-            pos = np.where(groups == group_id)[0]
+            pos = order[group_start:group_end]
             min_mz = 100000.0
             max_mz = 0.0
             if len(pos) > 0:
@@ -1922,15 +2210,27 @@ def corpusToMatrix(corpus,word_list,just_fragments = True):
     return mat,doc_index,word_index
 
 
+# Used by Loader.load_spectra_parallel to parse one file in a worker process
+def _parse_file(args):
+    loader,input_file,kwargs = args
+    start_time = time.time()
+    ms1,ms2,metadata = loader._parse_files([input_file],**kwargs)
+    return ms1,ms2,metadata,time.time() - start_time
+
+
+# With n_processes > 1 the files are loaded in parallel (if the loader supports it)
 class MS2LDAFeatureExtractor(object):
-    def __init__(self,input_set,loader,feature_maker):
+    def __init__(self,input_set,loader,feature_maker,n_processes = 1):
         self.input_set = input_set
         self.loader = loader
         print self.loader
         self.feature_maker = feature_maker
         print self.feature_maker
         print "Loading spectra"
-        self.ms1,self.ms2,self.metadata = self.loader.load_spectra(self.input_set)
+        if n_processes > 1 and len(self.input_set) > 1:
+            self.ms1,self.ms2,self.metadata = self.loader.load_spectra_parallel(self.input_set,n_processes = n_processes)
+        else:
+            self.ms1,self.ms2,self.metadata = self.loader.load_spectra(self.input_set)
         print "Creating corpus"
         self.corpus,self.word_mz_range = self.feature_maker.make_features(self.ms2)
 
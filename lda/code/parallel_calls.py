@@ -1,27 +1,47 @@
+import traceback
+
 import numpy as np
-from scipy.special import psi as psi
 
-# doesn't work ????
-# def par_e_step(lda):
-# 	beta = lda.e_step()
-# 	return beta
+# Attributes of an individual lda that the worker hands back to the parent at the end of a run
+LDA_STATE_ATTRIBUTES = ['gamma_matrix','alpha','phi_matrix','phi_array','phi_log_beta','phi_psi_gamma']
 
-def par_e_step(parameters):
- 
-	corpus, K, n_words, doc_index, alpha, word_index, phi_matrix, beta_matrix, gamma_matrix = parameters
-	temp_beta = np.zeros((K, n_words))
-	new_gamma_matrix = np.zeros_like(gamma_matrix)
-	for doc in corpus:
-		# print doc
-		d = doc_index[doc]
-		temp_gamma = np.zeros(K) + alpha
-		for word in corpus[doc]:
-			w = word_index[word]
-			phi_matrix[doc][word] = beta_matrix[:,w]*np.exp(psi(gamma_matrix[d,:])).T
-			phi_matrix[doc][word] /= phi_matrix[doc][word].sum()
-			temp_gamma += phi_matrix[doc][word]*corpus[doc][word]
-			temp_beta[:,w] += phi_matrix[doc][word] * corpus[doc][word]
- 
-		new_gamma_matrix[d,:] = temp_gamma
- 
-	return temp_beta, phi_matrix, new_gamma_matrix
\ No newline at end of file
+# Persistent worker used by MultiFileVariationalLDA.run_vb(parallel=True)
+# The worker owns the individual lda objects in ldas (a dict name -> VariationalLDA) for the whole run.
+# beta (K x n_words) is read from the shared array shared_beta and the summed e-step
+# statistics for all of the worker's ldas are written to its own shared array shared_stats,
+# so the only things sent through conn are the commands and the updated alphas:
+#  ('step',use_shared_beta) -> run an e-step and alpha update on every lda, replies with {name: alpha}
+#  ('state',attributes)     -> replies with {name: {attribute: value}} for the listed attributes
+#  ('stop',)                -> exits
+# Any exception is sent back as ('error',traceback string)
+def lda_worker(conn,ldas,shared_beta,shared_stats,K,n_words):
+	beta = np.frombuffer(shared_beta).reshape(K,n_words)
+	stats = np.frombuffer(shared_stats).reshape(K,n_words)
+	while True:
+		command = conn.recv()
+		try:
+			if command[0] == 'step':
+				stats[:] = 0.0
+				alphas = {}
+				for lda_name in ldas:
+					lda = ldas[lda_name]
+					if command[1]:
+						lda.beta_matrix = beta
+					stats += lda.e_step()
+					if lda.update_alpha:
+						lda.alpha = lda.alpha_nr()
+					alphas[lda_name] = lda.alpha
+				conn.send(alphas)
+			elif command[0] == 'state':
+				state = {}
+				for lda_name in ldas:
+					state[lda_name] = {}
+					for attribute in command[1]:
+						if hasattr(ldas[lda_name],attribute):
+							state[lda_name][attribute] = getattr(ldas[lda_name],attribute)
+				conn.send(state)
+			elif command[0] == 'stop':
+				break
+		except:
+			conn.send(('error',traceback.format_exc()))
+	conn.close()
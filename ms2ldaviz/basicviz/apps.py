@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class BasicvizConfig(AppConfig):
+    name = 'basicviz'
+
+    # Connects the receivers that keep the stored multi-file matrices and graphs up to date,
+    # also in processes that don't import the views (e.g. the scripts)
+    def ready(self):
+        import basicviz.multifile_matrices
+        import basicviz.graph_cache
@@ -0,0 +1,67 @@
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from basicviz.models import Mass2Motif, SystemOptions
+from decomposition.models import Decomposition
+from options.cache import bump_generation
+
+# Cache of the node-link JSON of the network views (get_graph in basicviz and decomposition),
+# keyed on the VizOptions id plus anything else the graph depends on (show_ms1, the decomposition).
+# The keys include a generation for the experiment and a global one: saving or deleting one of
+# the experiment's motifs (e.g. a new annotation) or options (e.g. the thresholds) moves the
+# experiment to a new generation, and a global option change moves everything to a new generation.
+# Documents are saved and deleted a whole experiment at a time, so rather than a receiver for
+# every document the code that writes them (load_dict, save_documents, the decomposition results,
+# the document views) calls invalidate_graphs once. Anything else (e.g. new MS1 analysis results
+# or documents changed by the scripts) is picked up when the entries expire after
+# GRAPH_CACHE_TIMEOUT seconds.
+# The generations are kept in the shared cache (see CACHES in settings.py), so a change in one
+# process (e.g. a decomposition in a celery worker) reaches all of them.
+GRAPH_CACHE_TIMEOUT = 3600
+GLOBAL_GENERATION_KEY = 'graph:generation'
+
+
+def _generation_key(experiment_id):
+    return 'graph:generation:{}'.format(experiment_id)
+
+
+def _graph_key(viz_options, extra):
+    generations = cache.get_many([GLOBAL_GENERATION_KEY, _generation_key(viz_options.experiment_id)])
+    return 'graph:{}:{}:{}:{}'.format(generations.get(GLOBAL_GENERATION_KEY, 0),
+                                      generations.get(_generation_key(viz_options.experiment_id), 0),
+                                      viz_options.id, ':'.join(str(e) for e in extra))
+
+
+def get_cached_graph(viz_options, *extra):
+    return cache.get(_graph_key(viz_options, extra))
+
+
+def set_cached_graph(viz_options, graph_json, *extra):
+    cache.set(_graph_key(viz_options, extra), graph_json, GRAPH_CACHE_TIMEOUT)
+
+
+def invalidate_graphs(experiment_id=None):
+    bump_generation(GLOBAL_GENERATION_KEY if experiment_id is None else _generation_key(experiment_id))
+
+
+@receiver(post_save, sender=SystemOptions)
+@receiver(post_delete, sender=SystemOptions)
+def graph_changed(sender, instance, **kwargs):
+    invalidate_graphs(instance.experiment_id)
+
+
+# A motif's annotation is also shown by the motifs linked to it and, through their global motifs,
+# in the graphs of the decompositions with it in their motif set
+@receiver(post_save, sender=Mass2Motif)
+@receiver(post_delete, sender=Mass2Motif)
+def motif_changed(sender, instance, **kwargs):
+    motif_ids = [instance.id]
+    experiment_ids = set([instance.experiment_id])
+    for motif_id, experiment_id in Mass2Motif.objects.filter(linkmotif=instance).values_list('id', 'experiment_id'):
+        motif_ids.append(motif_id)
+        experiment_ids.add(experiment_id)
+    decompositions = Decomposition.objects.filter(motifset__globalmotifstosets__motif__originalmotif_id__in=motif_ids)
+    experiment_ids.update(decompositions.values_list('experiment_id', flat=True))
+    for experiment_id in experiment_ids:
+        invalidate_graphs(experiment_id)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 16:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('basicviz', '0070_experiment_featureset'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='multifileexperiment',
+            name='alpha_matrix',
+        ),
+        migrations.RemoveField(
+            model_name='multifileexperiment',
+            name='degree_matrix',
+        ),
+        migrations.AddField(
+            model_name='multilink',
+            name='alphas',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='multilink',
+            name='degrees',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 16:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('basicviz', '0071_multilink_matrices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alphacorroptions',
+            name='graph',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 17:12
+from __future__ import unicode_literals
+
+import jsonpickle
+from django.db import migrations, models
+
+
+def float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Fills the new columns from the metadata of the existing documents (as Document.set_metadata_columns)
+def set_metadata_columns(apps, schema_editor):
+    Document = apps.get_model('basicviz', 'Document')
+    documents = Document.objects.exclude(metadata__isnull=True).exclude(metadata='')
+    for document_id, metadata in documents.values_list('id', 'metadata').iterator():
+        md = jsonpickle.decode(metadata)
+        mass = md.get('parentmass', md.get('mz'))
+        annotation = md.get('annotation')
+        columns = {
+            'parent_mass': float_or_none(mass),
+            'parent_rt': float_or_none(md.get('rt', md.get('parentrt'))),
+            'annotation_text': annotation[:2048] if isinstance(annotation, basestring) else None,
+        }
+        if any(value is not None for value in columns.values()):
+            Document.objects.filter(id=document_id).update(**columns)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('basicviz', '0072_alphacorroptions_graph'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='annotation_text',
+            field=models.CharField(db_index=True, max_length=2048, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='parent_mass',
+            field=models.FloatField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='parent_rt',
+            field=models.FloatField(db_index=True, null=True),
+        ),
+        migrations.RunPython(set_metadata_columns, migrations.RunPython.noop),
+    ]
@@ -14,8 +14,6 @@ class MultiFileExperiment(models.Model):
     description = models.CharField(max_length=1024, null=True)
     status = models.CharField(max_length=128, null=True)
     pca = models.TextField(null=True)
-    alpha_matrix = models.TextField(null=True)
-    degree_matrix = models.TextField(null=True)
 
     def __unicode__(self):
         return self.name
@@ -112,6 +110,10 @@ class Experiment(models.Model):
 class MultiLink(models.Model):
     multifileexperiment = models.ForeignKey(MultiFileExperiment)
     experiment = models.ForeignKey(Experiment)
+    # the experiment's column of the multi-file alpha and degree matrices, as the
+    # bytes of numpy arrays (see basicviz/multifile_matrices.py)
+    alphas = models.BinaryField(null=True)
+    degrees = models.BinaryField(null=True)
 
 
 class ExtraUsers(models.Model):
@@ -124,34 +126,75 @@ class UserExperiment(models.Model):
     permission = models.CharField(max_length=24,null=False)
 
 
+# The metadata values that are copied to Document columns
+DOCUMENT_METADATA_COLUMNS = ['parent_mass', 'parent_rt', 'annotation_text']
+
+
+def float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
 class Document(models.Model):
     name = models.CharField(max_length=64)
     experiment = models.ForeignKey(Experiment)
     metadata = models.CharField(max_length=2048, null=True)
+    # Copies of the mass, rt (or parentrt) and annotation in the metadata, so documents can be
+    # filtered on them (e.g. a mass or rt range) in the database. save sets them from the
+    # metadata, code that bulk_creates documents has to call set_metadata_columns first
+    parent_mass = models.FloatField(null=True, db_index=True)
+    parent_rt = models.FloatField(null=True, db_index=True)
+    annotation_text = models.CharField(max_length=2048, null=True, db_index=True)
+
+    # The decoded metadata. It is only decoded again when metadata is changed
+    def get_metadata(self):
+        decoded = getattr(self, '_decoded_metadata', None)
+        if decoded is None or decoded[0] is not self.metadata:
+            md = jsonpickle.decode(self.metadata) if self.metadata else {}
+            decoded = (self.metadata, md)
+            self._decoded_metadata = decoded
+        return decoded[1]
+
+    def set_metadata_columns(self):
+        self.parent_mass = float_or_none(self.mass)
+        # the uploads and decompositions store the rt as 'parentrt'
+        md = self.get_metadata()
+        self.parent_rt = float_or_none(md.get('rt', md.get('parentrt')))
+        annotation = self.annotation
+        self.annotation_text = annotation[:2048] if isinstance(annotation, basestring) else None
+
+    def save(self, *args, **kwargs):
+        self.set_metadata_columns()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'metadata' in update_fields:
+            kwargs['update_fields'] = list(update_fields) + DOCUMENT_METADATA_COLUMNS
+        super(Document, self).save(*args, **kwargs)
 
     def get_annotation(self):
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'annotation' in md:
             return md['annotation']
         else:
             return None
 
     def get_inchi(self):
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'InChIKey' in md:
             return md['InChIKey']
         else:
             return None
 
     def get_csid(self):
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'csid' in md:
             return md['csid']
         else:
             return None
 
     def get_image_url(self):
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'csid' in md:
             # If this doc already has a csid, make the url
             return 'http://www.chemspider.com/ImagesHandler.ashx?id=' + str(self.csid)
@@ -176,7 +219,7 @@ class Document(models.Model):
 
 
     def get_mass(self):
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'parentmass' in md:
             return md['parentmass']
         elif 'mz' in md:
@@ -185,7 +228,7 @@ class Document(models.Model):
             return None
 
     def get_rt(self):
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'rt' in md:
             return md['rt']
         else:
@@ -193,7 +236,7 @@ class Document(models.Model):
 
     def get_display_name(self):
         display_name = self.name
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'common_name' in md:
             display_name = md['common_name']
         elif 'annotation' in md:
@@ -201,14 +244,14 @@ class Document(models.Model):
         return display_name
 
     def get_logfc(self):
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'logfc' in md:
             return md['logfc']
         else:
             return None
 
     def get_user_cols(self):
-        md = jsonpickle.decode(self.metadata)
+        md = self.get_metadata()
         if 'user_cols' in md:
             return md['user_cols']
         else:
@@ -352,6 +395,7 @@ class AlphaCorrOptions(models.Model):
     normalise_alphas = models.BooleanField(null=False)
     max_edges = models.IntegerField(null=False)
     just_annotated = models.BooleanField(null=False)
+    graph = models.TextField(null=True)
 
 
 class PeakSet(models.Model):
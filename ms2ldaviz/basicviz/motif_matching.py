@@ -0,0 +1,99 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from basicviz.models import Mass2MotifInstance, MotifMatch
+
+# Cosine matching of the motifs of one experiment against those of a base experiment.
+# The motifs of each experiment are a sparse (motifs x features) matrix of their
+# Mass2MotifInstance probabilities and feature_map (query feature -> list of base features)
+# is a sparse (query features x base features) matrix, so all of the scores come from
+# sparse products rather than loops over motif and feature dictionaries.
+
+
+# The motifs of experiment with any instances (in id order), their (motifs x features)
+# probability matrix for the features in feature_index (feature id -> column) and their norms.
+# The norms include the probabilities of features that aren't in feature_index
+def get_motif_matrix(experiment, feature_index):
+    instances = Mass2MotifInstance.objects.filter(mass2motif__experiment=experiment)
+    rows = instances.values_list('mass2motif_id', 'feature_id', 'probability')
+    if len(rows) > 0:
+        motif_ids, feature_ids, probabilities = [np.array(column) for column in zip(*rows)]
+    else:
+        motif_ids, feature_ids, probabilities = np.zeros(0, np.int), np.zeros(0, np.int), np.zeros(0)
+    motif_ids, motif_rows = np.unique(motif_ids, return_inverse=True)
+    norms = np.sqrt(np.bincount(motif_rows, weights=probabilities ** 2, minlength=len(motif_ids)))
+
+    columns = np.array([feature_index.get(feature_id, -1) for feature_id in feature_ids.tolist()], np.int)
+    keep = columns >= 0
+    matrix = coo_matrix((probabilities[keep], (motif_rows[keep], columns[keep])),
+                        shape=(len(motif_ids), len(feature_index))).tocsr()
+    return motif_ids.tolist(), matrix, norms
+
+
+# feature_map as a list of sparse (query features x base features) 0/1 matrices with at most
+# one entry per row: the first base feature of each query feature, then the second, etc.
+def get_feature_map_layers(feature_map, feature_index, base_feature_index):
+    layers = []
+    for feature, map_features in feature_map.items():
+        for k, map_feature in enumerate(map_features):
+            if k == len(layers):
+                layers.append(([], []))
+            layers[k][0].append(feature_index[feature.id])
+            layers[k][1].append(base_feature_index[map_feature.id])
+    shape = (len(feature_index), len(base_feature_index))
+    return [coo_matrix((np.ones(len(rows)), (rows, columns)), shape=shape).tocsr() for rows, columns in layers]
+
+
+# The (query motifs x base motifs) cosine scores. A query feature that maps to more than one
+# base feature can only be used once (or the normalisation will mess up), so it contributes
+# its largest product with the mapped features of each base motif
+def get_match_scores(motifs, norms, base_motifs, base_norms, layers):
+    mapped = None
+    for layer in layers:
+        # (query features x base motifs) probability of each feature's mapped base feature
+        layer_probabilities = layer.dot(base_motifs.T).tocsr()
+        mapped = layer_probabilities if mapped is None else mapped.maximum(layer_probabilities)
+    if mapped is None:
+        return np.zeros((motifs.shape[0], base_motifs.shape[0]))
+    scores = motifs.dot(mapped).toarray()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores /= norms[:, None]
+        scores /= base_norms[None, :]
+    scores[~np.isfinite(scores)] = 0.0
+    return scores
+
+
+# The top_n best base motifs of each query motif with a score above zero, as
+# (query motif position, base motif position, score), best first for each query motif
+def get_top_matches(scores, top_n=1):
+    n_base = scores.shape[1]
+    if n_base == 0 or top_n < 1:
+        return []
+    order = -scores
+    if top_n < n_base:
+        best = np.argpartition(order, top_n - 1, axis=1)[:, :top_n]
+    else:
+        best = np.tile(np.arange(n_base), (scores.shape[0], 1))
+    matches = []
+    for i, columns in enumerate(best):
+        columns = columns[np.lexsort((columns, order[i, columns]))]
+        for j in columns.tolist():
+            if scores[i, j] > 0:
+                matches.append((i, j, scores[i, j]))
+    return matches
+
+
+# Saves (frommotif id, tomotif id, score) matches, updating the score of existing MotifMatches
+def save_motif_matches(matches):
+    existing = {}
+    from_ids = set([match[0] for match in matches])
+    motif_matches = MotifMatch.objects.filter(frommotif_id__in=from_ids).values_list('frommotif_id', 'tomotif_id', 'id')
+    for frommotif_id, tomotif_id, match_id in motif_matches:
+        existing[(frommotif_id, tomotif_id)] = match_id
+    new_matches = []
+    for frommotif_id, tomotif_id, score in matches:
+        if (frommotif_id, tomotif_id) in existing:
+            MotifMatch.objects.filter(id=existing[(frommotif_id, tomotif_id)]).update(score=score)
+        else:
+            new_matches.append(MotifMatch(frommotif_id=frommotif_id, tomotif_id=tomotif_id, score=score))
+    MotifMatch.objects.bulk_create(new_matches)
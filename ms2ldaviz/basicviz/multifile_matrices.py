@@ -0,0 +1,149 @@
+import numpy as np
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from basicviz.models import Alpha, AlphaCorrOptions, DocumentMass2Motif, Mass2Motif, MultiLink, SystemOptions
+
+# The alpha and degree matrices of a multi-file experiment have a row for each motif (in name
+# order) and a column for each individual experiment. Each column is stored on the experiment's
+# MultiLink as the bytes of a numpy array. They are computed in the background by the
+# compute_multifile_matrices task with one query per experiment for each matrix, and the degrees
+# of an experiment are recomputed on their own when its doc-m2m thresholds change.
+MATRIX_DTYPES = {'alphas': np.float64, 'degrees': np.int32}
+THRESHOLD_OPTIONS = ['doc_m2m_prob_threshold', 'doc_m2m_overlap_threshold']
+SIMILARITY_SCORES = ['cosine', 'pearson']
+
+
+def get_motif_ids(experiment):
+    return list(Mass2Motif.objects.filter(experiment=experiment).order_by('name').values_list('id', flat=True))
+
+
+def compute_alphas(experiment):
+    # the first alpha of each motif (as motif.alpha_set.all()[0])
+    alpha_values = {}
+    alphas = Alpha.objects.filter(mass2motif__experiment=experiment).order_by('-id')
+    for motif_id, value in alphas.values_list('mass2motif_id', 'value'):
+        alpha_values[motif_id] = value
+    return np.array([alpha_values[motif_id] for motif_id in get_motif_ids(experiment)], dtype=MATRIX_DTYPES['alphas'])
+
+
+def compute_degrees(experiment):
+    # the number of documents of each motif that are above the experiment's thresholds (as get_docm2m)
+    from basicviz.views.views_lda_single import get_prob_overlap_thresholds
+    doc_m2m_prob_threshold, doc_m2m_overlap_threshold = get_prob_overlap_thresholds(experiment)
+    dm2ms = DocumentMass2Motif.objects.filter(mass2motif__experiment=experiment,
+                                              probability__gte=doc_m2m_prob_threshold,
+                                              overlap_score__gte=doc_m2m_overlap_threshold)
+    counts = dict(dm2ms.order_by().values('mass2motif').annotate(n=Count('id')).values_list('mass2motif', 'n'))
+    return np.array([counts.get(motif_id, 0) for motif_id in get_motif_ids(experiment)], dtype=MATRIX_DTYPES['degrees'])
+
+
+def update_link(link, fields=('alphas', 'degrees')):
+    if 'alphas' in fields:
+        link.alphas = compute_alphas(link.experiment).tobytes()
+    if 'degrees' in fields:
+        link.degrees = compute_degrees(link.experiment).tobytes()
+    link.save(update_fields=list(fields))
+
+
+# Recomputes the columns of every MultiLink in links (a MultiLink queryset)
+def update_links(links, fields=('alphas', 'degrees')):
+    for link in links.select_related('experiment'):
+        print "Computing {} of {} in {}".format(', '.join(fields), link.experiment, link.multifileexperiment_id)
+        update_link(link, fields)
+
+
+# Returns the individual experiments (in name order) and their matrix (motifs x individuals) for
+# matrix = 'alphas' or 'degrees'. Any columns that haven't been computed yet are computed here
+def get_multifile_matrix(multifileexperiment, matrix):
+    links = MultiLink.objects.filter(multifileexperiment=multifileexperiment).select_related('experiment')
+    links = links.order_by('experiment__name')
+    individuals = []
+    columns = []
+    for link in links:
+        if getattr(link, matrix) is None:
+            update_link(link, [matrix])
+        individuals.append(link.experiment)
+        columns.append(np.frombuffer(getattr(link, matrix), dtype=MATRIX_DTYPES[matrix]))
+    # as zip, the rows stop at the shortest column
+    n_motifs = min(len(column) for column in columns) if len(columns) > 0 else 0
+    values = np.zeros((n_motifs, len(columns)), dtype=MATRIX_DTYPES[matrix])
+    for i, column in enumerate(columns):
+        values[:, i] = column[:n_motifs]
+    return individuals, values
+
+
+# Also wipes the alpha correlation graphs, which are made from the alphas
+def wipe_multifile_matrices(multifileexperiment):
+    MultiLink.objects.filter(multifileexperiment=multifileexperiment).update(alphas=None, degrees=None)
+    AlphaCorrOptions.objects.filter(multifileexperiment=multifileexperiment).update(graph=None)
+
+
+# Scores between every pair of rows of alphas (motifs x individuals) for an AlphaCorrOptions
+# distance_score: 'cosine' and 'pearson' are similarities, 'euclidean' and 'rms' are distances
+def alpha_correlation_scores(alphas, distance_score, normalise_alphas=False):
+    alphas = np.array(alphas, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if normalise_alphas:
+            alphas /= np.linalg.norm(alphas, axis=1)[:, None]
+        if distance_score == 'cosine':
+            return alphas.dot(alphas.T)
+        elif distance_score == 'pearson':
+            z = (alphas - alphas.mean(axis=1)[:, None]) / alphas.std(axis=1)[:, None]
+            return z.dot(z.T) / alphas.shape[1]
+        elif distance_score in ('euclidean', 'rms'):
+            squares = (alphas ** 2).sum(axis=1)
+            distances = np.maximum(squares[:, None] + squares[None, :] - 2 * alphas.dot(alphas.T), 0.0)
+            if distance_score == 'rms':
+                distances /= alphas.shape[1]
+            return np.sqrt(distances)
+    raise ValueError("Unknown distance score {}".format(distance_score))
+
+
+# The edges of the alpha correlation graph as (i, j, score) with i < j, best score first:
+# the pairs scoring above edge_thresh for a similarity (below it for a distance), at most max_edges
+def alpha_correlation_edges(alphas, distance_score, normalise_alphas, edge_thresh, max_edges):
+    scores = alpha_correlation_scores(alphas, distance_score, normalise_alphas)
+    rows, cols = np.triu_indices(len(scores), 1)
+    pair_scores = scores[rows, cols]
+    with np.errstate(invalid='ignore'):
+        if distance_score in SIMILARITY_SCORES:
+            order_key = -pair_scores
+            candidates = np.flatnonzero(pair_scores > edge_thresh)
+        else:
+            order_key = pair_scores
+            candidates = np.flatnonzero(pair_scores < edge_thresh)
+    max_edges = max(max_edges, 0)
+    if len(candidates) > max_edges:
+        if max_edges == 0:
+            return []
+        candidates = candidates[np.argpartition(order_key[candidates], max_edges - 1)[:max_edges]]
+    # ties are kept in pair order
+    candidates = candidates[np.lexsort((candidates, order_key[candidates]))]
+    return zip(rows[candidates].tolist(), cols[candidates].tolist(), pair_scores[candidates].tolist())
+
+
+# The alpha correlation graphs show the motifs' annotations, so saving a motif (e.g. a new
+# annotation) wipes the graphs of the multi-file experiments of its experiment, and of the
+# experiments with motifs linked to it (which show its annotation)
+@receiver(post_save, sender=Mass2Motif)
+def motif_changed(sender, instance, **kwargs):
+    experiment_ids = set(Mass2Motif.objects.filter(linkmotif=instance).values_list('experiment_id', flat=True))
+    experiment_ids.add(instance.experiment_id)
+    AlphaCorrOptions.objects.filter(multifileexperiment__multilink__experiment_id__in=experiment_ids).update(graph=None)
+
+
+# A threshold change for one experiment only changes its own degrees, a change of the
+# global threshold can change those of any experiment without its own threshold.
+# The options views make new options with get_or_create and then set the value and save,
+# so a new option without a value is skipped (its save with the value follows). The task is
+# queued once the change is committed, so it sees the new value
+@receiver(post_save, sender=SystemOptions)
+@receiver(post_delete, sender=SystemOptions)
+def threshold_changed(sender, instance, created=False, **kwargs):
+    if instance.key in THRESHOLD_OPTIONS and not (created and not instance.value):
+        from basicviz.tasks import update_multifile_degrees
+        experiment_id, key = instance.experiment_id, instance.key
+        transaction.on_commit(lambda: update_multifile_degrees.delay(experiment_id, key))
@@ -2,17 +2,17 @@ import bisect
 import numpy as np
 
 from ms2ldaviz.celery_tasks import app
-from basicviz.models import Experiment,Mass2MotifInstance,MotifMatch
+from basicviz.models import Experiment,Feature,Mass2MotifInstance,MotifMatch,MultiFileExperiment,MultiLink
+from basicviz.motif_matching import get_motif_matrix,get_feature_map_layers,get_match_scores,get_top_matches,save_motif_matches
+from basicviz.multifile_matrices import update_links
 
 
 def get_experiment_features(experiment):
-    motifs = experiment.mass2motif_set.all()
-    feature_instances = Mass2MotifInstance.objects.filter(mass2motif__in = motifs)
-    features = set([fi.feature for fi in feature_instances])
-    return features
+    features = Feature.objects.filter(mass2motifinstance__mass2motif__experiment = experiment).distinct()
+    return set(features)
 
 @app.task
-def match_motifs_set(experiment_id,base_experiment_id,min_score_to_save = 0.5):
+def match_motifs_set(experiment_id,base_experiment_id,min_score_to_save = 0.5,top_n = 1):
 
     # Get the expeiment objetcs 
     experiment = Experiment.objects.get(id = experiment_id)
@@ -68,11 +68,11 @@ def match_motifs_set(experiment_id,base_experiment_id,min_score_to_save = 0.5):
                     temp.append(base_feature_name_dict[fname2])
                 if len(temp) > 0:
                     feature_map[feature] = temp
-    elif fs.name == 'binned_005' and basefs.name == 'binned_01':
+    elif fs.name == 'binned_005' and base_fs.name == 'binned_01':
         # Each will only match to one, but the matches will appear more than once
         for feature in features:
             ftype = feature.name.split('_')[0]
-            if ftype == 'fragent' or ftype == 'loss':
+            if ftype == 'fragment' or ftype == 'loss':
                 lowval = feature.min_mz
                 highval = feature.max_mz
                 # Each feature will map perfectly into the first or second half of 
@@ -81,11 +81,11 @@ def match_motifs_set(experiment_id,base_experiment_id,min_score_to_save = 0.5):
                 # Easiest way is to check if upper lor lower val is a name in the other set
                 uppername = ftype+ "_{:.4f}".format(highval)
                 if uppername in base_feature_name_dict:
-                    feature_map[feature] = base_feature_name_dict[uppername]
+                    feature_map[feature] = [base_feature_name_dict[uppername]]
                 else:
                     lowername = ftype+ "_{:.4f}".format(lowval)
                     if lowername in base_feature_name_dict:
-                        feature_map[lowername] = base_feature_name_dict[lowername]
+                        feature_map[feature] = [base_feature_name_dict[lowername]]
             elif ftype == 'mzdiff':
                 if feature.name in base_feature_name_dict:
                     feature_map[feature] = [base_feature_name_dict[feature.name]]
@@ -114,92 +114,24 @@ def match_motifs_set(experiment_id,base_experiment_id,min_score_to_save = 0.5):
 
     print "Found matches of {} out of {} features".format(len(feature_map),len(features))
 
-    # get the motifs
-    motifs = experiment.mass2motif_set.all()
-    motif_dict = {}
-    motif_norms = {}
-
-    base_motifs = base_experiment.mass2motif_set.all()
-    base_motif_dict = {}
-    base_motif_norms = {}
-
-
-    # get the instances and compute the normalisation terms
-    mfs = Mass2MotifInstance.objects.filter(mass2motif__in = motifs)
-    base_mfs = Mass2MotifInstance.objects.filter(mass2motif__in = base_motifs)
-
-    # Store them in dicts for quick access
-    for mf in mfs:
-        motif = mf.mass2motif
-        if not motif in motif_dict:
-            motif_dict[motif] = {}
-            motif_norms[motif] = 0.0
-        motif_dict[motif][mf.feature] = mf.probability
-        motif_norms[motif] += mf.probability ** 2
-
-    for mf in base_mfs:
-        motif = mf.mass2motif
-        if not motif in base_motif_dict:
-            base_motif_dict[motif] = {}
-            base_motif_norms[motif] = 0.0
-        base_motif_dict[motif][mf.feature] = mf.probability
-        base_motif_norms[motif] += mf.probability ** 2
-
-
-    for motif in motif_norms:
-        motif_norms[motif] = np.sqrt(motif_norms[motif])
-    for motif in base_motif_norms:
-        base_motif_norms[motif] = np.sqrt(base_motif_norms[motif])
-
+    # the motifs of each experiment as sparse (motifs x features) matrices
+    feature_index = {}
+    for i,feature in enumerate(sorted(features,key = lambda x: x.id)):
+        feature_index[feature.id] = i
+    base_feature_index = {}
+    for i,feature in enumerate(sorted(base_features,key = lambda x: x.id)):
+        base_feature_index[feature.id] = i
+    motif_ids,motifs,motif_norms = get_motif_matrix(experiment,feature_index)
+    base_motif_ids,base_motifs,base_motif_norms = get_motif_matrix(base_experiment,base_feature_index)
 
     # compute the cosine scores
-    matches = []
-    for motif in motif_dict.keys():
-        best_score = 0.0
-        best_base = None
-        best_list = None
-        for base_motif in base_motif_dict.keys():
-            match_list = []
-            score = 0.0
-            # Note: with matching now, one feature could hit two base features. In this case
-            # we can't use it twice or the normalisation will mess up. So, we use the assignment
-            # that gives the max score
-            for feature,probability in motif_dict[motif].items():
-                temp_list = None
-                if feature in feature_map:
-                    map_features = feature_map[feature]
-                    for map_feature in map_features:
-                        temp_score = 0.0
-                        if map_feature in base_motif_dict[base_motif]:
-                            map_probability = base_motif_dict[base_motif][map_feature]
-                            t = probability * map_probability
-                            if t >= temp_score:
-                                temp_score = probability * map_probability
-                                temp_list = (feature,probability,map_feature,map_probability)
-                    match_list.append(temp_list)
-                    score += temp_score
-            
-            score /= motif_norms[motif]
-            score /= base_motif_norms[base_motif]
-            
-            
-            if score > best_score: # only keep the best one from this query motif
-                best_score = score
-                best_base = base_motif
-                best_list = match_list
-        if best_score >= min_score_to_save:
-            matches.append((motif,best_base,best_score,best_list))
-            print motif,best_score,best_base
-
-    for match in matches:
-        frommotif = match[0]
-        tomotif = match[1]
-        score = match[2]
-        mm,status = MotifMatch.objects.get_or_create(frommotif = frommotif,tomotif = tomotif)
-        mm.score = score
-        mm.save()
-
-
+    layers = get_feature_map_layers(feature_map,feature_index,base_feature_index)
+    scores = get_match_scores(motifs,motif_norms,base_motifs,base_motif_norms,layers)
+    matches = [(motif_ids[i],base_motif_ids[j],score) for i,j,score in get_top_matches(scores,top_n)]
+    to_save = [match for match in matches if match[2] >= min_score_to_save]
+    save_motif_matches(to_save)
+    print "Saved {} matches of {} motifs against {} base motifs".format(len(to_save),len(motif_ids),len(base_motif_ids))
+    return matches
 
 
 @app.task
@@ -363,3 +295,23 @@ def match_motifs(experiment_id,base_experiment_id,min_score_to_save = 0.5):
         mm,status = MotifMatch.objects.get_or_create(frommotif = frommotif,tomotif = tomotif)
         mm.score = score
         mm.save()
+
+
+# Computes the alpha and degree matrices of a multi-file experiment (see basicviz/multifile_matrices.py)
+@app.task
+def compute_multifile_matrices(multifileexperiment_id):
+    mfe = MultiFileExperiment.objects.get(id = multifileexperiment_id)
+    update_links(MultiLink.objects.filter(multifileexperiment = mfe))
+
+
+# Recomputes the degrees of an experiment in all of its multi-file experiments after its thresholds
+# have changed. With experiment_id = None (the global threshold key has changed) those of all of the
+# experiments that don't have their own value for key are recomputed
+@app.task
+def update_multifile_degrees(experiment_id = None,key = None):
+    links = MultiLink.objects.all()
+    if experiment_id is not None:
+        links = links.filter(experiment_id = experiment_id)
+    elif key is not None:
+        links = links.exclude(experiment__systemoptions__key = key)
+    update_links(links,fields = ['degrees'])
@@ -13,6 +13,9 @@ from basicviz.forms import AlphaCorrelationForm, AlphaDEForm
 from massbank.forms import Mass2MotifMetadataForm
 from basicviz.models import Experiment, Mass2Motif, Mass2MotifInstance, MultiFileExperiment, MultiLink, Alpha, \
     AlphaCorrOptions, Document
+from basicviz.multifile_matrices import SIMILARITY_SCORES, alpha_correlation_edges, get_multifile_matrix, \
+    wipe_multifile_matrices
+from basicviz.tasks import compute_multifile_matrices
 from massbank.views import get_massbank_form
 from options.views import get_option
 from views_index import index
@@ -28,112 +31,38 @@ def get_individual_names(request, mf_id):
 
 
 def get_alpha_matrix(request, mf_id):
-    if True:
-        mfe = MultiFileExperiment.objects.get(id=mf_id)
-
-        if not mfe.alpha_matrix:
-
-            links = MultiLink.objects.filter(multifileexperiment=mfe).order_by('experiment__name')
-            individuals = [l.experiment for l in links]
-            motifs = Mass2Motif.objects.filter(experiment=individuals[0])
+    mfe = MultiFileExperiment.objects.get(id=mf_id)
+    individuals, alphas = get_multifile_matrix(mfe, 'alphas')
+    motifs = list(individuals[-1].mass2motif_set.all().select_related('linkmotif').order_by('name'))
 
-            alp_vals = []
-            for individual in individuals:
-                motifs = individual.mass2motif_set.all().order_by('name')
-                alp_vals.append([m.alpha_set.all()[0].value for m in motifs])
+    alp_vals = alphas.tolist()
+    alp_vals = [[motifs[i].name, motifs[i].annotation] + av + [float((np.array(av) / sum(av)).var())] for i, av
+                in enumerate(alp_vals)]
 
-            alp_vals = map(list, zip(*alp_vals))
-            alp_vals = [[motifs[i].name, motifs[i].annotation] + av + [float((np.array(av) / sum(av)).var())] for i, av
-                        in enumerate(alp_vals)]
-
-            data = json.dumps(alp_vals)
-            mfe.alpha_matrix = jsonpickle.encode(alp_vals)
-            mfe.save()
-        else:
-            alp_vals = jsonpickle.decode(mfe.alpha_matrix)
-            data = json.dumps(alp_vals)
-
-        return HttpResponse(data, content_type='application/json')
-    else:
-        raise Http404
+    data = json.dumps(alp_vals)
+    return HttpResponse(data, content_type='application/json')
 
 
 def get_degree_matrix(request, mf_id):
     if request.is_ajax():
         mfe = MultiFileExperiment.objects.get(id=mf_id)
-        if not mfe.degree_matrix:
-            links = MultiLink.objects.filter(multifileexperiment=mfe).order_by('experiment__name')
-            individuals = [l.experiment for l in links]
-            deg_vals = []
-
-            for individual in individuals:
-
-                # doc_m2m_threshold = get_option('doc_m2m_threshold', experiment=individual)
-                # if doc_m2m_threshold:
-                #     doc_m2m_threshold = float(doc_m2m_threshold)
-                # else:
-                #     doc_m2m_threshold = 0.0
-                # default_score = get_option('default_doc_m2m_score', experiment=individual)
-                # if not default_score:
-                #     default_score = 'probability'
-
-                new_row = []
-                motif_set = individual.mass2motif_set.all().order_by('name')
-                for motif in motif_set:
-                    motif_name = motif.name
-                    m2m = Mass2Motif.objects.get(name=motif_name, experiment=individual)
-                    docs = get_docm2m(m2m)
-
-                    # Following modified to make the degrees here consistent with the plots
-                    
-                    # dm2m = motif.documentmass2motif_set.all()
-                    # if default_score == 'probability':
-                    #     new_row.append(len([d for d in dm2m if d.probability > doc_m2m_threshold]))
-                    # else:
-                    #     new_row.append(len([d for d in dm2m if d.overlap_score > doc_m2m_threshold]))
-
-                    new_row.append(len(docs))
-
-                deg_vals.append(new_row)
-
-            deg_vals = map(list, zip(*deg_vals))
-            deg_vals = [[motif_set[i].name, motif_set[i].annotation] + dv for i, dv in enumerate(deg_vals)]
-
-            data = json.dumps(deg_vals)
-            mfe.degree_matrix = jsonpickle.encode(deg_vals)
-            mfe.save()
-        else:
-            deg_vals = jsonpickle.decode(mfe.degree_matrix)
-            data = json.dumps(deg_vals)
+        individuals, degrees = get_multifile_matrix(mfe, 'degrees')
+        motif_set = list(individuals[-1].mass2motif_set.all().select_related('linkmotif').order_by('name'))
+
+        # the degrees are consistent with the plots (see get_docm2m)
+        deg_vals = degrees.tolist()
+        deg_vals = [[motif_set[i].name, motif_set[i].annotation] + dv for i, dv in enumerate(deg_vals)]
+
+        data = json.dumps(deg_vals)
         return HttpResponse(data, content_type='application/json')
     else:
         raise Http404
 
 
-def make_alpha_matrix(individuals, normalise=True):
-    print "Creating alpha matrix"
-    alp_vals = []
-    for individual in individuals:
-        motifs = individual.mass2motif_set.all().order_by('name')
-        alp_vals.append([m.alpha_set.all()[0].value for m in motifs])
-
-    alp_vals = map(list, zip(*alp_vals))
-    new_alp_vals = []
-    if normalise:
-        for av in alp_vals:
-            s = sum(av)
-            nav = [a / s for a in av]
-            new_alp_vals.append(nav)
-        alp_vals = new_alp_vals
-
-    return alp_vals
-
-
 def wipe_cache(request, mf_id):
     mfe = MultiFileExperiment.objects.get(id=mf_id)
-    mfe.alpha_matrix = None
-    mfe.degree_matrix = None
-    mfe.save()
+    wipe_multifile_matrices(mfe)
+    compute_multifile_matrices.delay(mfe.id)
     return index(request)
 
 
@@ -447,40 +376,32 @@ def alpha_correlation(request, mf_id):
 
 
 def get_alpha_correlation_graph(request, acviz_id):
-    from itertools import combinations
     acviz = AlphaCorrOptions.objects.get(id=acviz_id)
+    if acviz.graph:
+        return HttpResponse(acviz.graph, content_type='application/json')
+
     mfe = acviz.multifileexperiment
     links = mfe.multilink_set.all().order_by('experiment__name')
-    individuals = [l.experiment for l in links]
     an_experiment = links[0].experiment
     motifs = Mass2Motif.objects.filter(experiment=an_experiment).order_by('name')
 
-    if mfe.alpha_matrix:
-        alp_vals_with_names = jsonpickle.decode(mfe.alpha_matrix)
-        alp_vals = []
-        for av in alp_vals_with_names:
-            newav = av[2:-1]
-            alp_vals.append(newav)
-
-    else:
-        alp_vals = make_alpha_matrix(individuals, normalise=True)
+    _, alp_vals = get_multifile_matrix(mfe, 'alphas')
 
     motif_index = []
     an_motifs = []
-    if acviz.just_annotated:
-        for i, motif in enumerate(motifs):
-            if 'annotation' in jsonpickle.decode(motif.metadata):
-                an_motifs.append(motif)
-                motif_index.append(i)
-        motifs = an_motifs
-    else:
-        motif_index = range(len(motifs))
+    metadata = []
+    for i, motif in enumerate(motifs):
+        md = jsonpickle.decode(motif.metadata)
+        if not acviz.just_annotated or 'annotation' in md:
+            an_motifs.append(motif)
+            motif_index.append(i)
+            metadata.append(md)
+    motifs = an_motifs
 
     # Add motifs as nodes
     G = nx.Graph()
     motif_names = []
-    for motif in motifs:
-        md = jsonpickle.decode(motif.metadata)
+    for motif, md in zip(motifs, metadata):
         name = motif.name
         if 'mass2motif' in name:
             tokens = name.split('_')
@@ -493,53 +414,19 @@ def get_alpha_correlation_graph(request, acviz_id):
         else:
             G.add_node(motif.name, name=display_name, col='#333333')
 
-    # add edges where the score is > thresh
-    scores = []
-    for i, j in combinations(range(len(motifs)), 2):
-        a1 = np.array(alp_vals[motif_index[i]])
-        a2 = np.array(alp_vals[motif_index[j]])
-
-        if acviz.normalise_alphas:
-            a1n = a1 / np.linalg.norm(a1)
-            a2n = a2 / np.linalg.norm(a2)
-        else:
-            a1n = a1
-            a2n = a2
-
-        if acviz.distance_score == 'cosine':
-            score = np.dot(a1n, a2n)
-        elif acviz.distance_score == 'euclidean':
-            score = np.sqrt((a1n - a2n) ** 2)
-        elif acviz.distance_score == 'rms':
-            score = np.sqrt(((a1n - a2n) ** 2).mean())
-        elif acviz.distance_score == 'pearson':
-            score = ((a1n - a1n.mean()) * (a2n - a2n.mean())).mean() / (a1n.std() * a2n.std())
-
-        scores.append((i, j, score))
-
-    if acviz.distance_score == 'cosine' or acviz.distance_score == 'pearson':
-        scores = sorted(scores, key=lambda x: x[2], reverse=True)
-    else:
-        scores = sorted(scores, key=lambda x: x[2])
-
-    pos = 0
-    while True:
-        i, j, score = scores[pos]
-        if (acviz.distance_score == 'cosine' or acviz.distance_score == 'pearson') and score > acviz.edge_thresh:
+    # add edges where the score is better than thresh
+    edges = alpha_correlation_edges(alp_vals[motif_index], acviz.distance_score, acviz.normalise_alphas,
+                                    acviz.edge_thresh, acviz.max_edges)
+    for i, j, score in edges:
+        if acviz.distance_score in SIMILARITY_SCORES:
             G.add_edge(motif_names[i], motif_names[j], weight=score)
-        elif (acviz.distance_score == 'euclidean' or acviz.distance_score == 'rms') and score > acviz.edge_thresh:
-            G.add_edge(motif_names[i], motif_names[j])
         else:
-            break
-        pos += 1
-        if pos > acviz.max_edges:
-            break
-        if pos >= len(scores):
-            break
+            G.add_edge(motif_names[i], motif_names[j])
 
     # nx.write_gexf(G, "network_%d.gexf" % int(acviz_id))
-    d = json_graph.node_link_data(G)
-    return HttpResponse(json.dumps(d), content_type='application/json')
+    acviz.graph = json.dumps(json_graph.node_link_data(G))
+    acviz.save(update_fields=['graph'])
+    return HttpResponse(acviz.graph, content_type='application/json')
 
 
 def alpha_de(request, mfe_id):
@@ -556,15 +443,7 @@ def alpha_de(request, mfe_id):
             group2_experiments = form.cleaned_data['group2']
             motifs = individuals[0].mass2motif_set.all().order_by('name')
 
-            if mfe.alpha_matrix:
-                alp_vals_with_names = jsonpickle.decode(mfe.alpha_matrix)
-                alp_vals = []
-                for av in alp_vals_with_names:
-                    newav = av[2:-1]
-                    alp_vals.append(newav)
-
-            else:
-                alp_vals = make_alpha_matrix(individuals, normalise=True)
+            _, alp_vals = get_multifile_matrix(mfe, 'alphas')
 
             group1_index = []
             group2_index = []
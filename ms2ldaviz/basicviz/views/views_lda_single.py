@@ -18,6 +18,7 @@ from massbank.forms import Mass2MotifMetadataForm
 from basicviz.models import Feature, Experiment, Document, FeatureInstance, DocumentMass2Motif, \
     FeatureMass2MotifInstance, Mass2Motif, Mass2MotifInstance, VizOptions, UserExperiment, MotifMatch
 from basicviz.tasks import match_motifs,match_motifs_set
+from basicviz.graph_cache import get_cached_graph, set_cached_graph, invalidate_graphs
 from massbank.views import get_massbank_form
 from options.views import get_option
 from decomposition.models import DocumentGlobalMass2Motif, GlobalMotif, DocumentGlobalFeature, FeatureMap
@@ -90,6 +91,8 @@ def compute_topic_scores(request, experiment_id):
                     md['logfc'] = float(thisfc)
                     document.metadata = jsonpickle.encode(md)
                     document.save()
+            if form.cleaned_data['storelogfc']:
+                invalidate_graphs(experiment.id)
 
             logfc = np.array(logfc)
 
@@ -870,6 +873,10 @@ def get_graph(request, vo_id):
     else:
         show_ms1 = False
 
+    graph_json = get_cached_graph(viz_options, show_ms1)
+    if graph_json is not None:
+        return HttpResponse(graph_json, content_type='application/json')
+
     if experiment.experiment_type == "0":
         ms1_analysis_id = viz_options.ms1_analysis_id if show_ms1 else None
         G = make_graph(experiment, min_degree=viz_options.min_degree,
@@ -888,7 +895,9 @@ def get_graph(request, vo_id):
         #                edge_choice=viz_options.edge_choice)
         raise Http404("page not found")
     d = json_graph.node_link_data(G)
-    return HttpResponse(json.dumps(d), content_type='application/json')
+    graph_json = json.dumps(d)
+    set_cached_graph(viz_options, graph_json, show_ms1)
+    return HttpResponse(graph_json, content_type='application/json')
 
 
 # def make_decomposition_graph(experiment,min_degree = 5,edge_thresh = 0.5,
@@ -958,21 +967,26 @@ def get_graph(request, vo_id):
 #                colour_topic_by_score=False, edge_choice='probability', ms1_analysis_id = None, doc_max_size = 200, motif_max_size = 1000):
 def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor=5,
                ms1_analysis_id=None, doc_max_size=200, motif_max_size=1000):
-    mass2motifs = Mass2Motif.objects.filter(experiment=experiment)
-    documents = Document.objects.filter(experiment=experiment)
+    # All of the document-motif links above the thresholds, with their documents, in one query
+    doc_m2m_prob_threshold, doc_m2m_overlap_threshold = get_prob_overlap_thresholds(experiment)
+    all_docm2ms = DocumentMass2Motif.objects.filter(mass2motif__experiment=experiment,
+                                                    probability__gte=doc_m2m_prob_threshold,
+                                                    overlap_score__gte=doc_m2m_overlap_threshold)
+    all_docm2ms = all_docm2ms.order_by('-probability').values_list('mass2motif_id', 'document_id', 'document__name',
+                                                                  'document__metadata', 'probability', 'overlap_score')
+
     # Find the degrees
     topics = {}
     docm2m_dict = {}
-    for mass2motif in mass2motifs:
+    motif_names = {}
+    for mass2motif in Mass2Motif.objects.filter(experiment=experiment).select_related('linkmotif'):
         topics[mass2motif] = 0
-        docm2ms = get_docm2m(mass2motif)
-        docm2m_dict[mass2motif] = list(docm2ms)
-        # if edge_choice == 'probability':
-        #     docm2ms = DocumentMass2Motif.objects.filter(mass2motif=mass2motif, probability__gte=edge_thresh)
-        # else:
-        #     docm2ms = DocumentMass2Motif.objects.filter(mass2motif=mass2motif, overlap_score__gte=edge_thresh)
-        for d in docm2ms:
-            topics[mass2motif] += 1
+        docm2m_dict[mass2motif.id] = []
+        motif_names[mass2motif.id] = mass2motif.name
+    for docm2m in all_docm2ms:
+        docm2m_dict[docm2m[0]].append(docm2m)
+    for mass2motif in topics:
+        topics[mass2motif] = len(docm2m_dict[mass2motif.id])
     to_remove = []
     for topic in topics:
         if topics[topic] < min_degree:
@@ -982,7 +996,7 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
 
     docm2mset = []
     for topic in topics:
-        docm2mset += docm2m_dict[topic]
+        docm2mset += docm2m_dict[topic.id]
 
     # if edge_choice == 'probability':
     #     docm2mset = DocumentMass2Motif.objects.filter(document__in=documents, mass2motif__in=topics,
@@ -999,10 +1013,15 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
     do_plage_flag = True
     if ms1_analysis_id:
         analysis = Analysis.objects.filter(id=ms1_analysis_id)[0]
+        ## the results of the documents and motifs, in one query each
+        doc_ids = set([docm2m[1] for docm2m in docm2mset])
+        analysis_results = {}
         all_logfc_vals = []
-        res = AnalysisResult.objects.filter(analysis=analysis, document__in=[docm2m.document for docm2m in docm2mset])
-        for analysis_result in res:
-            foldChange = analysis_result.foldChange
+        res = AnalysisResult.objects.filter(analysis=analysis).order_by('id')
+        for document_id, foldChange, pValue in res.values_list('document_id', 'foldChange', 'pValue'):
+            if not document_id in doc_ids:
+                continue
+            analysis_results.setdefault(document_id, (foldChange, pValue))
             logfc = np.log(foldChange)
             if not np.abs(logfc) == np.inf:
                 all_logfc_vals.append(np.log(foldChange))
@@ -1010,9 +1029,14 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
         max_logfc = np.max(all_logfc_vals)
 
         ## try make graph for plage
+        topic_ids = set([topic.id for topic in topics])
+        plage_results = {}
         all_plage_vals = []
-        for plage_result in AnalysisResultPlage.objects.filter(analysis=analysis, mass2motif__in=topics.keys()):
-            plage_t_value = plage_result.plage_t_value
+        res = AnalysisResultPlage.objects.filter(analysis=analysis).order_by('id')
+        for mass2motif_id, plage_t_value, plage_p_value in res.values_list('mass2motif_id', 'plage_t_value', 'plage_p_value'):
+            if not mass2motif_id in topic_ids:
+                continue
+            plage_results.setdefault(mass2motif_id, (plage_t_value, plage_p_value))
             all_plage_vals.append(plage_t_value)
         if all_plage_vals:
             min_plage = np.min(all_plage_vals)
@@ -1024,7 +1048,7 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
     # Add the topics to the graph
     G = nx.Graph()
     for topic in topics:
-        metadata = jsonpickle.decode(topic.metadata)
+        short_annotation = topic.short_annotation
         # if colour_topic_by_score:
         #     upscore = metadata.get('upscore', 1.0)
         #     downscore = metadata.get('downscore', 1.0)
@@ -1046,9 +1070,7 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
             ## white to green
             lowcol = [255, 255, 255]
             endcol = [0, 255, 0]
-            plage_result = AnalysisResultPlage.objects.filter(analysis=analysis, mass2motif=topic)[0]
-            plage_t_value = plage_result.plage_t_value
-            plage_p_value = plage_result.plage_p_value
+            plage_t_value, plage_p_value = plage_results[topic.id]
             pos = (plage_t_value - min_plage) / (max_plage - min_plage)
             r = lowcol[0] + int(pos * (endcol[0] - lowcol[0]))
             g = lowcol[1] + int(pos * (endcol[1] - lowcol[1]))
@@ -1060,7 +1082,7 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
                 size = motif_max_size
             else:
                 size = min(10 - np.log(plage_p_value) * 200, motif_max_size)
-            na = topic.short_annotation
+            na = short_annotation
             if na:
                 na += ' (' + topic.name + ')'
             else:
@@ -1073,9 +1095,9 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
                        score=1, node_id=topic.id, is_topic=True)
 
         else:
-            if topic.short_annotation:
+            if short_annotation:
                 # if 'annotation' in metadata:
-                G.add_node(topic.name, group=2, name=topic.short_annotation,
+                G.add_node(topic.name, group=2, name=short_annotation,
                            size=topic_scale_factor * topics[topic],
                            special=True, in_degree=topics[topic],
                            score=1, node_id=topic.id, is_topic=True)
@@ -1093,32 +1115,30 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
 
     #     documents = new_documents
 
-    doc_nodes = []
+    doc_nodes = set()
 
     print "Second"
 
     # edge_choice = get_option('default_doc_m2m_score',experiment)
     edge_choice = 'probability'
 
-    for docm2m in docm2mset:
+    for mass2motif_id, document_id, document_name, document_metadata, probability, overlap_score in docm2mset:
         # if docm2m.mass2motif in topics:
-        if not docm2m.document in doc_nodes:
-            metadata = jsonpickle.decode(docm2m.document.metadata)
+        if not document_id in doc_nodes:
+            metadata = jsonpickle.decode(document_metadata)
             if 'compound' in metadata:
                 name = metadata['compound']
             elif 'annotation' in metadata:
                 name = metadata['annotation']
             else:
-                name = docm2m.document.name
+                name = document_name
             ## do MS1 expression analysis only when user choose a ms1 analysis setting
             if not ms1_analysis_id:
-                G.add_node(docm2m.document.name, group=1, name=name, size=20,
-                           type='square', peakid=docm2m.document.name, special=False,
+                G.add_node(document_name, group=1, name=name, size=20,
+                           type='square', peakid=document_name, special=False,
                            in_degree=0, score=0, is_topic=False)
             else:
-                analysis_result = AnalysisResult.objects.filter(analysis=analysis, document=docm2m.document)[0]
-                foldChange = analysis_result.foldChange
-                pValue = analysis_result.pValue
+                foldChange, pValue = analysis_results[document_id]
                 logfc = np.log(foldChange)
 
                 ## lowest: blue, logfc==0: white, highest: red
@@ -1156,20 +1176,20 @@ def make_graph(experiment, min_degree=5, topic_scale_factor=5, edge_scale_factor
                 else:
                     name = "{}, {:.3f}, None".format(name, logfc)
                 # name += ", " + str(logfc) + ", " + str(pValue)
-                G.add_node(docm2m.document.name, group=1, name=name, size=size,
-                           type='square', peakid=docm2m.document.name, special=True,
-                           highlight_colour=col, logfc=docm2m.document.logfc,
+                G.add_node(document_name, group=1, name=name, size=size,
+                           type='square', peakid=document_name, special=True,
+                           highlight_colour=col, logfc=metadata.get('logfc'),
                            in_degree=0, score=0, is_topic=False)
 
-            doc_nodes.append(docm2m.document)
+            doc_nodes.add(document_id)
 
         if edge_choice == 'probability':
-            weight = edge_scale_factor * docm2m.probability
+            weight = edge_scale_factor * probability
         elif edge_choice == 'both':
-            weight = docm2m.overlap_score
+            weight = overlap_score
         else:
-            weight = edge_scale_factor * docm2m.overlap_score
-        G.add_edge(docm2m.mass2motif.name, docm2m.document.name, weight=weight)
+            weight = edge_scale_factor * overlap_score
+        G.add_edge(motif_names[mass2motif_id], document_name, weight=weight)
     print "Third"
     return G
 
@@ -1835,6 +1855,7 @@ def set_doc_annotation(request):
         metadata['annotation'] = annotation
         document.metadata = jsonpickle.encode(metadata)
         document.save()
+        invalidate_graphs(experiment.id)
         response['status'] = 'ok'
     else:
         response['status'] = 'not a post request'
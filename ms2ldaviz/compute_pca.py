@@ -13,16 +13,15 @@ import jsonpickle
 
 from basicviz.models import MultiFileExperiment,MultiLink,Experiment,Document,Feature,FeatureInstance,Mass2Motif,Mass2MotifInstance,DocumentMass2Motif,FeatureMass2MotifInstance
 
-from basicviz.views import make_alpha_matrix
+from basicviz.multifile_matrices import get_multifile_matrix
 
 if __name__ == '__main__':
     mfname = sys.argv[1]
     mfe = MultiFileExperiment.objects.get(name = mfname)
-    links = MultiLink.objects.filter(multifileexperiment = mfe)
-    individuals = [l.experiment for l in links]
+    individuals,alphas = get_multifile_matrix(mfe,'alphas')
     motifs = Mass2Motif.objects.filter(experiment = individuals[0]).order_by('name')
-    alp_vals = make_alpha_matrix(individuals,normalise = True)
-    np_alp = np.array(alp_vals)
+    # each motif's alphas normalised to sum to one
+    np_alp = alphas / alphas.sum(axis = 1)[:,None]
     pca = PCA(n_components = 2,whiten = True,copy = True)
     pca.fit(np_alp.T)
     X = pca.transform(np_alp.T)
@@ -0,0 +1,11 @@
+# Settings for the batched e-steps in decomposition_functions.decompose_documents
+# A document stops iterating once the largest change in its gamma (which is in units of
+# normalised intensity) is below DECOMPOSITION_TOL
+# Documents are processed in blocks of about DECOMPOSITION_BLOCK_NNZ words (peak memory is
+# roughly 4 x 8 bytes x DECOMPOSITION_BLOCK_NNZ x the number of motifs)
+DECOMPOSITION_TOL = 1e-6
+DECOMPOSITION_BLOCK_NNZ = 5000
+
+# Results are written to the database DECOMPOSITION_WRITE_CHUNK rows at a time by
+# result_writer.DecompositionResultWriter
+DECOMPOSITION_WRITE_CHUNK = 5000
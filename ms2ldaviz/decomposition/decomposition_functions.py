@@ -1,15 +1,20 @@
+import time
 import numpy as np
-import bisect
+import scipy.sparse as sp
 import jsonpickle
 from scipy.special import psi as psi
 from scipy.special import polygamma as pg
-from scipy.sparse import coo_matrix
 import networkx as nx
 from networkx.readwrite import json_graph
-from decomposition.models import DocumentGlobalFeature,GlobalFeature,GlobalMotif,DocumentGlobalMass2Motif,DocumentFeatureMass2Motif,FeatureSet,Decomposition,FeatureMap,Beta
+from django.db import transaction
+from decomposition.models import DocumentGlobalFeature,GlobalFeature,GlobalMotif,DocumentGlobalMass2Motif,DocumentFeatureMass2Motif,FeatureSet,Decomposition,FeatureMap
 from basicviz.models import VizOptions,Experiment,Document,Mass2MotifInstance
+from basicviz.graph_cache import invalidate_graphs
 from annotation.models import TaxaInstance,SubstituentInstance
 from options.views import get_option
+from decomposition.motifset_cache import get_motifset_beta
+from decomposition.constants import DECOMPOSITION_TOL,DECOMPOSITION_BLOCK_NNZ,DECOMPOSITION_WRITE_CHUNK
+from decomposition.result_writer import DecompositionResultWriter
 from ms1analysis.models import Sample, DocSampleIntensity
 from ms1analysis.models import DecompositionAnalysis, DecompositionAnalysisResult, DecompositionAnalysisResultPlage
 
@@ -21,19 +26,6 @@ def add_sample(sample_name, experiment):
     sample = Sample.objects.get_or_create(name = sample_name, experiment = experiment)[0]
     return sample
 
-def add_doc_sample_intensity(sample, document, intensity):
-    i = DocSampleIntensity.objects.get_or_create(sample = sample, document = document, intensity = intensity)[0]
-
-def load_sample_intensity(document, experiment, metadata):
-    # metadata = lda_dict['doc_metadata'][doc_name]
-    if 'intensities' in metadata:
-        for sample_name, intensity in metadata['intensities'].items():
-            ## process missing data
-            ## if intensity not exist, does not save in database
-            if intensity:
-                sample = add_sample(sample_name, experiment)
-                add_doc_sample_intensity(sample, document, intensity)
-
 def load_mzml_and_make_documents(experiment,motifset):
     assert experiment.ms2_file
     peaklist = None
@@ -74,237 +66,329 @@ def load_mzml_and_make_documents(experiment,motifset):
     # TODO: what to do with this?
     # original_experiment = Experiment.objects.get(name=decompose_from)
 
-    features = GlobalFeature.objects.filter(featureset=fs).order_by('min_mz')
-
-    fragment_features = [f for f in features if f.name.startswith('fragment')]
-    loss_features = [f for f in features if f.name.startswith('loss')]
-    min_frag_mz = [f.min_mz for f in fragment_features]
-    max_frag_mz = [f.max_mz for f in fragment_features]
-    min_loss_mz = [f.min_mz for f in loss_features]
-    max_loss_mz = [f.max_mz for f in loss_features]
-
-    # Delete any already existing docs (mainly for debugging)
-    # docs = Document.objects.filter(experiment = experiment)
-    # print "Found {} documents to delete".format(len(docs))
-    # for doc in docs:
-    #     doc.delete()
-
-    # Add the documents to the database
-    n_done = 0
-    n_new_features = 0
+    start_time = time.time()
+    features = list(GlobalFeature.objects.filter(featureset=fs).order_by('min_mz'))
+    fragment_pos = [i for i,f in enumerate(features) if f.name.startswith('fragment')]
+    loss_pos = [i for i,f in enumerate(features) if f.name.startswith('loss')]
+    min_mz = np.array([f.min_mz for f in features],np.float)
+    max_mz = np.array([f.max_mz for f in features],np.float)
+
+    # One document per MS1 peak with MS2 peaks (in MS1 order), a molecule's peaks are found
+    # through a dictionary rather than by filtering the whole MS2 list
+    parents = set([peak[3] for peak in ms2])
+    doc_names = []
+    doc_molecules = []
+    doc_rows = {}
+    molecule_rows = {}
     for molecule in ms1:
-        ms2_features = filter(lambda x:x[3]==molecule,ms2)
-        if len(ms2_features) == 0:
+        if not molecule in parents:
             continue
         name = molecule.name + '_decomp'
-        new_doc,status = Document.objects.get_or_create(experiment = experiment,name = name)
-        ## load peaklist (sample names) to database
-        load_sample_intensity(new_doc, experiment, metadata[molecule.name])
+        if not name in doc_rows:
+            doc_rows[name] = len(doc_names)
+            doc_names.append(name)
+            doc_molecules.append(molecule)
+        doc_molecules[doc_rows[name]] = molecule
+        molecule_rows[molecule] = doc_rows[name]
+
+    peaks = [(molecule_rows[peak[3]],peak[0],peak[2],peak[3].mz) for peak in ms2 if peak[3] in molecule_rows]
+    if len(peaks) > 0:
+        peak_rows,mz,intensity,parent_mz = [np.array(column) for column in zip(*peaks)]
+    else:
+        peak_rows,mz,intensity,parent_mz = np.zeros(0,np.int),np.zeros(0),np.zeros(0),np.zeros(0)
+
+    # Every fragment has a feature, losses only within the range of the loss features
+    fragment_columns,new_names = assign_features(mz,fragment_pos,min_mz,max_mz,'fragment')
+    loss_mz = parent_mz - mz
+    if len(loss_pos) > 0:
+        in_range = (loss_mz >= min_mz[loss_pos[0]]) & (loss_mz <= max_mz[loss_pos[-1]])
+    else:
+        in_range = np.zeros(len(loss_mz),np.bool)
+    loss_columns,new_loss_names = assign_features(loss_mz[in_range],loss_pos,min_mz,max_mz,'loss')
+
+    # Make the new features (columns after the existing features) in bulk, unless the featureset
+    # already has them (as get_or_create)
+    feature_keys = {}
+    for i,f in enumerate(features):
+        feature_keys[(f.name,f.min_mz,f.max_mz)] = i
+    new_features = []
+    new_columns = np.zeros(len(new_names) + len(new_loss_names),np.int)
+    for i,key in enumerate(new_names + new_loss_names):
+        if not key in feature_keys:
+            feature_keys[key] = len(features)
+            features.append(GlobalFeature(name = key[0],min_mz = key[1],max_mz = key[2],featureset = fs))
+            new_features.append(features[-1])
+        new_columns[i] = feature_keys[key]
+    new_fragments = fragment_columns < 0
+    fragment_columns[new_fragments] = new_columns[-1 - fragment_columns[new_fragments]]
+    new_losses = loss_columns < 0
+    loss_columns[new_losses] = new_columns[len(new_names) - 1 - loss_columns[new_losses]]
+
+    # Sum the intensities of each document's features
+    rows = np.concatenate([peak_rows,peak_rows[in_range]])
+    columns = np.concatenate([fragment_columns,loss_columns])
+    keys,inverse = np.unique(rows * len(features) + columns,return_inverse = True)
+    sums = np.bincount(inverse,weights = np.concatenate([intensity,intensity[in_range]]))
+
+    with transaction.atomic():
+        if len(new_features) > 0:
+            GlobalFeature.objects.bulk_create(new_features)
+            if any(f.pk is None for f in new_features):
+                feature_ids = {}
+                for name,min_feature_mz,max_feature_mz,feature_id in GlobalFeature.objects.filter(featureset = fs).values_list('name','min_mz','max_mz','id'):
+                    feature_ids[(name,min_feature_mz,max_feature_mz)] = feature_id
+                for f in new_features:
+                    f.pk = feature_ids[(f.name,f.min_mz,f.max_mz)]
+        documents = save_documents(experiment,doc_names,doc_molecules,metadata)
+
+        docfeatures = []
+        for key,total in zip(keys.tolist(),sums.tolist()):
+            docfeatures.append(DocumentGlobalFeature(document_id = documents[key // len(features)].pk,
+                                                     feature_id = features[key % len(features)].pk,
+                                                     intensity = total))
+            if len(docfeatures) == DECOMPOSITION_WRITE_CHUNK:
+                DocumentGlobalFeature.objects.bulk_create(docfeatures)
+                docfeatures = []
+        DocumentGlobalFeature.objects.bulk_create(docfeatures)
+
+    print "Made {} documents with {} features (required {} new features) in {:.1f}s".format(
+        len(documents),len(keys),len(new_features),time.time() - start_time)
+
+
+# The feature of each mz: the position in features (ordered by min_mz) of the feature in
+# positions whose [min_mz, max_mz] contains it. An mz without one is given a new binned_005
+# feature, returned as -1 - its index in the returned list of new (name, min_mz, max_mz)
+def assign_features(mz,positions,min_mz,max_mz,prefix):
+    positions = np.array(positions,np.int)
+    pos = np.searchsorted(min_mz[positions],mz,side = 'right') - 1
+    found = pos >= 0
+    found[found] = mz[found] <= max_mz[positions[pos[found]]]
+    columns = np.full(len(mz),-1,np.int)
+    columns[found] = positions[pos[found]]
+
+    # make new features, assumes binned_005 featureset
+    tempmz = mz[~found]*100
+    new_min_mz = np.floor(tempmz)/100
+    upper = tempmz - np.floor(tempmz) > 0.5
+    new_min_mz[upper] = new_min_mz[upper] + 0.005
+    new_max_mz = new_min_mz + 0.005
+    new_features = []
+    new_index = {}
+    new_columns = np.zeros(len(tempmz),np.int)
+    for i,(feature_min_mz,feature_max_mz) in enumerate(zip(new_min_mz,new_max_mz)):
+        name = '{}_{}'.format(prefix,(feature_max_mz + feature_min_mz)/2.0)
+        if not name in new_index:
+            new_index[name] = len(new_features)
+            new_features.append((name,float(feature_min_mz),float(feature_max_mz)))
+        new_columns[i] = -1 - new_index[name]
+    columns[~found] = new_columns
+    return columns,new_features
+
+
+# Creates (or updates the metadata of) the named documents of the experiment, with their
+# sample intensities, in bulk. Existing documents have their features deleted, so they
+# can be replaced. Returns the documents in the order of doc_names
+def save_documents(experiment,doc_names,doc_molecules,metadata):
+    existing = {}
+    for document in Document.objects.filter(experiment = experiment):
+        existing[document.name] = document
+    documents = []
+    new_documents = []
+    for name,molecule in zip(doc_names,doc_molecules):
         doc_metadata = {}
         doc_metadata['parentmass'] = molecule.mz
         doc_metadata['parentrt'] = molecule.rt
-        new_doc.metadata = jsonpickle.encode(doc_metadata)
-        new_doc.save()
-        for f in ms2_features:
-            fragment_mz = f[0]
-            intensity = f[2]
-            frag_pos = bisect.bisect_right(min_frag_mz,fragment_mz)-1
-            if fragment_mz <= max_frag_mz[frag_pos]:
-                feat = fragment_features[frag_pos]
-                df,status = DocumentGlobalFeature.objects.get_or_create(document = new_doc,feature = feat)
-                if status:
-                    df.intensity = intensity
-                else:
-                    df.intensity += intensity
-                df.save()
-            else:
-                # make a new feature
-                # Assumes binned_005 featureset
-                tempmz = fragment_mz*100
-                if tempmz - np.floor(tempmz) > 0.5:
-                    min_mz = np.floor(tempmz)/100 + 0.005
-                else:
-                    min_mz = np.floor(tempmz)/100
-                max_mz = min_mz + 0.005
-                new_feature_name = 'fragment_{}'.format((max_mz + min_mz)/2.0)
-                gf,status = GlobalFeature.objects.get_or_create(max_mz = max_mz,min_mz = min_mz,name = new_feature_name,featureset = fs)
-                n_new_features += 1
-                df,status = DocumentGlobalFeature.objects.get_or_create(document = new_doc,feature = gf)
-                if status:
-                    df.intensity = intensity
-                else:
-                    df.intensity += intensity
-                df.save()
-                
-            loss_mz = molecule.mz - fragment_mz
-            if loss_mz >= min_loss_mz[0] and loss_mz <= max_loss_mz[-1]:
-                loss_pos = bisect.bisect_right(min_loss_mz,loss_mz)-1
-                if loss_mz <= max_loss_mz[loss_pos]:
-                    feat = loss_features[loss_pos]
-                    df,status = DocumentGlobalFeature.objects.get_or_create(document = new_doc,feature  = feat)
-                    if status:
-                        df.intensity = intensity
-                    else:
-                        df.intensity += intensity
-                    df.save()
-                else:
-                    # make a new feature
-                    tempmz = loss_mz*100
-                    if tempmz - np.floor(tempmz) > 0.5:
-                        min_mz = np.floor(tempmz)/100 + 0.005
-                    else:
-                        min_mz = np.floor(tempmz)/100
-                    max_mz = min_mz + 0.005
-                    new_feature_name = 'loss_{}'.format((max_mz + min_mz)/2.0)
-                    gf,status = GlobalFeature.objects.get_or_create(max_mz = max_mz,min_mz = min_mz,name = new_feature_name,featureset = fs)
-                    n_new_features += 1
-                    df,status = DocumentGlobalFeature.objects.get_or_create(document = new_doc,feature = gf)
-                    if status:
-                        df.intensity = intensity
-                    else:
-                        df.intensity += intensity
-                    df.save()
-                    
-        n_done += 1
-        if n_done % 100 == 0:
-            print "Done {} documents (required {} new features)".format(n_done,n_new_features)
-
-
+        if name in existing:
+            document = existing[name]
+            document.metadata = jsonpickle.encode(doc_metadata)
+            document.save()
+        else:
+            document = Document(experiment = experiment,name = name,metadata = jsonpickle.encode(doc_metadata))
+            document.set_metadata_columns()
+            new_documents.append(document)
+        documents.append(document)
+    Document.objects.bulk_create(new_documents)
+    if any(document.pk is None for document in new_documents):
+        document_ids = dict(Document.objects.filter(experiment = experiment).values_list('name','id'))
+        for document in new_documents:
+            document.pk = document_ids[document.name]
+    replaced = [document.pk for document in documents if document.name in existing]
+    for start in range(0,len(replaced),500):
+        DocumentGlobalFeature.objects.filter(document_id__in = replaced[start:start + 500]).delete()
+
+    ## load peaklist (sample names) to database
+    ## process missing data: if intensity not exist, does not save in database
+    samples = {}
+    for sample in Sample.objects.filter(experiment = experiment):
+        samples[sample.name] = sample
+    saved = set(DocSampleIntensity.objects.filter(document__experiment = experiment).values_list('sample_id','document_id','intensity'))
+    intensities = []
+    for document,molecule in zip(documents,doc_molecules):
+        for sample_name,intensity in metadata[molecule.name].get('intensities',{}).items():
+            if intensity:
+                if not sample_name in samples:
+                    samples[sample_name] = add_sample(sample_name,experiment)
+                if not (samples[sample_name].id,document.pk,intensity) in saved:
+                    saved.add((samples[sample_name].id,document.pk,intensity))
+                    intensities.append(DocSampleIntensity(sample = samples[sample_name],document = document,intensity = intensity))
+    DocSampleIntensity.objects.bulk_create(intensities)
+    invalidate_graphs(experiment.id)
+    return documents
 
 
-def decompose(decomposition,normalise = 1000.0,store_threshold = 0.01):
+def decompose(decomposition,normalise = 1000.0,store_threshold = 0.01,tol = DECOMPOSITION_TOL,replace = True):
     motifset = decomposition.motifset
-    betaobject = Beta.objects.get(motifset = motifset)
-    documents = Document.objects.filter(experiment = decomposition.experiment)
-    print "Loading and unpickling beta"
-
-    alpha = jsonpickle.decode(betaobject.alpha_list)
-    motif_id_list = jsonpickle.decode(betaobject.motif_id_list)
-    feature_id_list = jsonpickle.decode(betaobject.feature_id_list)
-    beta = jsonpickle.decode(betaobject.beta)
-
-    n_motifs = len(motif_id_list)
-    n_features = len(feature_id_list)
-
-    # if decomposition.motifset.name.startswith('gnps'):
-        # assuming sparse beta
-        # Naive construction
-        # beta_matrix = np.zeros((n_motif,n_feature),np.float)
-        # for r,c,v in beta:
-        #     beta_matrix[r,c] = v
-        # or using sparse...
-    r,c,data = zip(*beta)
-    beta_matrix = np.array(coo_matrix((data,(r,c)),shape=(n_motifs,n_features)).todense())
-    s = beta_matrix.sum(axis=1)[:,None]
-    s[s==0] = 1.0
-    beta_matrix /= s # makes beta a full matrix. Note that can keep it sparse by beta_matrix.data /= s[beta_matrix.row]
-    
-        # beta_matrix = coo.todense()
-    # else:
-        # beta_matrix = np.array(beta)
-
-
-    alpha_matrix = np.array(alpha)
-    
-
-    word_index = {}
-    for i,word_id in enumerate(feature_id_list):
-        feature = GlobalFeature.objects.get(id = word_id)
-        word_index[feature] = i
+    documents = list(Document.objects.filter(experiment = decomposition.experiment).order_by('id'))
 
-    motif_index = {}
-    motif_list = []
-    for i,motif_id in enumerate(motif_id_list):
-        motif = GlobalMotif.objects.get(id = motif_id)
-        motif_index[motif] = i
-        motif_list.append(motif)
+    motifset_beta = get_motifset_beta(motifset)
+    motif_list = motifset_beta.motif_list
+    feature_list = motifset_beta.feature_list
+    feature_index = {}
+    for i,feature in enumerate(feature_list):
+        feature_index[feature.id] = i
 
     K = len(motif_list)
 
+    # Load the features of all the documents in one query
+    doc_features = {}
+    for document in documents:
+        doc_features[document.id] = {}
+    docfeatures = DocumentGlobalFeature.objects.filter(document__experiment = decomposition.experiment)
+    for document_id,feature_id,intensity in docfeatures.values_list('document_id','feature_id','intensity'):
+        doc_features[document_id][feature_id] = intensity
+    doc_arrays = [make_document_arrays(doc_features[document.id],feature_index,normalise) for document in documents]
+
     g_term = np.zeros(K)
     print "Performing e-steps"
     total_docs = len(documents)
-    for i in range(total_docs):
-        document = documents[i]
-        print '%d/%d: %s' % (i, total_docs, document.name)
-        docfeatures = DocumentGlobalFeature.objects.filter(document = document)
-
-        doc_dict = {}
-        maxi = 0.0
-        for df in docfeatures:
-            doc_dict[df.feature] = df.intensity
-            if df.intensity > maxi:
-                maxi = df.intensity
-
-        # normalise
-        if normalise:
-            for word in doc_dict:
-                doc_dict[word] = int(normalise*doc_dict[word]/maxi)
-
-        # Do the e-steps for this document
-        phi_matrix = {}
-        for word in doc_dict:
-            phi_matrix[word] = None
-        gamma = np.ones(K)
-        for i in range(100): # do 100 iterations
-            # print "Iteration {}".format(i)
-            temp_gamma = np.zeros(K) + alpha_matrix
-            for word,intensity in doc_dict.items():
-                # Find the word position in beta
-                if word in word_index:
-                    word_pos = word_index[word]
-                    # beta_col = beta_matrix.getcol(word_pos).todense().flatten()
-                    # if beta_col.sum() > 0:
-                    if beta_matrix[:,word_pos].sum() > 0:
-                        log_phi_matrix = np.log(beta_matrix[:,word_pos]) + psi(gamma)
-                        # log_phi_matrix = np.log(beta_col) + psi(gamma).T
-                        log_phi_matrix = np.exp(log_phi_matrix - log_phi_matrix.max())
-                        phi_matrix[word] = log_phi_matrix/log_phi_matrix.sum()
-                        temp_gamma += phi_matrix[word]*intensity
-
-            gamma = temp_gamma.copy()
+    writer = DecompositionResultWriter(decomposition,replace = replace)
+    for d,gamma,positions,phi,overlap in decompose_documents(doc_arrays,motifset_beta,tol = tol):
+        document = documents[d]
+        print '%d/%d: %s' % (d, total_docs, document.name)
         g_term += psi(gamma) - psi(gamma.sum())
-        
-        
+
         # normalise the gamma to get probabilities
         theta = gamma/gamma.sum()
-        theta = list(theta.flatten())
-
-        theta_motif = zip(theta,motif_list)
-        theta_motif = sorted(theta_motif,key = lambda x : x[0],reverse = True)
-        theta,motif = zip(*theta_motif)
-        tot_prob = 0.0
-        for i in range(K):
-            if theta[i] < store_threshold:
+        for k in np.argsort(-theta,kind = 'mergesort'):
+            if theta[k] < store_threshold:
                 break
-            motif_pos = motif_index[motif[i]]
-            overlap_score = compute_overlap(phi_matrix,motif_pos,beta_matrix[motif_pos,:],word_index)
-            dgm2m,status = DocumentGlobalMass2Motif.objects.get_or_create(document = document,mass2motif = motif[i],decomposition=decomposition)
-            dgm2m.probability = theta[i]
-            dgm2m.overlap_score = overlap_score
-            dgm2m.save()
-            for word in phi_matrix:
-                if phi_matrix[word] == None:
-                    continue
-                else:
-                    if phi_matrix[word][motif_pos] >= store_threshold:
-                        dfm = DocumentFeatureMass2Motif.objects.get_or_create(docm2m = dgm2m,feature = word)[0]
-                        dfm.probability = phi_matrix[word][motif_pos]
-                        dfm.save()
+            feature_probabilities = []
+            for i,word_pos in enumerate(positions):
+                if phi[i,k] >= store_threshold:
+                    feature_probabilities.append((feature_list[word_pos],phi[i,k]))
+            writer.add(document,motif_list[k],theta[k],overlap[k],feature_probabilities)
+    writer.close()
     M = total_docs
     alpha = alpha_nr(g_term,M)
 
 
-def compute_overlap(phi_matrix,motif_pos,beta_row,word_index):
-    overlap_score = 0.0
-    for word in phi_matrix:
+# Turns a document dictionary (word -> intensity) into arrays of the positions (from word_index)
+# and intensities of its words, normalising the intensities so that the largest is normalise
+# Words not in word_index are dropped (after normalising)
+def make_document_arrays(doc_dict,word_index,normalise = 1000.0):
+    maxi = 0.0
+    for word,intensity in doc_dict.items():
+        if intensity > maxi:
+            maxi = intensity
+    positions = []
+    intensities = []
+    for word,intensity in doc_dict.items():
         if word in word_index:
-            word_pos = word_index[word]
-            if phi_matrix[word] == None:
+            if normalise:
+                intensity = int(normalise*intensity/maxi)
+            positions.append(word_index[word])
+            intensities.append(intensity)
+    return np.array(positions,np.int),np.array(intensities,np.float)
+
+
+# Batched e-steps for decomposition
+# doc_arrays is a list of (word positions, intensities) from make_document_arrays, where the
+# positions are columns of motifset_beta.beta.
+# Documents are processed in blocks of about block_nnz words: the gamma / phi updates for all of the
+# documents in a block are done together, and each document stops once the largest change
+# in its gamma is below tol (or after n_its iterations). With tol = None every document does n_its
+# iterations, exactly as the old per-document loop did.
+# Yields (document number, gamma, word positions, phi, overlap) for each document, in order, where
+# phi is (number of words x K) for the words of the document that have some probability
+# in the motifset and overlap is the overlap score of the document with each of the K motifs
+def decompose_documents(doc_arrays,motifset_beta,n_its = 100,tol = DECOMPOSITION_TOL,block_nnz = DECOMPOSITION_BLOCK_NNZ):
+    SMALL_NUMBER = 1e-100
+    alpha = motifset_beta.alpha
+    K = motifset_beta.K
+
+    # keep only the words with some probability in the motifset
+    doc_words = []
+    for positions,intensities in doc_arrays:
+        keep = motifset_beta.word_has_beta[positions]
+        doc_words.append((positions[keep],intensities[keep]))
+
+    start = 0
+    while start < len(doc_words):
+        end = start + 1
+        block_size = len(doc_words[start][0])
+        while end < len(doc_words) and block_size + len(doc_words[end][0]) <= block_nnz:
+            block_size += len(doc_words[end][0])
+            end += 1
+        n_docs = end - start
+
+        lengths = np.array([len(doc_words[d][0]) for d in range(start,end)],np.int)
+        offsets = np.zeros(n_docs + 1,np.int)
+        offsets[1:] = np.cumsum(lengths)
+        positions = np.concatenate([doc_words[d][0] for d in range(start,end)])
+        intensities = np.concatenate([doc_words[d][1] for d in range(start,end)])
+
+        beta_words = motifset_beta.get_columns(positions).T # n_words x K
+
+        gamma = np.ones((n_docs,K))
+        phi = np.zeros((len(positions),K))
+
+        # active holds the documents still iterating, words the rows of phi that belong
+        # to them and word_doc the position in active of the document of each of those words
+        active = np.arange(n_docs)
+        words = np.arange(len(positions))
+        word_doc = np.repeat(active,lengths)
+        active_beta = beta_words
+        for it in range(n_its):
+            weights = sp.csr_matrix((intensities[words],(word_doc,np.arange(len(words)))),shape = (len(active),len(words)))
+            # phi is proportional to beta * exp(psi(gamma)), scaled by the largest exp(psi(gamma))
+            # of each document. Words where this underflows for every motif are done in log space.
+            psi_gamma = psi(gamma[active,:])
+            psi_gamma -= psi_gamma.max(axis=1)[:,None]
+            new_phi = active_beta * np.exp(psi_gamma)[word_doc,:]
+            phi_sum = new_phi.sum(axis=1)
+            underflow = np.where(phi_sum < SMALL_NUMBER)[0]
+            if len(underflow) > 0:
+                with np.errstate(divide = 'ignore'):
+                    log_phi = np.log(active_beta[underflow,:]) + psi_gamma[word_doc[underflow],:]
+                log_phi = np.exp(log_phi - log_phi.max(axis=1)[:,None])
+                new_phi[underflow,:] = log_phi
+                phi_sum[underflow] = log_phi.sum(axis=1)
+            new_phi /= phi_sum[:,None]
+            phi[words,:] = new_phi
+            new_gamma = alpha + weights.dot(new_phi)
+
+            change = np.abs(new_gamma - gamma[active,:]).max(axis=1)
+            gamma[active,:] = new_gamma
+            if tol is None:
                 continue
-            else:
-                overlap_score += phi_matrix[word][motif_pos]*beta_row[word_pos]
-    return overlap_score
+            still_active = change >= tol
+            if not still_active.any():
+                break
+            if not still_active.all():
+                new_pos = np.cumsum(still_active) - 1
+                keep_words = still_active[word_doc]
+                active = active[still_active]
+                words = words[keep_words]
+                word_doc = new_pos[word_doc[keep_words]]
+                active_beta = beta_words[words,:]
+
+        # overlap of document d with motif k is the sum over its words of phi * beta
+        indicator = sp.csr_matrix((np.ones(len(positions)),(np.repeat(np.arange(n_docs),lengths),np.arange(len(positions)))),shape = (n_docs,len(positions)))
+        overlap = indicator.dot(phi*beta_words)
+
+        for i in range(n_docs):
+            yield start + i,gamma[i,:],positions[offsets[i]:offsets[i+1]],phi[offsets[i]:offsets[i+1],:],overlap[i,:]
+        start = end
 
 
 def get_parents_decomposition(motif_id,decomposition,experiment = None):
@@ -616,20 +700,29 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
                                 doc_max_size=200, motif_max_size=1000):
     # This is the graph maker for a decomposition experiment
     ## Notice mass2motif here is an object of GlobalMotif
-    ## Get all unique Global mass2motifs, prepare for *get_docglobalm2m*
-    all_docm2ms = DocumentGlobalMass2Motif.objects.filter(decomposition = decomposition)
-    mass2motifs = set([docm2m.mass2motif for docm2m in all_docm2ms])
+    ## All of the Global mass2motifs in the decomposition, and all of the document-motif links
+    ## above the thresholds (as *get_docglobalm2m*) with their documents, in one query each
+    mass2motifs = GlobalMotif.objects.filter(documentglobalmass2motif__decomposition = decomposition).distinct()
+    mass2motifs = mass2motifs.select_related('originalmotif__linkmotif')
+    doc_m2m_prob_threshold,doc_m2m_overlap_threshold = get_decomposition_thresholds(decomposition)
+    all_docm2ms = DocumentGlobalMass2Motif.objects.filter(decomposition = decomposition,
+                                                          probability__gte = doc_m2m_prob_threshold,
+                                                          overlap_score__gte = doc_m2m_overlap_threshold)
+    all_docm2ms = all_docm2ms.order_by('-probability').values_list('mass2motif_id', 'document_id', 'document__name',
+                                                                  'document__metadata', 'probability', 'overlap_score')
 
     # Find the degrees
     topics = {}
     docm2m_dict = {}
+    motif_names = {}
     for mass2motif in mass2motifs:
         topics[mass2motif] = 0
-        docm2ms = get_docglobalm2m(mass2motif, decomposition)
-        docm2m_dict[mass2motif] = list(docm2ms)
-
-        for d in docm2ms:
-            topics[mass2motif] += 1
+        docm2m_dict[mass2motif.id] = []
+        motif_names[mass2motif.id] = mass2motif.name
+    for docm2m in all_docm2ms:
+        docm2m_dict[docm2m[0]].append(docm2m)
+    for mass2motif in topics:
+        topics[mass2motif] = len(docm2m_dict[mass2motif.id])
     to_remove = []
     for topic in topics:
         if topics[topic] < min_degree:
@@ -639,16 +732,21 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
 
     docm2mset = []
     for topic in topics:
-        docm2mset += docm2m_dict[topic]
+        docm2mset += docm2m_dict[topic.id]
 
 
     do_plage_flag = True
     if ms1_analysis_id:
         analysis = DecompositionAnalysis.objects.filter(id=ms1_analysis_id)[0]
+        ## the results of the documents and motifs, in one query each
+        doc_ids = set([docm2m[1] for docm2m in docm2mset])
+        analysis_results = {}
         all_logfc_vals = []
-        res = DecompositionAnalysisResult.objects.filter(analysis=analysis, document__in=[docm2m.document for docm2m in docm2mset])
-        for analysis_result in res:
-            foldChange = analysis_result.foldChange
+        res = DecompositionAnalysisResult.objects.filter(analysis=analysis).order_by('id')
+        for document_id, foldChange, pValue in res.values_list('document_id', 'foldChange', 'pValue'):
+            if not document_id in doc_ids:
+                continue
+            analysis_results.setdefault(document_id, (foldChange, pValue))
             logfc = np.log(foldChange)
             if not np.abs(logfc) == np.inf:
                 all_logfc_vals.append(np.log(foldChange))
@@ -656,9 +754,14 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
         max_logfc = np.max(all_logfc_vals)
 
         ## try make graph for plage
+        topic_ids = set([topic.id for topic in topics])
+        plage_results = {}
         all_plage_vals = []
-        for plage_result in DecompositionAnalysisResultPlage.objects.filter(analysis=analysis, globalmotif__in=topics.keys()):
-            plage_t_value = plage_result.plage_t_value
+        res = DecompositionAnalysisResultPlage.objects.filter(analysis=analysis).order_by('id')
+        for globalmotif_id, plage_t_value, plage_p_value in res.values_list('globalmotif_id', 'plage_t_value', 'plage_p_value'):
+            if not globalmotif_id in topic_ids:
+                continue
+            plage_results.setdefault(globalmotif_id, (plage_t_value, plage_p_value))
             all_plage_vals.append(plage_t_value)
         if all_plage_vals:
             min_plage = np.min(all_plage_vals)
@@ -671,15 +774,13 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
     G = nx.Graph()
     for topic in topics:
         mass2motif = topic.originalmotif
-        metadata = jsonpickle.decode(mass2motif.metadata)
+        short_annotation = mass2motif.short_annotation
         ## try make graph for plage
         if ms1_analysis_id and do_plage_flag:
             ## white to green
             lowcol = [255, 255, 255]
             endcol = [0, 255, 0]
-            plage_result = DecompositionAnalysisResultPlage.objects.filter(analysis=analysis, globalmotif=topic)[0]
-            plage_t_value = plage_result.plage_t_value
-            plage_p_value = plage_result.plage_p_value
+            plage_t_value, plage_p_value = plage_results[topic.id]
             pos = (plage_t_value - min_plage) / (max_plage - min_plage)
             r = lowcol[0] + int(pos * (endcol[0] - lowcol[0]))
             g = lowcol[1] + int(pos * (endcol[1] - lowcol[1]))
@@ -691,7 +792,7 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
                 size = motif_max_size
             else:
                 size = min(10 - np.log(plage_p_value) * 200, motif_max_size)
-            na = mass2motif.short_annotation
+            na = short_annotation
             if na:
                 na += ' (' + topic.name + ')'
             else:
@@ -704,9 +805,9 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
                        score=1, node_id=topic.id, is_topic=True)
 
         else:
-            if mass2motif.short_annotation:
+            if short_annotation:
             # if 'annotation' in metadata:
-                G.add_node(topic.name, group=2, name=mass2motif.short_annotation,
+                G.add_node(topic.name, group=2, name=short_annotation,
                            size=topic_scale_factor * topics[topic],
                            special=True, in_degree=topics[topic],
                            score=1, node_id=topic.id, is_topic=True)
@@ -716,7 +817,7 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
                            special=False, in_degree=topics[topic],
                            score=1, node_id=topic.id, is_topic=True)
 
-    doc_nodes = []
+    doc_nodes = set()
 
     print "Second"
 
@@ -724,25 +825,23 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
     # edge_choice = get_option('default_doc_m2m_score', experiment)
     edge_choice = 'probability'
 
-    for docm2m in docm2mset:
+    for mass2motif_id, document_id, document_name, document_metadata, probability, overlap_score in docm2mset:
         # if docm2m.mass2motif in topics:
-        if not docm2m.document in doc_nodes:
-            metadata = jsonpickle.decode(docm2m.document.metadata)
+        if not document_id in doc_nodes:
+            metadata = jsonpickle.decode(document_metadata)
             if 'compound' in metadata:
                 name = metadata['compound']
             elif 'annotation' in metadata:
                 name = metadata['annotation']
             else:
-                name = docm2m.document.name
+                name = document_name
             ## do MS1 expression analysis only when user choose a ms1 analysis setting
             if not ms1_analysis_id:
-                G.add_node(docm2m.document.name, group=1, name=name, size=20,
-                           type='square', peakid=docm2m.document.name, special=False,
+                G.add_node(document_name, group=1, name=name, size=20,
+                           type='square', peakid=document_name, special=False,
                            in_degree=0, score=0, is_topic=False)
             else:
-                analysis_result = DecompositionAnalysisResult.objects.filter(analysis=analysis, document=docm2m.document)[0]
-                foldChange = analysis_result.foldChange
-                pValue = analysis_result.pValue
+                foldChange, pValue = analysis_results[document_id]
                 logfc = np.log(foldChange)
 
                 ## lowest: blue, logfc==0: white, highest: red
@@ -780,21 +879,21 @@ def make_decomposition_graph(decomposition,experiment,min_degree = 5,
                 else:
                     name = "{}, {:.3f}, None".format(name, logfc)
                 # name += ", " + str(logfc) + ", " + str(pValue)
-                G.add_node(docm2m.document.name, group=1, name=name, size=size,
-                           type='square', peakid=docm2m.document.name, special=True,
-                           highlight_colour=col, logfc=docm2m.document.logfc,
+                G.add_node(document_name, group=1, name=name, size=size,
+                           type='square', peakid=document_name, special=True,
+                           highlight_colour=col, logfc=metadata.get('logfc'),
                            in_degree=0, score=0, is_topic=False)
 
-            doc_nodes.append(docm2m.document)
+            doc_nodes.add(document_id)
 
 
         if edge_choice == 'probability':
-            weight = edge_scale_factor * docm2m.probability
+            weight = edge_scale_factor * probability
         elif edge_choice == 'both':
-            weight = docm2m.overlap_score
+            weight = overlap_score
         else:
-            weight = edge_scale_factor * docm2m.overlap_score
-        G.add_edge(docm2m.mass2motif.name, docm2m.document.name, weight=weight)
+            weight = edge_scale_factor * overlap_score
+        G.add_edge(motif_names[mass2motif_id], document_name, weight=weight)
     print "Third"
 
     return G
@@ -805,37 +904,10 @@ def api_decomposition(doc_dict,motifset):
 
     normalise = 1000.0
 
-    betaobject = Beta.objects.get(motifset = motifset)
-    alpha = jsonpickle.decode(betaobject.alpha_list)
-    motif_id_list = jsonpickle.decode(betaobject.motif_id_list)
-    feature_id_list = jsonpickle.decode(betaobject.feature_id_list)
-    beta = jsonpickle.decode(betaobject.beta)
-
-
-    n_motifs = len(motif_id_list)
-    n_features = len(feature_id_list)
-
-    r,c,data = zip(*beta)
-    beta_matrix = np.array(coo_matrix((data,(r,c)),shape=(n_motifs,n_features)).todense())
-    s = beta_matrix.sum(axis=1)[:,None]
-    s[s==0] = 1.0
-    beta_matrix /= s # makes beta a full matrix. Note that can keep it sparse by beta_matrix.data /= s[beta_matrix.row]
-
-
-    alpha_matrix = np.array(alpha)
-    
-
-    word_index = {}
-    for i,word_id in enumerate(feature_id_list):
-        feature = GlobalFeature.objects.get(id = word_id)
-        word_index[feature] = i
-
-    motif_index = {}
-    motif_list = []
-    for i,motif_id in enumerate(motif_id_list):
-        motif = GlobalMotif.objects.get(id = motif_id)
-        motif_index[motif] = i
-        motif_list.append(motif)
+    motifset_beta = get_motifset_beta(motifset)
+    word_index = motifset_beta.word_index
+    motif_index = motifset_beta.motif_index
+    motif_list = motifset_beta.motif_list
 
     K = len(motif_list)
     print "Performing e-steps"
@@ -846,44 +918,16 @@ def api_decomposition(doc_dict,motifset):
     results['terms'] = {}
     g_term = np.zeros(K)
 
-    for i,doc in enumerate(doc_dict.keys()):
+    doc_names = doc_dict.keys()
+    doc_arrays = [make_document_arrays(doc_dict[doc],word_index,normalise) for doc in doc_names]
+    for i,gamma,positions,phi,overlap in decompose_documents(doc_arrays,motifset_beta):
+        doc = doc_names[i]
         results['decompositions'][doc] = []
         results['terms'][doc] = []
-        document = doc_dict[doc]
         print '%d/%d: %s' % (i, total_docs, doc)
 
-        maxi = 0.0
-        for feature,intensity in doc_dict[doc].items():
-            if intensity > maxi:
-                maxi = intensity
-
-        # normalise
-        if normalise:
-            for word in doc_dict[doc]:
-                doc_dict[doc][word] = int(normalise*doc_dict[doc][word]/maxi)
-
-        # Do the e-steps for this document
-        phi_matrix = {}
-        for word in doc_dict[doc]:
-            phi_matrix[word] = None
-        gamma = np.ones(K)
-        for ei in range(100): # do 20 iterations
-            # print "Iteration {}".format(ei)
-            temp_gamma = np.zeros(K) + alpha_matrix
-            # temp_gamma = np.ones_like(alpha_matrix)
-            for word,intensity in doc_dict[doc].items():
-                # Find the word position in beta
-                if word in word_index:
-                    word_pos = word_index[word]
-                    if beta_matrix[:,word_pos].sum() > 0:
-                        log_phi_matrix = np.log(beta_matrix[:,word_pos]) + psi(gamma)
-                        log_phi_matrix = np.exp(log_phi_matrix - log_phi_matrix.max())
-                        phi_matrix[word] = log_phi_matrix/log_phi_matrix.sum()
-                        temp_gamma += phi_matrix[word]*intensity
-
-            gamma = temp_gamma.copy()
-        g_term += psi(gamma) - psi(gamma.sum())        
-        
+        g_term += psi(gamma) - psi(gamma.sum())
+
         # normalise the gamma to get probabilities
         theta = gamma/gamma.sum()
         theta = list(theta.flatten())
@@ -898,8 +942,7 @@ def api_decomposition(doc_dict,motifset):
 
         while cum_prob < 0.99:
             theta,motif = theta_motif[pos]
-            motif_pos = motif_index[motif]
-            overlap_score = compute_overlap(phi_matrix,motif_pos,beta_matrix[motif_pos,:],word_index)
+            overlap_score = overlap[motif_index[motif]]
 
 
             tax_term_instances = TaxaInstance.objects.filter(motif = motif.originalmotif)
@@ -1066,6 +1109,17 @@ def parse_spectrum_string(spectrum_string):
     return peaks
 
 def get_docglobalm2m(globalm2m, decomposition, doc_m2m_prob_threshold=None, doc_m2m_overlap_threshold=None):
+    doc_m2m_prob_threshold, doc_m2m_overlap_threshold = get_decomposition_thresholds(decomposition, doc_m2m_prob_threshold, doc_m2m_overlap_threshold)
+
+    ## Notice need to add *decomposition* when search database for *DocumentGlobalMass2Motif*
+    ## For LDA experiment,  *DocumentMass2Motif* does not have *experiment* entry, so does not need to do that
+    dm2m = DocumentGlobalMass2Motif.objects.filter(mass2motif=globalm2m, decomposition=decomposition, probability__gte=doc_m2m_prob_threshold,
+                                                 overlap_score__gte=doc_m2m_overlap_threshold).order_by('-probability')
+
+    return dm2m
+
+
+def get_decomposition_thresholds(decomposition, doc_m2m_prob_threshold=None, doc_m2m_overlap_threshold=None):
     # experiment = mass2motif.experiment
     experiment = Experiment.objects.get(pk=decomposition.experiment_id)
     ## default prob_threshold 0.05, default overlap_threshld 0.0
@@ -1083,9 +1137,4 @@ def get_docglobalm2m(globalm2m, decomposition, doc_m2m_prob_threshold=None, doc_
         else:
             doc_m2m_overlap_threshold = 0.0
 
-    ## Notice need to add *decomposition* when search database for *DocumentGlobalMass2Motif*
-    ## For LDA experiment,  *DocumentMass2Motif* does not have *experiment* entry, so does not need to do that
-    dm2m = DocumentGlobalMass2Motif.objects.filter(mass2motif=globalm2m, decomposition=decomposition, probability__gte=doc_m2m_prob_threshold,
-                                                 overlap_score__gte=doc_m2m_overlap_threshold).order_by('-probability')
-
-    return dm2m
+    return doc_m2m_prob_threshold, doc_m2m_overlap_threshold
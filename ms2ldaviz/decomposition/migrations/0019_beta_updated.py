@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 16:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('decomposition', '0018_apibatchresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='beta',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
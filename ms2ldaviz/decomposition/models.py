@@ -98,6 +98,8 @@ class Beta(models.Model):
 	feature_id_list = models.TextField(null = True)
 	alpha_list = models.TextField(null = True)
 	motifset = models.ForeignKey(MotifSet,null = True)
+	# version stamp for the decoded beta cache in motifset_cache.py
+	updated = models.DateTimeField(auto_now = True,null = True)
 
 class DocumentGlobalMass2Motif(models.Model):
 	document = models.ForeignKey(Document)
@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+
+import jsonpickle
+import numpy as np
+from scipy.sparse import coo_matrix, diags
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from decomposition.models import Beta, GlobalFeature, GlobalMotif
+
+# Per-process cache of decoded motifset betas, so decomposition doesn't have to unpickle
+# the Beta row and look up every feature and motif each time it is called.
+# Entries are keyed on the motifset id and stamped with the Beta row's (id, updated),
+# so a Beta rewritten by make_beta.py etc. (in any process) is reloaded on the next call.
+# The least recently used motifset is dropped once there are more than MOTIFSET_CACHE_SIZE.
+MOTIFSET_CACHE_SIZE = 4
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class MotifSetBeta(object):
+    # The decoded Beta of a motifset:
+    # beta: normalised K x n_features scipy CSC matrix (rows are motifs)
+    # alpha: numpy array of the K alphas
+    # motif_list, motif_index: GlobalMotifs in beta row order and GlobalMotif -> row
+    # feature_list, word_index: GlobalFeatures in beta column order and GlobalFeature -> column
+    # word_has_beta: boolean array, True for columns with some probability in at least one motif
+    def __init__(self, betaobject):
+        motifset = betaobject.motifset
+        motif_id_list = jsonpickle.decode(betaobject.motif_id_list)
+        feature_id_list = jsonpickle.decode(betaobject.feature_id_list)
+        self.alpha = np.array(jsonpickle.decode(betaobject.alpha_list))
+
+        self.K = len(motif_id_list)
+        self.n_features = len(feature_id_list)
+
+        beta = jsonpickle.decode(betaobject.beta)
+        if len(beta) > 0:
+            r, c, data = zip(*beta)
+        else:
+            r, c, data = [], [], []
+        beta_matrix = coo_matrix((data, (r, c)), shape=(self.K, self.n_features), dtype=np.float).tocsr()
+        s = np.asarray(beta_matrix.sum(axis=1)).flatten()
+        s[s == 0] = 1.0
+        self.beta = (diags(1.0 / s) * beta_matrix).tocsc()
+        self.word_has_beta = np.asarray(self.beta.sum(axis=0)).flatten() > 0
+
+        # One query for the features (plus one for any that aren't in the motifset's featureset)
+        # and one for the motifs
+        features = {}
+        for feature in GlobalFeature.objects.filter(featureset=motifset.featureset):
+            features[feature.id] = feature
+        missing = [feature_id for feature_id in feature_id_list if not feature_id in features]
+        if len(missing) > 0:
+            features.update(GlobalFeature.objects.in_bulk(missing))
+        self.feature_list = [features[feature_id] for feature_id in feature_id_list]
+        self.word_index = {}
+        for i, feature in enumerate(self.feature_list):
+            self.word_index[feature] = i
+
+        motifs = {}
+        for motif in GlobalMotif.objects.filter(id__in=motif_id_list).select_related('originalmotif'):
+            motifs[motif.id] = motif
+        self.motif_list = [motifs[motif_id] for motif_id in motif_id_list]
+        self.motif_index = {}
+        for i, motif in enumerate(self.motif_list):
+            self.motif_index[motif] = i
+
+    # Dense K x len(positions) array of the requested beta columns
+    def get_columns(self, positions):
+        return self.beta[:, positions].toarray()
+
+
+def get_motifset_beta(motifset):
+    version = Beta.objects.values_list('id', 'updated').get(motifset=motifset)
+    with _lock:
+        entry = _cache.pop(motifset.id, None)
+        if entry is not None and entry[0] == version:
+            _cache[motifset.id] = entry
+            return entry[1]
+
+    print "Loading and unpickling beta for {}".format(motifset)
+    motifset_beta = MotifSetBeta(Beta.objects.get(id=version[0]))
+    with _lock:
+        _cache[motifset.id] = (version, motifset_beta)
+        while len(_cache) > MOTIFSET_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return motifset_beta
+
+
+def invalidate_motifset_cache(motifset_id=None):
+    with _lock:
+        if motifset_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(motifset_id, None)
+
+
+# Saves in this process don't have to wait for the version check
+@receiver(post_save, sender=Beta)
+@receiver(post_delete, sender=Beta)
+def beta_changed(sender, instance, **kwargs):
+    invalidate_motifset_cache(instance.motifset_id)
@@ -0,0 +1,91 @@
+import time
+
+from django.db import transaction
+
+from basicviz.graph_cache import invalidate_graphs
+from decomposition.models import DocumentGlobalMass2Motif, DocumentFeatureMass2Motif
+from decomposition.constants import DECOMPOSITION_WRITE_CHUNK
+
+
+# Collects the results of a decomposition and writes them with bulk_create, rather than
+# a get_or_create and a save for every DocumentGlobalMass2Motif and DocumentFeatureMass2Motif.
+# Rows are written every DECOMPOSITION_WRITE_CHUNK rows, each chunk in its own transaction
+# (so a DocumentGlobalMass2Motif is never committed without its DocumentFeatureMass2Motifs).
+# With replace = True any existing results for the decomposition are deleted first, so
+# re-running a decomposition doesn't leave old rows behind.
+# Usage:
+#   writer = DecompositionResultWriter(decomposition)
+#   writer.add(document, globalmotif, probability, overlap_score, [(globalfeature, probability), ...])
+#   ...
+#   writer.close()
+class DecompositionResultWriter(object):
+    def __init__(self, decomposition, replace=True, chunk_size=DECOMPOSITION_WRITE_CHUNK):
+        self.decomposition = decomposition
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.n_pending = 0
+        self.n_docm2m = 0
+        self.n_featurem2m = 0
+        self.write_time = 0.0
+        if replace:
+            self.delete_existing()
+
+    def delete_existing(self):
+        start_time = time.time()
+        with transaction.atomic():
+            DocumentFeatureMass2Motif.objects.filter(docm2m__decomposition=self.decomposition).delete()
+            DocumentGlobalMass2Motif.objects.filter(decomposition=self.decomposition).delete()
+        self.write_time += time.time() - start_time
+
+    def add(self, document, mass2motif, probability, overlap_score, feature_probabilities=None):
+        if feature_probabilities is None:
+            feature_probabilities = []
+        self.pending.append((document, mass2motif, probability, overlap_score, feature_probabilities))
+        self.n_pending += 1 + len(feature_probabilities)
+        if self.n_pending >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        start_time = time.time()
+        with transaction.atomic():
+            docm2ms = []
+            for document, mass2motif, probability, overlap_score, feature_probabilities in self.pending:
+                docm2ms.append(DocumentGlobalMass2Motif(document=document, mass2motif=mass2motif,
+                                                        probability=float(probability),
+                                                        overlap_score=float(overlap_score),
+                                                        decomposition=self.decomposition))
+            DocumentGlobalMass2Motif.objects.bulk_create(docm2ms, batch_size=self.chunk_size)
+
+            # PostgreSQL sets the ids in bulk_create, other databases don't so they are looked up.
+            # If there are old rows (replace = False) the newest (highest id) is used
+            if any(docm2m.pk is None for docm2m in docm2ms):
+                docm2m_ids = {}
+                document_ids = set([docm2m.document_id for docm2m in docm2ms])
+                rows = DocumentGlobalMass2Motif.objects.filter(decomposition=self.decomposition,
+                                                               document_id__in=document_ids).order_by('id')
+                for docm2m_id, document_id, mass2motif_id in rows.values_list('id', 'document_id', 'mass2motif_id'):
+                    docm2m_ids[(document_id, mass2motif_id)] = docm2m_id
+                for docm2m in docm2ms:
+                    docm2m.pk = docm2m_ids[(docm2m.document_id, docm2m.mass2motif_id)]
+
+            featurem2ms = []
+            for docm2m, (_, _, _, _, feature_probabilities) in zip(docm2ms, self.pending):
+                for feature, probability in feature_probabilities:
+                    featurem2ms.append(DocumentFeatureMass2Motif(docm2m_id=docm2m.pk, feature=feature,
+                                                                 probability=float(probability)))
+            DocumentFeatureMass2Motif.objects.bulk_create(featurem2ms, batch_size=self.chunk_size)
+
+        self.n_docm2m += len(docm2ms)
+        self.n_featurem2m += len(featurem2ms)
+        self.write_time += time.time() - start_time
+        self.pending = []
+        self.n_pending = 0
+
+    def close(self):
+        self.flush()
+        invalidate_graphs(self.decomposition.experiment_id)
+        n_rows = self.n_docm2m + self.n_featurem2m
+        print "Wrote {} document-motif and {} feature-motif rows in {:.1f}s ({:.0f} rows/s)".format(
+            self.n_docm2m, self.n_featurem2m, self.write_time, n_rows / max(self.write_time, 1e-6))
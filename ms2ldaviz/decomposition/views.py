@@ -9,6 +9,7 @@ from decomposition.models import GlobalMotif,DocumentGlobalMass2Motif,Decomposit
 from decomposition.forms import DecompVizForm,NewDecompositionForm,BatchDecompositionForm,SpectrumForm,MotifsetAnnotationForm
 from basicviz.models import Mass2MotifInstance,Experiment,Document,JobLog,VizOptions
 from basicviz.forms import VizForm
+from basicviz.graph_cache import get_cached_graph,set_cached_graph
 from options.views import get_option
 
 from ms1analysis.models import DecompositionAnalysis
@@ -157,6 +158,9 @@ def start_viz(request,decomposition_id):
 
 def get_graph(request,decomposition_id,vo_id):
     vo = VizOptions.objects.get(id = vo_id)
+    graph_json = get_cached_graph(vo,decomposition_id)
+    if graph_json is not None:
+        return HttpResponse(graph_json,content_type = 'application/json')
     decomposition = Decomposition.objects.get(id = decomposition_id)
     experiment = decomposition.experiment
     min_degree = int(vo.min_degree)
@@ -167,7 +171,9 @@ def get_graph(request,decomposition_id,vo_id):
     G = make_decomposition_graph(decomposition,experiment,min_degree = min_degree,
                                 ms1_analysis_id = vo.ms1_analysis_id)
     d = json_graph.node_link_data(G)
-    return HttpResponse(json.dumps(d),content_type = 'application/json')
+    graph_json = json.dumps(d)
+    set_cached_graph(vo,graph_json,decomposition_id)
+    return HttpResponse(graph_json,content_type = 'application/json')
 
 
 def new_decomposition(request,experiment_id):
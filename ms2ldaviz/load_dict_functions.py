@@ -1,11 +1,12 @@
 import pickle
 import sys
+import time
 
 import jsonpickle
 
 from basicviz.models import Experiment,Document,Feature,FeatureInstance,Mass2Motif,Mass2MotifInstance,DocumentMass2Motif,FeatureMass2MotifInstance,Alpha
 from basicviz.models import BVFeatureSet
-from basicviz.views import compute_overlap_score
+from basicviz.graph_cache import invalidate_graphs
 from ms1analysis.models import Sample, DocSampleIntensity
 
 from django.db import transaction
@@ -167,111 +168,153 @@ def load_sample_intensity(document, experiment, metadata):
                 sample = add_sample(sample_name, experiment)
                 add_doc_sample_intensity(sample, document, intensity)
 
+# Rows are written with bulk_create LOAD_BATCH_SIZE at a time
+LOAD_BATCH_SIZE = 5000
+
 def load_dict(lda_dict,experiment,verbose = True,feature_set_name = 'binned_005'):
+    # Loads everything in an lda dictionary into the (new) experiment.
+    # Names are resolved to ids in memory and each table is written with bulk_create
+    # in its own transaction. If the experiment already has documents or motifs (e.g.
+    # from a load that was interrupted) they are deleted first.
+    stage_times = []
+    def stage_done(stage,start_time,n_rows):
+        stage_times.append((stage,time.time() - start_time,n_rows))
+        print "{}: {} rows in {:.1f}s".format(stage,n_rows,stage_times[-1][1])
+        experiment.status = "Loaded {}".format(stage)
+        experiment.save()
 
     # Hard-coded to use the binned 005 featureset
     featureset = BVFeatureSet.objects.get(name = feature_set_name)
     experiment.featureset = featureset
     experiment.save()
+
+    start_time = time.time()
+    if Document.objects.filter(experiment = experiment).exists() or Mass2Motif.objects.filter(experiment = experiment).exists():
+        print "Deleting the documents and motifs of a previous load"
+        with transaction.atomic():
+            Document.objects.filter(experiment = experiment).delete()
+            Mass2Motif.objects.filter(experiment = experiment).delete()
+            Sample.objects.filter(experiment = experiment).delete()
+        stage_done('cleanup',start_time,0)
+
+    start_time = time.time()
+    feature_ids = dict(Feature.objects.filter(featureset = featureset).values_list('name','id'))
     if 'features' in lda_dict:
         print "Explicit feature object: loading them all at once"
-        add_all_features_set(experiment,lda_dict['features'],featureset = featureset)
-
+        new_features = []
+        for feature,mz_vals in lda_dict['features'].items():
+            if not feature in feature_ids:
+                new_features.append(Feature(name = feature,featureset = featureset,min_mz = mz_vals[0],max_mz = mz_vals[1]))
+        with transaction.atomic():
+            Feature.objects.bulk_create(new_features,batch_size = LOAD_BATCH_SIZE)
+        feature_ids = dict(Feature.objects.filter(featureset = featureset).values_list('name','id'))
+        stage_done('features',start_time,len(new_features))
 
     print "Loading corpus, samples and intensities"
-    n_done = 0
-    to_do = len(lda_dict['corpus'])
-    with transaction.atomic():
-        for doc in lda_dict['corpus']:
-            n_done += 1
-            if n_done % 100 == 0:
-                print "Done {}/{}".format(n_done,to_do)
-                experiment.status = "Done {}/{} docs".format(n_done,to_do)
-                experiment.save()
-            ## remove 'intensities' from metdat before store it into database
-            metdat = lda_dict['doc_metadata'][doc].copy()
-            metdat.pop('intensities', None)
-            metdat = jsonpickle.encode(metdat)
-            if verbose:
-                print doc,experiment,metdat
-            d = add_document(doc,experiment,metdat)
-            # d = Document.objects.get_or_create(name=doc,experiment=experiment,metadata=metdat)[0]
-
-            add_document_words_set(d,doc,experiment,lda_dict,featureset)
-
-
-            load_sample_intensity(d, experiment, lda_dict['doc_metadata'][doc])
-
-
-            # for word in lda_dict['corpus'][doc]:
-            #   feature = add_feature(word,experiment)
-            #   # feature = Feature.objects.get_or_create(name=word,experiment=experiment)[0]
-            #   # fi = FeatureInstance.objects.get_or_create(document = d,feature = feature, intensity = lda_dict['corpus'][doc][word])
-            #   add_feature_instance(d,feature,lda_dict['corpus'][doc][word])
-    print "Loading topics"
-    n_done = 0
-    to_do = len(lda_dict['beta'])
+    start_time = time.time()
+    documents = []
+    sample_names = set()
+    for doc in lda_dict['corpus']:
+        ## remove 'intensities' from metdat before store it into database
+        metdat = lda_dict['doc_metadata'][doc].copy()
+        intensities = metdat.pop('intensities', {})
+        sample_names.update(intensities.keys())
+        metdat = jsonpickle.encode(metdat)
+        if verbose:
+            print doc,experiment,metdat
+        document = Document(name = doc,experiment = experiment,metadata = metdat)
+        document.set_metadata_columns()
+        documents.append(document)
     with transaction.atomic():
-        for topic in lda_dict['beta']:
-            n_done += 1
-            if n_done % 100 == 0:
-                print "Done {}/{}".format(n_done,to_do)
-                experiment.status = "Done {}/{} topics".format(n_done,to_do)
-                experiment.save()
-            metadata = {}
-            metadata = lda_dict['topic_metadata'].get(topic,{})
-            add_topic_set(topic,experiment,jsonpickle.encode(metadata),lda_dict,featureset)
-            # m2m = Mass2Motif.objects.get_or_create(name = topic,experiment = experiment,metadata = jsonpickle.encode(metadata))[0]
-            # for word in lda_dict['beta'][topic]:
-            #   feature = Feature.objects.get(name = word,experiment=experiment)
-            #   Mass2MotifInstance.objects.get_or_create(feature = feature,mass2motif = m2m,probability = lda_dict['beta'][topic][word])
-
-    print "Loading theta"
-    n_done = 0
-    to_do = len(lda_dict['theta'])
+        Document.objects.bulk_create(documents,batch_size = LOAD_BATCH_SIZE)
+    document_ids = dict(Document.objects.filter(experiment = experiment).values_list('name','id'))
+    stage_done('documents',start_time,len(documents))
+
+    start_time = time.time()
+    feature_instances = []
+    for doc,words in lda_dict['corpus'].items():
+        document_id = document_ids[doc]
+        for word,intensity in words.items():
+            feature_instances.append(FeatureInstance(document_id = document_id,feature_id = feature_ids[word],intensity = intensity))
     with transaction.atomic():
-        for doc in lda_dict['theta']:
-            n_done += 1
-            if n_done % 100 == 0:
-                print "Done {}/{}".format(n_done,to_do) 
-                experiment.status = "Done {}/{} theta".format(n_done,to_do)     
-                experiment.save()
-            add_theta(doc,experiment,lda_dict)
+        FeatureInstance.objects.bulk_create(feature_instances,batch_size = LOAD_BATCH_SIZE)
+    feature_instance_ids = {}
+    for fi_id,document_id,feature_id in FeatureInstance.objects.filter(document__experiment = experiment).values_list('id','document_id','feature_id'):
+        feature_instance_ids[(document_id,feature_id)] = fi_id
+    stage_done('feature instances',start_time,len(feature_instances))
 
+    start_time = time.time()
+    with transaction.atomic():
+        Sample.objects.bulk_create([Sample(name = sample_name,experiment = experiment) for sample_name in sample_names],batch_size = LOAD_BATCH_SIZE)
+    sample_ids = dict(Sample.objects.filter(experiment = experiment).values_list('name','id'))
+    doc_sample_intensities = []
+    for doc in lda_dict['corpus']:
+        for sample_name,intensity in lda_dict['doc_metadata'][doc].get('intensities',{}).items():
+            ## process missing data
+            ## if intensity not exist, does not save in database
+            if intensity:
+                doc_sample_intensities.append(DocSampleIntensity(sample_id = sample_ids[sample_name],document_id = document_ids[doc],intensity = intensity))
+    with transaction.atomic():
+        DocSampleIntensity.objects.bulk_create(doc_sample_intensities,batch_size = LOAD_BATCH_SIZE)
+    stage_done('sample intensities',start_time,len(sample_names) + len(doc_sample_intensities))
 
-            # document = Document.objects.get(name = doc,experiment=experiment)
-            # for topic in lda_dict['theta'][doc]:
-            #   mass2motif = Mass2Motif.objects.get(name = topic,experiment = experiment)
-            #   DocumentMass2Motif.objects.get_or_create(document = document,mass2motif = mass2motif,probability = lda_dict['theta'][doc][topic])
+    print "Loading topics"
+    start_time = time.time()
+    mass2motifs = []
+    for topic in lda_dict['beta']:
+        metadata = lda_dict['topic_metadata'].get(topic,{})
+        mass2motifs.append(Mass2Motif(name = topic,experiment = experiment,metadata = jsonpickle.encode(metadata)))
+    with transaction.atomic():
+        Mass2Motif.objects.bulk_create(mass2motifs,batch_size = LOAD_BATCH_SIZE)
+    mass2motif_ids = dict(Mass2Motif.objects.filter(experiment = experiment).values_list('name','id'))
+    mass2motif_instances = []
+    alphas = []
+    for topic in lda_dict['beta']:
+        mass2motif_id = mass2motif_ids[topic]
+        for word,probability in lda_dict['beta'][topic].items():
+            mass2motif_instances.append(Mass2MotifInstance(feature_id = feature_ids[word],mass2motif_id = mass2motif_id,probability = probability))
+        topic_pos = lda_dict['topic_index'][topic]
+        alphas.append(Alpha(mass2motif_id = mass2motif_id,value = lda_dict['alpha'][topic_pos]))
+    with transaction.atomic():
+        Mass2MotifInstance.objects.bulk_create(mass2motif_instances,batch_size = LOAD_BATCH_SIZE)
+        Alpha.objects.bulk_create(alphas,batch_size = LOAD_BATCH_SIZE)
+    stage_done('topics',start_time,len(mass2motifs) + len(mass2motif_instances) + len(alphas))
+
+    print "Loading theta and computing overlap scores"
+    start_time = time.time()
+    document_mass2motifs = []
+    for doc in lda_dict['theta']:
+        # The same score as basicviz.views.compute_overlap_score: the sum over the document's phi
+        # entries (for all motifs) of phi times the probability of the word in the motif
+        word_phi = {}
+        for word,topic_phi in lda_dict['phi'].get(doc,{}).items():
+            word_phi[word] = sum(topic_phi.values())
+        for topic,probability in lda_dict['theta'][doc].items():
+            topic_beta = lda_dict['beta'][topic]
+            overlap_score = 0.0
+            for word,phi in word_phi.items():
+                if word in topic_beta:
+                    overlap_score += phi*topic_beta[word]
+            document_mass2motifs.append(DocumentMass2Motif(document_id = document_ids[doc],mass2motif_id = mass2motif_ids[topic],
+                                                           probability = probability,overlap_score = overlap_score))
+    with transaction.atomic():
+        DocumentMass2Motif.objects.bulk_create(document_mass2motifs,batch_size = LOAD_BATCH_SIZE)
+    stage_done('theta',start_time,len(document_mass2motifs))
 
     print "Loading phi"
-    n_done = 0
-    to_do = len(lda_dict['phi'])
+    start_time = time.time()
+    feature_mass2motif_instances = []
+    for doc in lda_dict['phi']:
+        document_id = document_ids[doc]
+        for word in lda_dict['phi'][doc]:
+            fi_id = feature_instance_ids[(document_id,feature_ids[word])]
+            for topic,probability in lda_dict['phi'][doc][word].items():
+                feature_mass2motif_instances.append(FeatureMass2MotifInstance(featureinstance_id = fi_id,mass2motif_id = mass2motif_ids[topic],probability = probability))
     with transaction.atomic():
-        for doc in lda_dict['phi']:
-            n_done += 1
-            if n_done % 100 == 0:
-                print "Done {}/{}".format(n_done,to_do)
-                experiment.status = "Done {}/{} phi".format(n_done,to_do)
-                experiment.save()
-            load_phi_set(doc,experiment,lda_dict,featureset)
-            # document = Document.objects.get(name = doc,experiment=experiment)
-            # for word in lda_dict['phi'][doc]:
-            #   feature = Feature.objects.get(name=word,experiment=experiment)
-            #   feature_instance = FeatureInstance.objects.get(document=document,feature=feature)
-            #   for topic in lda_dict['phi'][doc][word]:
-            #       mass2motif = Mass2Motif.objects.get(name=topic,experiment=experiment)
-            #       probability = lda_dict['phi'][doc][word][topic]
-            #       FeatureMass2MotifInstance.objects.get_or_create(featureinstance = feature_instance,mass2motif = mass2motif,probability = probability)
-
-    print "Computing overlap scores"
-    n_done = 0
-    dm2ms = DocumentMass2Motif.objects.filter(document__experiment = experiment)
-    to_do = len(dm2ms)
-    with transaction.atomic():
-        for dm2m in dm2ms:
-            n_done += 1
-            if n_done % 100 == 0:
-                print "Done {}/{}".format(n_done,to_do)
-            dm2m.overlap_score = compute_overlap_score(dm2m.mass2motif,dm2m.document)
-            dm2m.save()
\ No newline at end of file
+        FeatureMass2MotifInstance.objects.bulk_create(feature_mass2motif_instances,batch_size = LOAD_BATCH_SIZE)
+    stage_done('phi',start_time,len(feature_mass2motif_instances))
+    invalidate_graphs(experiment.id)
+
+    print "Finished loading in {:.1f}s".format(sum(t for _,t,_ in stage_times))
+    for stage,stage_time,n_rows in stage_times:
+        print "  {:<20}{:>10} rows{:>10.1f}s".format(stage,n_rows,stage_time)
@@ -10,6 +10,7 @@ django.setup()
 import jsonpickle
 
 from basicviz.models import Experiment,MultiFileExperiment,MultiLink
+from basicviz.tasks import compute_multifile_matrices
 
 
 from load_dict_functions import *
@@ -50,4 +51,7 @@ if __name__ == '__main__':
 		load_dict(lda_dict,experiment,verbose,feature_set_name = fs_name)
 
 	n_loaded += 1
-	mfe.status = 'loaded {} of {}'.format(n_loaded,len(multi_lda_dict['individual_lda']))
\ No newline at end of file
+	mfe.status = 'loaded {} of {}'.format(n_loaded,len(multi_lda_dict['individual_lda']))
+
+	# precompute the alpha and degree matrices for the multi-file views
+	compute_multifile_matrices(mfe.id)
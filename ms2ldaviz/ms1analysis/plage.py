@@ -0,0 +1,80 @@
+import multiprocessing
+
+import numpy as np
+
+## number of permutations used for the PLAGE p-values
+PLAGE_ITERATIONS = 10000
+## seed for the permutations, so that the p-values of an analysis are reproducible
+PLAGE_SEED = 42
+
+
+## builds the (documents x samples) intensity matrix once for all of the motifs
+## missing intensities are set to 0.0, and documents with all missing values are omitted
+## returns the matrix and a dictionary from document id to its row
+def make_intensity_matrix(document_intensity_dict, samples):
+    row_index = {}
+    rows = []
+    for doc_id, sample_intensity_dict in document_intensity_dict.items():
+        intensity_list = [sample_intensity_dict.get(sample.id, 0.0) for sample in samples]
+        if np.sum(intensity_list) > 0.0:
+            row_index[doc_id] = len(rows)
+            rows.append(intensity_list)
+    intensity_matrix = np.array(rows, dtype=np.float).reshape(len(rows), len(samples))
+    return intensity_matrix, row_index
+
+
+## all the permutations as one (iterations x n_samples) index matrix, drawn from a seeded generator
+## the same permutations are used for every motif
+def make_permutations(n_samples, iterations=PLAGE_ITERATIONS, seed=PLAGE_SEED):
+    rng = np.random.RandomState(seed)
+    permutations = np.empty((iterations, n_samples), dtype=np.int)
+    for i in range(iterations):
+        permutations[i] = rng.permutation(n_samples)
+    return permutations
+
+
+## t-values for each row of v0_matrix, where the first n_group1 columns are group1
+def plage_t_values(v0_matrix, n_group1):
+    v0_group1 = v0_matrix[:, :n_group1]
+    v0_group2 = v0_matrix[:, n_group1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_vals = np.abs(v0_group1.mean(axis=1) - v0_group2.mean(axis=1))
+        t_vals /= np.sqrt(v0_group1.var(axis=1) / (1.0 * v0_group1.shape[1]) + v0_group2.var(axis=1) / (1.0 * v0_group2.shape[1]))
+    return t_vals
+
+
+## PLAGE t-value and permutation p-value for the intensities of one motif's documents
+## sub_mat is (documents x samples), with the group1 samples first
+## is it correct to set t_val to be zero when there are no documents???
+def plage_test(sub_mat, n_group1, permutations):
+    if len(sub_mat) == 0:
+        return 0, None
+    u, s, v = np.linalg.svd(sub_mat)
+    true_t_val = plage_t_values(v[0][None, :], n_group1)[0]
+    if true_t_val == 0:
+        return true_t_val, None
+    t_vals = plage_t_values(v[0][permutations], n_group1)
+    count = (t_vals >= true_t_val).sum()
+    return true_t_val, count * 1.0 / len(permutations)
+
+
+def _plage_test_star(args):
+    return plage_test(*args)
+
+
+## runs plage_test for every motif in motif_rows (motif -> rows of intensity_matrix)
+## returns a dictionary from motif to (t-value, p-value)
+## with n_processes > 1 the motifs are split across a process pool (note that this isn't
+## possible from inside a celery prefork worker, whose processes are daemonic)
+def run_plage(motif_rows, intensity_matrix, n_group1, iterations=PLAGE_ITERATIONS, seed=PLAGE_SEED, n_processes=1):
+    permutations = make_permutations(intensity_matrix.shape[1], iterations, seed)
+    motifs = list(motif_rows.keys())
+    args = [(intensity_matrix[motif_rows[motif]], n_group1, permutations) for motif in motifs]
+    if n_processes > 1:
+        pool = multiprocessing.Pool(n_processes)
+        results = pool.map(_plage_test_star, args)
+        pool.close()
+        pool.join()
+    else:
+        results = [plage_test(*a) for a in args]
+    return dict(zip(motifs, results))
@@ -8,6 +8,7 @@ from decomposition.decomposition_functions import get_docglobalm2m
 from decomposition.models import DocumentGlobalMass2Motif, Decomposition
 from ms1analysis.models import DecompositionAnalysis, DecompositionAnalysisResult, DecompositionAnalysisResultPlage
 from ms1analysis.models import Sample, DocSampleIntensity, Analysis, AnalysisResult, AnalysisResultPlage
+from ms1analysis.plage import make_intensity_matrix, run_plage
 from ms2ldaviz.celery_tasks import app
 from django.forms import model_to_dict
 
@@ -32,71 +33,17 @@ def process_ms1_analysis(new_analysis_id, params):
 
     document_intensity_dict = get_intensities(group1_samples, group2_samples, use_normalization)
 
-    ## set up a dictionary to cache documents' intensities
-    document_intensitylist_dict = {}
+    ## build the documents x samples intensity matrix once, and find the rows of each motif's documents
+    intensity_matrix, row_index = make_intensity_matrix(document_intensity_dict, samples)
+    motif_rows = {}
     for mass2motif in mass2motifs:
         docm2ms = get_docm2m(mass2motif)
         # docm2ms = DocumentMass2Motif.objects.filter(mass2motif=mass2motif)
-        sub_mat = []
-        # for docm2m in docm2ms:
-        #     if docm2m.document in document_intensities_dict:
-        #         temp_list = document_intensities_dict[docm2m.document]
-        #         sub_mat.append(temp_list)
-        #     else:
-        #         temp_list = []
-        #         for sample in samples:
-        #             ## missing intensity will be set to 0.0
-        #             try:
-        #                 intensity = DocSampleIntensity.objects.filter(document=docm2m.document, sample=sample)[0].intensity
-        #             except:
-        #                 intensity = 0.0
-        #             temp_list.append(intensity)
-        #         ## documents with all missing values should still be omitted
-        #         if np.sum(temp_list) > 0.0:
-        #             document_intensities_dict[docm2m.document] = temp_list
-        #             sub_mat.append(temp_list)
-
-        for doc_id, sample_intensity_dict in document_intensity_dict.items():
-            intensity_list = []
-            for sample in samples:
-                if sample.id in sample_intensity_dict:
-                    intensity_list.append(sample_intensity_dict[sample.id])
-                else:
-                    intensity_list.append(0.0)
-            if np.sum(intensity_list) > 0.0:
-                document_intensitylist_dict[doc_id] = intensity_list
-
-        for docm2m in docm2ms:
-            if docm2m.document.id in document_intensitylist_dict:
-                sub_mat.append(document_intensitylist_dict[docm2m.document.id])
-
-        sub_mat = np.array(sub_mat)
-
-        ## is it correct to set t_val to be zero here???
-        if len(sub_mat) == 0:
-            true_t_val = 0
-            plage_p_val = None
-        else:
-            u, s, v = np.linalg.svd(sub_mat)
-            v0_group1 = v[0][:len(group1)]
-            v0_group2 = v[0][len(group1):]
-            t_val = np.abs(np.mean(v0_group1) - np.mean(v0_group2))
-            t_val /= np.sqrt(np.var(v0_group1)/(1.0*len(group1)) + np.var(v0_group2)/(1.0*len(group2)))
-            true_t_val = t_val
-            if true_t_val == 0:
-                plage_p_val = None
-            else:
-                count = 0
-                iterations = 10000
-                for i in range(iterations):
-                    v0_permutation = np.random.permutation(v[0])
-                    v0_group1 = v0_permutation[:len(group1)]
-                    v0_group2 = v0_permutation[len(group1):]
-                    t_val = np.abs(np.mean(v0_group1) - np.mean(v0_group2))
-                    t_val /= np.sqrt(np.var(v0_group1) / (1.0 * len(group1)) + np.var(v0_group2) / (1.0 * len(group2)))
-                    if t_val >= true_t_val:
-                        count += 1
-                plage_p_val = count * 1.0 / iterations
+        motif_rows[mass2motif] = [row_index[doc_id] for doc_id in docm2ms.values_list('document_id', flat=True) if doc_id in row_index]
+
+    plage_results = run_plage(motif_rows, intensity_matrix, len(group1))
+    for mass2motif in mass2motifs:
+        true_t_val, plage_p_val = plage_results[mass2motif]
         AnalysisResultPlage.objects.get_or_create(analysis=new_analysis, mass2motif=mass2motif,plage_t_value=true_t_val, plage_p_value=plage_p_val)
 
     ## do fold change and pValue here
@@ -180,68 +127,16 @@ def process_ms1_analysis_decomposition(new_analysis_id, params):
 
     document_intensity_dict = get_intensities(group1_samples, group2_samples, use_normalization)
 
-    ## set up a dictionary to cache documents' intensities
-    document_intensitylist_dict = {}
+    ## build the documents x samples intensity matrix once, and find the rows of each motif's documents
+    intensity_matrix, row_index = make_intensity_matrix(document_intensity_dict, samples)
+    motif_rows = {}
     for mass2motif in mass2motifs:
         docm2ms = get_docglobalm2m(mass2motif, decomposition)
-        sub_mat = []
-        # for docm2m in docm2ms:
-        #     if docm2m.document in document_intensities_dict:
-        #         temp_list = document_intensities_dict[docm2m.document]
-        #         sub_mat.append(temp_list)
-        #     else:
-        #         temp_list = []
-        #         for sample in samples:
-        #             ## missing intensity will be set to 0.0
-        #             try:
-        #                 intensity = DocSampleIntensity.objects.filter(document=docm2m.document, sample=sample)[0].intensity
-        #             except:
-        #                 intensity = 0.0
-        #             temp_list.append(intensity)
-        #         ## documents with all missing values should still be omitted
-        #         if np.sum(temp_list) > 0.0:
-        #             document_intensities_dict[docm2m.document] = temp_list
-        #             sub_mat.append(temp_list)
-        for doc_id, sample_intensity_dict in document_intensity_dict.items():
-            intensity_list = []
-            for sample in samples:
-                if sample.id in sample_intensity_dict:
-                    intensity_list.append(sample_intensity_dict[sample.id])
-                else:
-                    intensity_list.append(0.0)
-            if np.sum(intensity_list) > 0.0:
-                document_intensitylist_dict[doc_id] = intensity_list
-
-        for docm2m in docm2ms:
-            if docm2m.document.id in document_intensitylist_dict:
-                sub_mat.append(document_intensitylist_dict[docm2m.document.id])
-
-        sub_mat = np.array(sub_mat)
-
-        if len(sub_mat) == 0:
-            true_t_val = 0
-            plage_p_val = None
-        else:
-            u, s, v = np.linalg.svd(sub_mat)
-            v0_group1 = v[0][:len(group1)]
-            v0_group2 = v[0][len(group1):]
-            t_val = np.abs(np.mean(v0_group1) - np.mean(v0_group2))
-            t_val /= np.sqrt(np.var(v0_group1)/(1.0*len(group1)) + np.var(v0_group2)/(1.0*len(group2)))
-            true_t_val = t_val
-            if true_t_val == 0:
-                plage_p_val = None
-            else:
-                count = 0
-                iterations = 10000
-                for i in range(iterations):
-                    v0_permutation = np.random.permutation(v[0])
-                    v0_group1 = v0_permutation[:len(group1)]
-                    v0_group2 = v0_permutation[len(group1):]
-                    t_val = np.abs(np.mean(v0_group1) - np.mean(v0_group2))
-                    t_val /= np.sqrt(np.var(v0_group1) / (1.0 * len(group1)) + np.var(v0_group2) / (1.0 * len(group2)))
-                    if t_val >= true_t_val:
-                        count += 1
-                plage_p_val = count * 1.0 / iterations
+        motif_rows[mass2motif] = [row_index[doc_id] for doc_id in docm2ms.values_list('document_id', flat=True) if doc_id in row_index]
+
+    plage_results = run_plage(motif_rows, intensity_matrix, len(group1))
+    for mass2motif in mass2motifs:
+        true_t_val, plage_p_val = plage_results[mass2motif]
         DecompositionAnalysisResultPlage.objects.get_or_create(analysis=new_analysis, globalmotif=mass2motif,plage_t_value=true_t_val, plage_p_value=plage_p_val)
 
     ## do fold change and pValue here
@@ -58,6 +58,7 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'options.cache.OptionsCacheMiddleware',
 ]
 
 TEMPLATES = [
@@ -97,6 +98,20 @@ DATABASES = {
     }
 }
 
+# Cache
+# Shared by the web processes, the celery workers and the scripts, so that the option
+# snapshots (options/cache.py) and the network graphs (basicviz/graph_cache.py) are
+# invalidated in all of them. The table is made by the basicviz migrations
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'ms2ldaviz_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class OptionsConfig(AppConfig):
+    name = 'options'
+
+    # Connects the receivers that drop the cached options, also in processes that
+    # don't import the views (e.g. the scripts)
+    def ready(self):
+        import options.cache
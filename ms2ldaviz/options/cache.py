@@ -0,0 +1,92 @@
+import threading
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from basicviz.models import SystemOptions
+
+# Cache of the SystemOptions, so get_option doesn't run up to two queries every time it is
+# called (get_prob_overlap_thresholds calls it twice for every get_docm2m, which some views
+# do for every motif or document).
+# The options of an experiment (its own ones over the global ones) are loaded as one
+# snapshot in one query. Snapshots are kept:
+# - for the rest of the request, by OptionsCacheMiddleware
+# - in the Django cache for OPTIONS_CACHE_TIMEOUT seconds (shared by all of the processes,
+#   see CACHES in settings.py)
+# Saving or deleting a SystemOptions drops the snapshots that include it: an experiment's
+# own snapshot, or every snapshot (by moving to a new generation) for a global option.
+OPTIONS_CACHE_TIMEOUT = 300
+GENERATION_KEY = 'options:generation'
+
+_local = threading.local()
+
+
+# Moves a generation counter on. The counter never expires (incr would set it with the
+# default timeout on some backends, and an expired counter would go back to old generations)
+def bump_generation(key):
+    cache.set(key, cache.get(key, 0) + 1, None)
+
+
+def _cache_key(experiment_id):
+    return 'options:{}:{}'.format(cache.get(GENERATION_KEY, 0), experiment_id)
+
+
+# Dictionary from key to value of the options of an experiment (or just the global options
+# for experiment_id = None). As get_option, the first of any repeated global option is used
+def load_options(experiment_id=None):
+    global_options = {}
+    experiment_options = {}
+    rows = SystemOptions.objects.filter(Q(experiment__isnull=True) | Q(experiment_id=experiment_id)).order_by('id')
+    for key, value, option_experiment_id in rows.values_list('key', 'value', 'experiment_id'):
+        if option_experiment_id is None:
+            global_options.setdefault(key, value)
+        else:
+            experiment_options.setdefault(key, value)
+    global_options.update(experiment_options)
+    return global_options
+
+
+def get_options(experiment=None):
+    experiment_id = experiment.id if experiment else None
+    snapshots = getattr(_local, 'snapshots', None)
+    if snapshots is not None and experiment_id in snapshots:
+        return snapshots[experiment_id]
+
+    key = _cache_key(experiment_id)
+    options = cache.get(key)
+    if options is None:
+        options = load_options(experiment_id)
+        cache.set(key, options, OPTIONS_CACHE_TIMEOUT)
+    if snapshots is not None:
+        snapshots[experiment_id] = options
+    return options
+
+
+def invalidate_options(experiment_id=None):
+    snapshots = getattr(_local, 'snapshots', None)
+    if experiment_id is None:
+        bump_generation(GENERATION_KEY)
+        if snapshots is not None:
+            snapshots.clear()
+    else:
+        cache.delete(_cache_key(experiment_id))
+        if snapshots is not None:
+            snapshots.pop(experiment_id, None)
+
+
+# Holds the snapshots used during a request, so repeated lookups don't go to the cache
+class OptionsCacheMiddleware(object):
+    def process_request(self, request):
+        _local.snapshots = {}
+
+    def process_response(self, request, response):
+        _local.snapshots = None
+        return response
+
+
+@receiver(post_save, sender=SystemOptions)
+@receiver(post_delete, sender=SystemOptions)
+def option_changed(sender, instance, **kwargs):
+    invalidate_options(instance.experiment_id)
@@ -1,23 +1,15 @@
 from django.shortcuts import render
 
 from basicviz.models import Experiment, MultiFileExperiment, SystemOptions
+from options.cache import get_options
 from options.constants import AVAILABLE_OPTIONS
 from options.forms import SystemOptionsForm
 
 
 def get_option(key, experiment=None):
     # Retrieves an option, looking for an experiment specific one if it exists
-    print "Looking for option ",key
-    if experiment:
-        options = SystemOptions.objects.filter(key=key, experiment=experiment)
-        if len(options) == 0:
-            options = SystemOptions.objects.filter(key=key, experiment__isnull = True)
-    else:
-        options = SystemOptions.objects.filter(key=key, experiment__isnull = True)
-    if len(options) > 0:
-        return options[0].value 
-    else:
-        return None
+    # (from the cached options of the experiment, see options.cache)
+    return get_options(experiment).get(key)
 
 
 def view_experiment_options(request, experiment_id):
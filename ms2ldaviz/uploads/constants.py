@@ -0,0 +1,7 @@
+# Settings for the LDA runs in uploads.tasks.lda_task
+# The run stops once the mean change per motif in beta drops below LDA_CONVERGENCE_TOL,
+# and is checkpointed to LDA_CHECKPOINT_FILENAME (in the upload folder) every
+# LDA_CHECKPOINT_EVERY iterations so that a restarted task carries on from there
+LDA_CONVERGENCE_TOL = 1e-3
+LDA_CHECKPOINT_EVERY = 10
+LDA_CHECKPOINT_FILENAME = 'lda_checkpoint.pkl'
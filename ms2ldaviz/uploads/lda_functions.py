@@ -8,6 +8,8 @@ from basicviz.models import Experiment, Document, Feature, FeatureInstance, Mass
     DocumentMass2Motif, FeatureMass2MotifInstance, Alpha
 import jsonpickle
 
+from .constants import LDA_CONVERGENCE_TOL, LDA_CHECKPOINT_EVERY
+
 
 def load_mzml_and_make_documents(experiment):
     assert experiment.ms2_file
@@ -50,9 +52,10 @@ def load_mzml_and_make_documents(experiment):
     return corpus, metadata, word_mz_range
 
 
-def run_lda(corpus, metadata, word_mz_range, K, n_its=1000):
-    vlda = VariationalLDA(corpus=corpus, K=K, normalise=1000.0)
-    vlda.run_vb(n_its=n_its, initialise=True)
+def run_lda(corpus, metadata, word_mz_range, K, n_its=1000, checkpoint_file=None):
+    vlda = VariationalLDA(corpus=corpus, K=K, normalise=1000.0, engine='sparse', store_phi=False)
+    vlda.run_vb(n_its=n_its, initialise=True, tol=LDA_CONVERGENCE_TOL,
+                checkpoint_file=checkpoint_file, checkpoint_every=LDA_CHECKPOINT_EVERY)
 
     lda_dict = vlda.make_dictionary(metadata=metadata, features=word_mz_range)
     return lda_dict
@@ -16,6 +16,7 @@ from load_dict_functions import load_dict
 from ms2ldaviz.celery_tasks import app
 from .lda_functions import load_mzml_and_make_documents as lda_load_mzml_and_make_documents
 from .lda_functions import run_lda
+from .constants import LDA_CHECKPOINT_FILENAME
 
 
 def delete_analysis_dir(exp):
@@ -48,7 +49,9 @@ def custom_logger(exp):
     return logger
 
 
-@app.task
+# acks_late: if the worker is killed the task is redelivered, and run_lda picks up
+# from the last checkpoint in the upload folder
+@app.task(acks_late=True)
 def lda_task(exp_id, params):
 
     exp = Experiment.objects.get(pk=exp_id)
@@ -68,7 +71,8 @@ def lda_task(exp_id, params):
         app.log.redirect_stdouts_to_logger(logger, rlevel)
 
         corpus, metadata, word_mz_range = lda_load_mzml_and_make_documents(exp)
-        lda_dict = run_lda(corpus, metadata, word_mz_range, K, n_its=n_its)
+        checkpoint_file = os.path.join(os.path.dirname(exp.ms2_file.path), LDA_CHECKPOINT_FILENAME)
+        lda_dict = run_lda(corpus, metadata, word_mz_range, K, n_its=n_its, checkpoint_file=checkpoint_file)
         load_dict(lda_dict, exp)
 
         yes, _ = EXPERIMENT_DECOMPOSITION_SOURCE[1]